@@ -1,9 +1,18 @@
 import pandas as pd
 import numpy as np
 import datetime as dt
+import os
+import re
+import sys
+import csv
+import json
+import codecs
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import matplotlib.pyplot as plt
 import seaborn as sns
-from typing import Union, Optional, Dict, List, Tuple
+from typing import Union, Optional, Dict, List, Tuple, Iterable, Iterator, Callable
 
 
 def rfm_analysis(
@@ -16,7 +25,13 @@ def rfm_analysis(
     ranking_method: str = 'quantile',
     custom_intervals: Optional[Dict[str, List[float]]] = None,
     business_days_only: bool = False,
-    segment_mapping: Optional[Dict[str, str]] = None
+    segment_mapping: Optional[Union[Dict[str, str], List[Tuple]]] = None,
+    weekmask: str = '1111100',
+    holidays: Optional[Union[str, List]] = None,
+    n_jobs: int = 1,
+    compact_dtypes: Optional[bool] = None,
+    quantile_error: float = 0.01,
+    monetary_stats: Optional[Iterable[str]] = None
 ) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
     """
     Выполняет расширенный RFM-анализ на основе пользовательских данных.
@@ -37,14 +52,37 @@ def rfm_analysis(
     n_quantiles : int, default=4
         Количество квантилей для ранжирования.
     ranking_method : str, default='quantile'
-        Метод ранжирования: 'quantile' для квантилей или 'fixed' для фиксированных интервалов.
+        Метод ранжирования: 'quantile' для квантилей, 'approx_quantile' для приближенных
+        квантилей по объединяемому скетчу или 'fixed' для фиксированных интервалов.
     custom_intervals : dict, optional
         Пользовательские интервалы для ранжирования метрик при ranking_method='fixed'.
         Формат: {'R': [intervals], 'F': [intervals], 'M': [intervals]}.
     business_days_only : bool, default=False
         Учитывать только рабочие дни при расчете Recency.
-    segment_mapping : dict, optional
-        Словарь для маппинга RFM-сегментов. Если None, используется стандартная сегментация.
+    segment_mapping : dict or list, optional
+        Словарь для маппинга RFM-сегментов или набор правил сегментации
+        (см. compile_segment_table). Если None, используется стандартная сегментация.
+    weekmask : str, default='1111100'
+        Маска рабочих дней недели (понедельник-воскресенье) при business_days_only=True.
+    holidays : str or list, optional
+        Нерабочие праздничные дни при business_days_only=True: список дат или путь
+        к файлу производственного календаря (см. load_holiday_calendar).
+    n_jobs : int, default=1
+        Количество процессов для расчета метрик. Клиенты распределяются по процессам
+        по хешу идентификатора; -1 означает все доступные ядра. Ускорение возможно
+        только при нескольких ядрах: разбиение данных выполняется в одном процессе.
+    compact_dtypes : bool, optional
+        Хранить результат в компактных типах: ранги int8, Recency и Frequency в
+        наименьшем подходящем целом типе, RFM_Segment_Code и Customer_Segment как
+        pandas Categorical. Если None, включается автоматически при числе клиентов
+        не меньше COMPACT_DTYPES_MIN_CUSTOMERS.
+    quantile_error : float, default=0.01
+        Допустимая ошибка ранга квантиля (доля клиентов) при ranking_method='approx_quantile'.
+    monetary_stats : iterable of str, optional
+        Дополнительные статистики сумм покупок клиента: 'mean' (Monetary_Mean),
+        'median' (Monetary_Median), 'std' (Monetary_Std). Незапрошенные статистики не рассчитываются
+        и не добавляются в результат; пустой набор оставляет только Monetary.
+        Если None, рассчитываются все (MONETARY_STATS).
         
     Returns:
     --------
@@ -54,344 +92,2322 @@ def rfm_analysis(
     # Валидация входных данных
     _validate_input_data(data, date_col, customer_col, amount_col)
     
-    # Копирование данных во избежание изменения исходного DataFrame
-    data_copy = data.copy()
+    # Берем только нужные столбцы без копирования исходного DataFrame;
+    # преобразуются только даты и суммы, если они еще не в нужном формате
+    transactions = _select_transaction_columns(data, date_col, customer_col, amount_col)
     
+    # Устанавливаем дату анализа
+    current_date = _resolve_analysis_date(analysis_date)
+    
+    # Рассчитываем метрики RFM
+    rfm = _calculate_rfm_metrics(transactions, customer_col, date_col, amount_col, current_date,
+                                 business_days_only, weekmask, holidays, n_jobs, monetary_stats)
+    
+    # Присваиваем ранги для каждой метрики
+    compact = _use_compact_dtypes(compact_dtypes, len(rfm))
+    rfm, rank_edges = _assign_rfm_ranks(rfm, n_quantiles, ranking_method, custom_intervals, compact,
+                                        quantile_error)
+    
+    # Создаем RFM-сегменты
+    rfm = _create_rfm_segments(rfm, segment_mapping, compact)
+    
+    # Создаем дополнительную информацию для анализа
+    additional_info = _create_additional_info(rfm)
+    additional_info['rank_edges'] = rank_edges
+    
+    return rfm, additional_info
+
+
+def _resolve_analysis_date(analysis_date: Optional[Union[str, dt.datetime]]) -> dt.datetime:
+    """Возвращает дату анализа; если она не задана, используется текущая дата."""
+    if analysis_date is None:
+        return dt.datetime.now()
+    if isinstance(analysis_date, str):
+        try:
+            return pd.to_datetime(analysis_date)
+        except Exception as e:
+            raise ValueError(f"Невозможно преобразовать analysis_date в формат datetime: {str(e)}")
+    return analysis_date
+
+
+def _select_transaction_columns(data: pd.DataFrame, date_col: str, customer_col: str,
+                                amount_col: str) -> pd.DataFrame:
+    """Возвращает DataFrame из трех столбцов анализа, не копируя данные исходного DataFrame."""
+    dates = data[date_col]
     # Преобразование столбца с датами в datetime, если он еще не в этом формате
-    if not pd.api.types.is_datetime64_any_dtype(data_copy[date_col]):
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        try:
+            dates = pd.to_datetime(dates)
+        except Exception as e:
+            raise ValueError(f"Невозможно преобразовать столбец {date_col} в формат datetime: {str(e)}")
+    
+    amounts = data[amount_col]
+    if not pd.api.types.is_numeric_dtype(amounts):
+        amounts = pd.to_numeric(amounts)
+    
+    columns = {customer_col: data[customer_col], date_col: dates, amount_col: amounts}
+    return pd.DataFrame(columns, copy=False)
+
+
+def _validate_input_data(data: pd.DataFrame, date_col: str, customer_col: str, amount_col: str) -> None:
+    """Проверяет входные данные на корректность."""
+    # Проверка наличия необходимых столбцов
+    required_cols = [date_col, customer_col, amount_col]
+    missing_cols = [col for col in required_cols if col not in data.columns]
+    
+    if missing_cols:
+        raise ValueError(f"Отсутствуют следующие столбцы: {', '.join(missing_cols)}")
+    
+    # Проверка на пустые значения
+    cols_with_na = [col for col in required_cols if data[col].isna().any()]
+    
+    if cols_with_na:
+        warning_msg = f"Внимание: обнаружены пропущенные значения в столбцах: {', '.join(cols_with_na)}"
+        print(warning_msg)
+    
+    # Проверка типа данных в столбце с суммой
+    if not pd.api.types.is_numeric_dtype(data[amount_col]):
+        try:
+            # Пытаемся преобразовать к числовому типу
+            pd.to_numeric(data[amount_col])
+        except:
+            raise ValueError(f"Столбец {amount_col} должен содержать числовые значения")
+    
+    # Проверка наличия отрицательных значений в столбце с суммой
+    if (data[amount_col] < 0).any():
+        print(f"Внимание: обнаружены отрицательные значения в столбце {amount_col}")
+    
+    # Проверка на минимальное количество данных
+    if len(data) < 10:
+        print("Внимание: слишком мало данных для надежного RFM-анализа")
+
+
+def _calculate_rfm_metrics(data: pd.DataFrame, customer_col: str, date_col: str, 
+                          amount_col: str, current_date: dt.datetime, 
+                          business_days_only: bool,
+                          weekmask: str = '1111100',
+                          holidays: Optional[Union[str, List]] = None,
+                          n_jobs: int = 1,
+                          monetary_stats: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """Рассчитывает базовые RFM-метрики."""
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    monetary_stats = _resolve_monetary_stats(monetary_stats)
+    
+    if n_jobs > 1:
+        rfm = _aggregate_metrics_parallel(data, customer_col, date_col, amount_col, n_jobs, monetary_stats)
+    else:
+        rfm = _aggregate_metrics(data, customer_col, date_col, amount_col, monetary_stats)
+    
+    # Расчет Recency векторно по массиву последних дат покупок
+    recency = _calculate_recency(rfm.pop('Last_Purchase'), current_date,
+                                 business_days_only, weekmask, holidays)
+    rfm.insert(0, 'Recency', recency)
+    rfm = rfm.reset_index()
+    
+    return _finalize_rfm_metrics(rfm)
+
+
+# Дополнительные статистики сумм покупок и соответствующие им столбцы результата
+MONETARY_STATS = ('mean', 'median', 'std')
+_MONETARY_STAT_COLUMNS = {'mean': 'Monetary_Mean', 'median': 'Monetary_Median', 'std': 'Monetary_Std'}
+
+
+def _resolve_monetary_stats(monetary_stats: Optional[Iterable[str]]) -> Tuple[str, ...]:
+    """Проверяет набор статистик сумм и возвращает его в порядке MONETARY_STATS."""
+    if monetary_stats is None:
+        return MONETARY_STATS
+    if isinstance(monetary_stats, str):
+        monetary_stats = [monetary_stats]
+    requested = set(monetary_stats)
+    unknown = requested - set(MONETARY_STATS)
+    if unknown:
+        raise ValueError(f"Неподдерживаемые статистики сумм: {', '.join(sorted(unknown))}. "
+                         f"Доступны: {', '.join(MONETARY_STATS)}")
+    return tuple(stat for stat in MONETARY_STATS if stat in requested)
+
+
+def _aggregate_metrics(data: pd.DataFrame, customer_col: str, date_col: str,
+                       amount_col: str, monetary_stats: Tuple[str, ...] = MONETARY_STATS) -> pd.DataFrame:
+    """Агрегирует транзакции по клиентам: дата последней покупки, частота и статистики сумм."""
+    # Расчет всех метрик за один проход groupby.
+    # Используются только встроенные (cython) агрегации, без Python-лямбд на каждого клиента;
+    # статистики, которые не запрошены, не рассчитываются
+    aggregations = {
+        'Last_Purchase': (date_col, 'max'),
+        'Frequency': (date_col, 'size'),
+        'Monetary_Sum': (amount_col, 'sum')
+    }
+    for stat in monetary_stats:
+        aggregations[_MONETARY_STAT_COLUMNS[stat]] = (amount_col, stat)
+    return data.groupby(customer_col).agg(**aggregations)
+
+
+def _aggregate_metrics_parallel(data: pd.DataFrame, customer_col: str, date_col: str,
+                                amount_col: str, n_jobs: int,
+                                monetary_stats: Tuple[str, ...] = MONETARY_STATS) -> pd.DataFrame:
+    """
+    Агрегирует транзакции по клиентам в пуле процессов.
+    
+    Клиенты делятся на n_jobs частей по хешу: числовые идентификаторы хешируются
+    как есть, остальные сначала кодируются целыми числами (pd.factorize без
+    сортировки). Строки один раз упорядочиваются по части (устойчивой поразрядной
+    сортировкой, порядок транзакций клиента сохраняется) и записываются в
+    разделяемую память, так что каждая часть - непрерывный отрезок: процесс
+    получает только его границы и агрегирует своих клиентов, не просматривая
+    чужие строки. Клиенты упорядочиваются после агрегации, по уже сгруппированной
+    таблице. Результат совпадает с _aggregate_metrics.
+    """
+    customers = data[customer_col]
+    if isinstance(customers.dtype, np.dtype) and customers.dtype.kind in 'iuf':
+        keys = customers.to_numpy()
+        labels = None
+        if keys.dtype.kind == 'f':
+            valid = ~np.isnan(keys)
+            # -0.0 и 0.0 - один клиент в groupby, но хешируются по битам по-разному
+            part_of_row = pd.util.hash_array(keys + 0.0) % np.uint64(n_jobs)
+        else:
+            valid = np.ones(len(keys), dtype=bool)
+            part_of_row = pd.util.hash_array(keys) % np.uint64(n_jobs)
+    else:
+        keys, labels = pd.factorize(customers)
+        keys = keys.astype(np.int64, copy=False)
+        valid = keys >= 0
+        part_of_row = keys % n_jobs
+    # Строки без клиента не участвуют в агрегации, как и в groupby:
+    # они попадают в последнюю, необрабатываемую часть
+    part_of_row = np.where(valid, part_of_row, n_jobs).astype(np.min_scalar_type(n_jobs))
+    order = np.argsort(part_of_row, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(part_of_row, minlength=n_jobs + 1))])
+    del part_of_row, valid
+    arrays = {
+        'key': keys,
+        'date': data[date_col].to_numpy(dtype='datetime64[ns]').view(np.int64),
+        'amount': pd.to_numeric(data[amount_col]).to_numpy(dtype=np.float64)
+    }
+    
+    blocks = {}
+    try:
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.take(array, order, out=np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf))
+            blocks[name] = block
+        layout = {name: (blocks[name].name, array.dtype.str) for name, array in arrays.items()}
+        n_rows = len(keys)
+        del arrays, keys, order
+        
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(_aggregate_partition, [layout] * n_jobs, [n_rows] * n_jobs,
+                                      bounds[:n_jobs].tolist(), bounds[1:n_jobs + 1].tolist(),
+                                      [monetary_stats] * n_jobs))
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+    
+    rfm = pd.concat(parts)
+    if labels is not None:
+        rfm.index = labels.take(rfm.index.to_numpy())
+    rfm = rfm.sort_index()
+    rfm.index.name = customer_col
+    return rfm
+
+
+def _aggregate_partition(layout: Dict[str, Tuple[str, str]], n_rows: int,
+                         start: int, stop: int,
+                         monetary_stats: Tuple[str, ...] = MONETARY_STATS) -> pd.DataFrame:
+    """Агрегирует транзакции строк [start, stop) одной части; выполняется в дочернем процессе."""
+    blocks = {name: shared_memory.SharedMemory(name=block_name)
+              for name, (block_name, _) in layout.items()}
+    try:
+        arrays = {name: np.ndarray((n_rows,), dtype=np.dtype(dtype), buffer=blocks[name].buf)
+                  for name, (_, dtype) in layout.items()}
+        # Отрезки - представления разделяемой памяти, поэтому данные копируются до ее закрытия
+        partition = pd.DataFrame({
+            'key': arrays['key'][start:stop],
+            'date': arrays['date'][start:stop].view('datetime64[ns]'),
+            'amount': arrays['amount'][start:stop]
+        }, copy=True)
+        del arrays
+    finally:
+        for block in blocks.values():
+            block.close()
+    
+    return _aggregate_metrics(partition, 'key', 'date', 'amount', monetary_stats)
+
+
+def _finalize_rfm_metrics(rfm: pd.DataFrame) -> pd.DataFrame:
+    """Добавляет основную метрику Monetary и исправляет некорректные значения."""
+    # Основная метрика для Monetary - сумма
+    rfm['Monetary'] = rfm['Monetary_Sum']
+    
+    # Обработка возможных ошибок в данных
+    rfm['Recency'] = rfm['Recency'].clip(lower=0)  # Recency не может быть отрицательным
+    if 'Monetary_Std' in rfm.columns:
+        rfm['Monetary_Std'] = rfm['Monetary_Std'].fillna(0)  # Заполняем NaN в стандартном отклонении
+    
+    return rfm
+
+
+def _calculate_recency(last_purchase: pd.Series, current_date: dt.datetime,
+                       business_days_only: bool, weekmask: str = '1111100',
+                       holidays: Optional[Union[str, List]] = None) -> pd.Series:
+    """Рассчитывает Recency по датам последних покупок клиентов."""
+    if business_days_only:
+        return _business_days_between(last_purchase, current_date, weekmask, holidays)
+    return (current_date - last_purchase).dt.days
+
+
+def _business_days_between(start_dates: pd.Series, end_date: dt.datetime,
+                           weekmask: str = '1111100',
+                           holidays: Optional[Union[str, List]] = None) -> pd.Series:
+    """
+    Считает количество рабочих дней между датами последних покупок и датой анализа.
+    
+    Результат совпадает с pd.bdate_range(start, end).shape[0] - 1 для стандартной
+    рабочей недели, но вычисляется одним вызовом np.busday_count для всего массива.
+    """
+    calendar = np.busdaycalendar(weekmask=weekmask, holidays=_load_holidays(holidays))
+    
+    start = start_dates.to_numpy(dtype='datetime64[D]')
+    end = pd.Timestamp(end_date).to_datetime64().astype('datetime64[D]')
+    valid = ~np.isnat(start)
+    
+    # busday_count считает дни в полуинтервале [start, end), поэтому
+    # добавляем саму дату анализа, если она рабочая, и вычитаем начальный день
+    counts = np.full(len(start), np.nan)
+    counts[valid] = (
+        np.busday_count(start[valid], end, busdaycal=calendar)
+        + np.is_busday(end, busdaycal=calendar) - 1
+    )
+    
+    recency = pd.Series(counts, index=start_dates.index)
+    if valid.all():
+        recency = recency.astype(np.int64)
+    return recency
+
+
+def _load_holidays(holidays: Optional[Union[str, List]]) -> np.ndarray:
+    """Возвращает массив праздничных дней; строка трактуется как путь к файлу календаря."""
+    if holidays is None:
+        return np.array([], dtype='datetime64[D]')
+    if isinstance(holidays, str):
+        return load_holiday_calendar(holidays)
+    return pd.to_datetime(pd.Series(list(holidays))).to_numpy(dtype='datetime64[D]')
+
+
+def load_holiday_calendar(path: str) -> np.ndarray:
+    """
+    Загружает производственный календарь (список нерабочих дней) из локального файла.
+    
+    Файл должен содержать по одной дате в строке (или в первом столбце CSV),
+    строки, начинающиеся с '#', игнорируются. Например, праздничные дни
+    производственного календаря РФ:
+    
+        # Производственный календарь 2025
+        2025-01-01
+        2025-01-02
+        2025-05-09
+    """
+    try:
+        dates = pd.read_csv(path, header=None, usecols=[0], comment='#', skip_blank_lines=True)[0]
+        return np.unique(pd.to_datetime(dates).to_numpy(dtype='datetime64[D]'))
+    except Exception as e:
+        raise ValueError(f"Невозможно загрузить календарь праздников из {path}: {str(e)}")
+
+
+def rfm_analysis_stream(
+    source: Union[str, pd.DataFrame, Iterable[pd.DataFrame]],
+    date_col: str,
+    customer_col: str,
+    amount_col: str,
+    analysis_date: Optional[Union[str, dt.datetime]] = None,
+    n_quantiles: int = 4,
+    ranking_method: str = 'quantile',
+    custom_intervals: Optional[Dict[str, List[float]]] = None,
+    business_days_only: bool = False,
+    segment_mapping: Optional[Union[Dict[str, str], List[Tuple]]] = None,
+    weekmask: str = '1111100',
+    holidays: Optional[Union[str, List]] = None,
+    chunksize: int = 1_000_000,
+    median_sample_size: int = 64,
+    read_csv_kwargs: Optional[Dict] = None,
+    compact_dtypes: Optional[bool] = None,
+    quantile_error: float = 0.01,
+    monetary_stats: Optional[Iterable[str]] = None,
+    progress: Optional[Callable[[int], None]] = None
+) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """
+    Выполняет RFM-анализ потоково, не загружая весь файл транзакций в память.
+    
+    Данные читаются частями, для каждого клиента накапливаются объединяемые
+    частичные агрегаты (дата последней покупки, количество, сумма, сумма квадратов)
+    и выборка сумм для оценки медианы. Затем выполняются те же этапы ранжирования
+    и сегментации, что и в rfm_analysis. Пиковая память пропорциональна числу
+    клиентов и размеру части, а не количеству транзакций.
+    
+    Parameters:
+    -----------
+    source : str, pd.DataFrame or iterable of pd.DataFrame
+        Путь к файлу CSV, Parquet или Arrow IPC (.arrow, .feather), DataFrame
+        или итератор DataFrame с частями транзакций.
+    chunksize : int, default=1_000_000
+        Количество строк CSV, читаемых за один раз (если source - путь к файлу).
+    median_sample_size : int, default=64
+        Максимальное количество сумм, хранимых на клиента для расчета медианы.
+        Для клиентов с небольшим числом покупок медиана точная, иначе
+        оценивается по равномерной выборке.
+    read_csv_kwargs : dict, optional
+        Дополнительные параметры pd.read_csv (encoding, sep и т.д.).
+    monetary_stats : iterable of str, optional
+        Статистики сумм, как в rfm_analysis. Стандартное отклонение объединяется
+        между частями по формуле Уэлфорда-Чана, медиана оценивается по выборке
+        (см. median_sample_size). Для незапрошенных статистик состояние не ведется.
+    progress : callable, optional
+        Вызывается после каждой обработанной части с общим числом уже
+        обработанных транзакций (например, для отображения хода фоновой задачи).
+    
+    Остальные параметры совпадают с rfm_analysis.
+        
+    Returns:
+    --------
+    Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]
+        Кортеж из DataFrame с результатами RFM-анализа и словаря с дополнительной информацией.
+    """
+    current_date = _resolve_analysis_date(analysis_date)
+    state = create_rfm_state(source, date_col, customer_col, amount_col,
+                             chunksize, median_sample_size, read_csv_kwargs, monetary_stats,
+                             progress)
+    
+    return _rfm_from_state(state, current_date, n_quantiles, ranking_method, custom_intervals,
+                           business_days_only, segment_mapping, weekmask, holidays, compact_dtypes,
+                           quantile_error)
+
+
+def create_rfm_state(
+    source: Union[str, pd.DataFrame, Iterable[pd.DataFrame]],
+    date_col: str,
+    customer_col: str,
+    amount_col: str,
+    chunksize: int = 1_000_000,
+    median_sample_size: int = 64,
+    read_csv_kwargs: Optional[Dict] = None,
+    monetary_stats: Optional[Iterable[str]] = None,
+    progress: Optional[Callable[[int], None]] = None
+) -> Dict:
+    """
+    Создает состояние RFM: накопленные агрегаты по каждому клиенту.
+    
+    Состояние хранит дату последней покупки, количество покупок, сумму и сумму
+    квадратов отклонений сумм (для стандартного отклонения), а также выборку сумм
+    для медианы; последние две - только если статистика запрошена в monetary_stats.
+    Его можно сохранить
+    (save_rfm_state) и затем дополнять только новыми транзакциями (update_rfm),
+    не пересчитывая всю историю.
+    
+    Parameters:
+    -----------
+    source : str, pd.DataFrame or iterable of pd.DataFrame
+        Путь к CSV-файлу, DataFrame или итератор DataFrame с транзакциями.
+    
+    Остальные параметры совпадают с rfm_analysis_stream.
+    
+    Returns:
+    --------
+    dict
+        Состояние RFM для update_rfm.
+    """
+    state = {
+        'date_col': date_col,
+        'customer_col': customer_col,
+        'amount_col': amount_col,
+        'median_sample_size': median_sample_size,
+        'monetary_stats': _resolve_monetary_stats(monetary_stats),
+        'n_transactions': 0,
+        'aggregates': None,
+        'median_sample': None,
+        'median_pending': [],
+        'median_overflow': [],
+        'medians': None,
+        'stale_medians': []
+    }
+    
+    for i, chunk in enumerate(_iter_transaction_chunks(source, [date_col, customer_col, amount_col],
+                                                       chunksize, read_csv_kwargs)):
+        if i == 0:
+            _validate_input_data(chunk, date_col, customer_col, amount_col)
+        _fold_transactions(state, chunk)
+        if progress is not None:
+            progress(state['n_transactions'])
+    
+    if state['aggregates'] is None:
+        raise ValueError("Нет данных для RFM-анализа")
+    
+    return state
+
+
+def update_rfm(
+    state: Dict,
+    new_transactions: Union[str, pd.DataFrame, Iterable[pd.DataFrame]],
+    analysis_date: Optional[Union[str, dt.datetime]] = None,
+    n_quantiles: int = 4,
+    ranking_method: str = 'quantile',
+    custom_intervals: Optional[Dict[str, List[float]]] = None,
+    business_days_only: bool = False,
+    segment_mapping: Optional[Union[Dict[str, str], List[Tuple]]] = None,
+    weekmask: str = '1111100',
+    holidays: Optional[Union[str, List]] = None,
+    chunksize: int = 1_000_000,
+    read_csv_kwargs: Optional[Dict] = None,
+    compact_dtypes: Optional[bool] = None,
+    quantile_error: float = 0.01
+) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """
+    Добавляет в состояние RFM новые транзакции и пересчитывает ранги и сегменты.
+    
+    Агрегаты обновляются только для клиентов из новых транзакций (состояние
+    изменяется на месте), поэтому стоимость обновления зависит от объема новых
+    данных, а не от всей истории. Recency, ранги и сегменты затем пересчитываются
+    для всех клиентов, так как они зависят от даты анализа и общего распределения.
+    
+    Parameters:
+    -----------
+    state : dict
+        Состояние, созданное create_rfm_state или загруженное load_rfm_state.
+    new_transactions : str, pd.DataFrame or iterable of pd.DataFrame
+        Новые транзакции в тех же столбцах, что и при создании состояния.
+    
+    Статистики сумм определяются параметром monetary_stats при создании состояния.
+    Остальные параметры совпадают с rfm_analysis_stream.
+        
+    Returns:
+    --------
+    Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]
+        Кортеж из DataFrame с результатами RFM-анализа и словаря с дополнительной информацией.
+    """
+    columns = [state['date_col'], state['customer_col'], state['amount_col']]
+    for chunk in _iter_transaction_chunks(new_transactions, columns, chunksize, read_csv_kwargs):
+        missing_cols = [col for col in columns if col not in chunk.columns]
+        if missing_cols:
+            raise ValueError(f"Отсутствуют следующие столбцы: {', '.join(missing_cols)}")
+        _fold_transactions(state, chunk)
+    
+    current_date = _resolve_analysis_date(analysis_date)
+    return _rfm_from_state(state, current_date, n_quantiles, ranking_method, custom_intervals,
+                           business_days_only, segment_mapping, weekmask, holidays, compact_dtypes,
+                           quantile_error)
+
+
+def save_rfm_state(state: Dict, output_path: str) -> None:
+    """Сохраняет состояние RFM в файл."""
+    pd.to_pickle(state, output_path)
+
+
+def load_rfm_state(input_path: str) -> Dict:
+    """Загружает состояние RFM, сохраненное save_rfm_state."""
+    state = pd.read_pickle(input_path)
+    if not isinstance(state, dict) or 'aggregates' not in state:
+        raise ValueError(f"Файл {input_path} не содержит состояние RFM")
+    # Состояния, сохраненные до появления отложенного отбора выборки
+    state.setdefault('median_pending', [])
+    state.setdefault('median_overflow', [])
+    return state
+
+
+# Разделители, которые распознает sniff_csv_format
+CSV_DELIMITERS = (',', ';', '\t', '|')
+
+
+def sniff_csv_format(path: str, sample_size: int = 1 << 20, probes: int = 8) -> Dict[str, str]:
+    """
+    Определяет кодировку, разделитель и десятичный знак CSV-файла по выборке байтов.
+    
+    Читается начало файла (sample_size байт) и probes блоков по 64 КБ,
+    равномерно распределенных по остальной части файла: ошибка кодировки,
+    встречающаяся только в конце файла, обнаруживается без полного разбора.
+    Файл затем разбирается один раз с найденными параметрами.
+    
+    Кодировка: UTF-8 (с BOM или без), иначе cp1251, если байты старше 0x7F
+    образуют слова и в cp1251 дают в основном кириллицу, иначе latin-1.
+    
+    Parameters:
+    -----------
+    path : str
+        Путь к CSV-файлу.
+    sample_size : int, default=1 МБ
+        Размер читаемого начала файла; по нему же определяется разделитель.
+    probes : int, default=8
+        Количество дополнительных блоков для проверки кодировки.
+        
+    Returns:
+    --------
+    dict
+        Параметры pd.read_csv: encoding, sep и, если в числах используется
+        десятичная запятая (выгрузки Excel с разделителем ';'), decimal.
+    """
+    probe_size = 64 * 1024
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(sample_size)
+        blocks = [head]
+        if file_size > len(head) + probe_size:
+            for position in np.linspace(len(head), file_size - probe_size, probes).astype(np.int64):
+                f.seek(int(position))
+                block = f.read(probe_size)
+                # Блок может начинаться с середины многобайтового символа UTF-8:
+                # пропускаем до трех байтов продолжения
+                start = 0
+                while start < 3 and start < len(block) and 0x80 <= block[start] < 0xC0:
+                    start += 1
+                blocks.append(block[start:])
+    
+    if head.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    else:
+        try:
+            for block in blocks:
+                # Последний символ блока может быть обрезан, поэтому final=False
+                codecs.getincrementaldecoder('utf-8')().decode(block, final=False)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            # Кириллица в cp1251 - слова из байтов старше 0x7F, а в latin-1 такие
+            # байты (é, ü) обычно стоят по одному внутри слов из латинских букв
+            sample = np.frombuffer(b''.join(blocks), dtype=np.uint8)
+            high = sample > 0x7F
+            latin = ((sample | 0x20) >= ord('a')) & ((sample | 0x20) <= ord('z'))
+            next_to_high = np.r_[False, high[:-1]] | np.r_[high[1:], False]
+            next_to_latin = np.r_[False, latin[:-1]] | np.r_[latin[1:], False]
+            inside_latin_words = high & ~next_to_high & next_to_latin
+            high_text = sample[high].tobytes().decode('cp1251', errors='replace')
+            cyrillic = len(re.findall('[\u0400-\u04FF]', high_text))
+            is_cp1251 = cyrillic >= 0.8 * len(high_text) and inside_latin_words.sum() <= 0.5 * high.sum()
+            encoding = 'cp1251' if is_cp1251 else 'latin-1'
+    
+    lines = head.decode(encoding, errors='replace').splitlines()
+    if len(head) == sample_size:
+        # Последняя строка выборки может быть неполной
+        lines = lines[:-1]
+    lines = [line for line in lines[:200] if line.strip()]
+    
+    sep = _sniff_delimiter(lines)
+    read_csv_kwargs = {'encoding': encoding, 'sep': sep}
+    if sep != ',' and _uses_decimal_comma(lines[1:], sep):
+        read_csv_kwargs['decimal'] = ','
+    return read_csv_kwargs
+
+
+def _sniff_delimiter(lines: List[str]) -> str:
+    """
+    Выбирает разделитель, который делит заголовок на несколько полей и дает
+    такое же число полей в наибольшей доле строк (кавычки учитываются).
+    """
+    best, best_score = ',', (0.0, 0)
+    for delimiter in CSV_DELIMITERS:
+        if not lines:
+            break
+        counts = [len(row) for row in csv.reader(lines, delimiter=delimiter)]
+        if counts[0] < 2:
+            continue
+        score = (sum(count == counts[0] for count in counts) / len(counts), counts[0])
+        if score > best_score:
+            best, best_score = delimiter, score
+    return best
+
+
+def _uses_decimal_comma(lines: List[str], sep: str) -> bool:
+    """Проверяет, записаны ли дробные числа с десятичной запятой (1409,44) и ни одно - с точкой."""
+    values = [value.strip() for row in csv.reader(lines, delimiter=sep) for value in row]
+    return (any(re.fullmatch(r'-?\d+,\d+', value) for value in values)
+            and not any(re.fullmatch(r'-?\d+\.\d+', value) for value in values))
+
+
+def _iter_transaction_chunks(source: Union[str, pd.DataFrame, Iterable[pd.DataFrame]],
+                             columns: List[str], chunksize: int,
+                             read_csv_kwargs: Optional[Dict] = None) -> Iterable[pd.DataFrame]:
+    """
+    Возвращает итератор частей транзакций из пути к файлу, DataFrame или итератора DataFrame.
+    
+    Файлы Parquet и Arrow IPC (по расширению) читаются по группам строк только
+    в нужных столбцах, без разбора CSV.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        file_format = _file_format(source)
+        if file_format == 'parquet':
+            parquet = _import_pyarrow('parquet')
+            batches = parquet.ParquetFile(source, memory_map=True).iter_batches(
+                batch_size=chunksize, columns=columns)
+            return (batch.to_pandas() for batch in batches)
+        if file_format == 'arrow':
+            feather = _import_pyarrow('feather')
+            table = feather.read_table(source, columns=columns, memory_map=True)
+            return (batch.to_pandas() for batch in table.to_batches(max_chunksize=chunksize))
+        # Разбираются только столбцы анализа; read_csv_kwargs может переопределить
+        # usecols и задать dtype, чтобы типы не определялись по данным
+        return pd.read_csv(source, chunksize=chunksize, **{'usecols': columns, **(read_csv_kwargs or {})})
+    if isinstance(source, pd.DataFrame):
+        return [source]
+    return source
+
+
+def _fold_transactions(state: Dict, chunk: pd.DataFrame) -> None:
+    """Добавляет часть транзакций в агрегаты и выборку для медианы состояния RFM."""
+    # Ключи выборки зависят от числа уже обработанных транзакций,
+    # поэтому результат воспроизводим при повторном запуске
+    rng = np.random.default_rng(state['n_transactions'])
+    chunk_aggregates, chunk_sample = _partial_rfm_aggregates(
+        chunk, state['date_col'], state['customer_col'], state['amount_col'], rng,
+        state['monetary_stats'])
+    
+    aggregates = _fold_partial_aggregates(state['aggregates'], chunk_aggregates)
+    state['aggregates'] = aggregates
+    if chunk_sample is not None:
+        # Новые суммы откладываются; выборки клиентов, у которых всего сумм стало
+        # больше median_sample_size, отбираются заново при уплотнении
+        counts = aggregates['Amount_Count'].to_numpy()[aggregates.index.get_indexer(chunk_aggregates.index)]
+        state['median_pending'].append(chunk_sample)
+        state['median_overflow'].append(chunk_aggregates.index[counts > state['median_sample_size']])
+        sample_rows = 0 if state['median_sample'] is None else len(state['median_sample'])
+        if sum(len(part) for part in state['median_pending']) >= sample_rows:
+            _compact_median_sample(state)
+        state['stale_medians'].append(chunk_aggregates.index)
+    state['n_transactions'] += len(chunk)
+
+
+def _compact_median_sample(state: Dict) -> None:
+    """
+    Переносит отложенные суммы в выборку для медианы состояния RFM.
+    
+    Уплотнение выполняется, когда отложенных сумм становится не меньше, чем
+    строк в выборке, поэтому каждая сумма в среднем обрабатывается постоянное
+    число раз, а выборка занимает не более чем вдвое больше необходимого.
+    """
+    if not state['median_pending']:
+        return
+    parts = state['median_pending']
+    if state['median_sample'] is not None:
+        parts = [state['median_sample']] + parts
+    overflow = state['median_overflow'][0].append(state['median_overflow'][1:]).unique()
+    state['median_sample'] = _merge_median_samples(parts, overflow, state['median_sample_size'])
+    state['median_pending'] = []
+    state['median_overflow'] = []
+
+
+def _state_medians(state: Dict) -> pd.Series:
+    """Возвращает медианы сумм по клиентам, пересчитывая их только для измененных клиентов."""
+    _compact_median_sample(state)
+    sample = state['median_sample']
+    if state['medians'] is None:
+        state['medians'] = sample.groupby(level=0)['_value'].median()
+    elif state['stale_medians']:
+        stale = state['stale_medians'][0].append(state['stale_medians'][1:]).unique()
+        updated = sample[sample.index.isin(stale)].groupby(level=0)['_value'].median()
+        medians = state['medians'].drop(updated.index, errors='ignore')
+        state['medians'] = pd.concat([medians, updated])
+    state['stale_medians'] = []
+    return state['medians']
+
+
+def _rfm_from_state(state: Dict, current_date: dt.datetime, n_quantiles: int,
+                    ranking_method: str, custom_intervals: Optional[Dict[str, List[float]]],
+                    business_days_only: bool,
+                    segment_mapping: Optional[Union[Dict[str, str], List[Tuple]]],
+                    weekmask: str = '1111100',
+                    holidays: Optional[Union[str, List]] = None,
+                    compact_dtypes: Optional[bool] = None,
+                    quantile_error: float = 0.01) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """Выполняет ранжирование и сегментацию по накопленному состоянию RFM."""
+    medians = _state_medians(state) if 'median' in state['monetary_stats'] else None
+    rfm = _finalize_partial_aggregates(state['aggregates'], medians, state['customer_col'],
+                                       current_date, business_days_only, weekmask, holidays,
+                                       state['monetary_stats'])
+    compact = _use_compact_dtypes(compact_dtypes, len(rfm))
+    rfm, rank_edges = _assign_rfm_ranks(rfm, n_quantiles, ranking_method, custom_intervals, compact,
+                                        quantile_error)
+    rfm = _create_rfm_segments(rfm, segment_mapping, compact)
+    additional_info = _create_additional_info(rfm)
+    additional_info['rank_edges'] = rank_edges
+    
+    return rfm, additional_info
+
+
+# Способ объединения частичных агрегатов по клиенту
+_PARTIAL_AGGREGATIONS = {
+    'Last_Purchase': 'max',
+    'Frequency': 'sum',
+    'Amount_Count': 'sum',
+    'Monetary_Sum': 'sum'
+}
+
+
+def _partial_rfm_aggregates(chunk: pd.DataFrame, date_col: str, customer_col: str,
+                            amount_col: str, rng: np.random.Generator,
+                            monetary_stats: Tuple[str, ...] = MONETARY_STATS
+                            ) -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
+    """
+    Рассчитывает объединяемые частичные агрегаты и выборку для медианы по части транзакций.
+    
+    Monetary_M2 (сумма квадратов отклонений от среднего клиента) рассчитывается,
+    только если запрошено стандартное отклонение, выборка - только если запрошена медиана.
+    """
+    dates = chunk[date_col]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
         try:
-            data_copy[date_col] = pd.to_datetime(data_copy[date_col])
+            dates = pd.to_datetime(dates)
         except Exception as e:
             raise ValueError(f"Невозможно преобразовать столбец {date_col} в формат datetime: {str(e)}")
     
-    # Устанавливаем дату анализа
-    if analysis_date is None:
-        current_date = dt.datetime.now()
-    else:
-        if isinstance(analysis_date, str):
+    amounts = pd.to_numeric(chunk[amount_col]).astype(np.float64)
+    customers = chunk[customer_col]
+    
+    parts = pd.DataFrame({
+        'Last_Purchase': dates.to_numpy(),
+        'Frequency': 1,
+        'Amount_Count': amounts.notna().to_numpy(dtype=np.int64),
+        'Monetary_Sum': amounts.to_numpy()
+    }, index=pd.Index(customers.to_numpy(), name=customer_col))
+    grouped = parts.groupby(level=0)
+    aggregates = grouped.agg(_PARTIAL_AGGREGATIONS)
+    
+    if 'std' in monetary_stats:
+        # Дисперсия внутри части считается в groupby алгоритмом Уэлфорда,
+        # без вычитания больших сумм квадратов
+        variance = grouped['Monetary_Sum'].var(ddof=0)
+        aggregates['Monetary_M2'] = (variance * aggregates['Amount_Count']).fillna(0)
+    
+    if 'median' not in monetary_stats:
+        return aggregates, None
+    
+    # Каждой сумме назначается случайный ключ; хранятся суммы с наименьшими ключами
+    # (bottom-k выборка), что дает равномерную выборку, объединяемую между частями
+    valid = amounts.notna().to_numpy()
+    sample = pd.DataFrame({
+        '_key': rng.random(int(valid.sum()), dtype=np.float32),
+        '_value': amounts.to_numpy()[valid]
+    }, index=pd.Index(customers.to_numpy()[valid], name=customer_col))
+    
+    return aggregates, sample
+
+
+def _fold_partial_aggregates(aggregates: Optional[pd.DataFrame], delta: pd.DataFrame) -> pd.DataFrame:
+    """
+    Добавляет частичные агрегаты новых транзакций к накопленным.
+    
+    Строки клиентов из delta обновляются на месте позиционным присваиванием
+    (поиск по хеш-индексу), поэтому стоимость зависит от размера delta, а не
+    от числа накопленных клиентов. Новые клиенты добавляются в конец таблицы.
+    """
+    if aggregates is None:
+        return delta
+    
+    positions = aggregates.index.get_indexer(delta.index)
+    known = positions >= 0
+    rows = positions[known]
+    
+    if len(rows):
+        current = {column: aggregates[column].to_numpy()[rows] for column in aggregates.columns}
+        update = {column: delta[column].to_numpy()[known] for column in aggregates.columns}
+        merged = {}
+        if 'Monetary_M2' in current:
+            # M2 объединяется по прежним количествам и суммам, так как зависит от прежних средних
+            merged['Monetary_M2'] = _merge_m2(
+                current['Amount_Count'], current['Monetary_Sum'], current['Monetary_M2'],
+                update['Amount_Count'], update['Monetary_Sum'], update['Monetary_M2'])
+        for column, how in _PARTIAL_AGGREGATIONS.items():
+            if how == 'max':
+                merged[column] = np.fmax(current[column], update[column].astype(current[column].dtype))
+            else:
+                merged[column] = current[column] + update[column]
+        for column, values in merged.items():
+            aggregates.iloc[rows, aggregates.columns.get_loc(column)] = values
+    
+    if known.all():
+        return aggregates
+    # Даты новой части приводятся к типу накопленных, чтобы concat не менял тип столбца
+    added = delta[~known].astype(aggregates.dtypes.to_dict())
+    return pd.concat([aggregates, added])
+
+
+def _merge_m2(count_a: np.ndarray, sum_a: np.ndarray, m2_a: np.ndarray,
+              count_b: np.ndarray, sum_b: np.ndarray, m2_b: np.ndarray) -> np.ndarray:
+    """
+    Объединяет суммы квадратов отклонений двух частей (параллельный вариант
+    алгоритма Уэлфорда, формула Чана).
+    """
+    total = count_a + count_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_delta = sum_b / count_b - sum_a / count_a
+        correction = np.where((count_a > 0) & (count_b > 0),
+                              np.square(mean_delta) * count_a * count_b / total, 0.0)
+    return m2_a + m2_b + correction
+
+
+def _merge_median_samples(parts: List[pd.DataFrame], overflow: pd.Index,
+                          sample_size: int) -> pd.DataFrame:
+    """
+    Объединяет выборки сумм, оставляя не более sample_size значений на клиента.
+    
+    overflow - клиенты, у которых общее количество сумм превысило sample_size;
+    пересортировываются только их выборки, остальные строки объединяются как есть.
+    """
+    merged = pd.concat(parts) if len(parts) > 1 else parts[0]
+    if not len(overflow):
+        return merged
+    in_overflow = merged.index.isin(overflow)
+    
+    trimmed = merged[in_overflow].sort_values('_key', kind='stable')
+    trimmed = trimmed[trimmed.groupby(level=0).cumcount().to_numpy() < sample_size]
+    return pd.concat([merged[~in_overflow], trimmed])
+
+
+def _finalize_partial_aggregates(aggregates: pd.DataFrame, medians: Optional[pd.Series],
+                                 customer_col: str, current_date: dt.datetime,
+                                 business_days_only: bool, weekmask: str = '1111100',
+                                 holidays: Optional[Union[str, List]] = None,
+                                 monetary_stats: Tuple[str, ...] = MONETARY_STATS) -> pd.DataFrame:
+    """Преобразует частичные агрегаты в таблицу RFM-метрик того же вида, что и _calculate_rfm_metrics."""
+    # Новые клиенты добавляются в конец агрегатов, а результат упорядочен по клиенту
+    if not aggregates.index.is_monotonic_increasing:
+        aggregates = aggregates.sort_index()
+    
+    count = aggregates['Amount_Count']
+    monetary_sum = aggregates['Monetary_Sum']
+    
+    rfm = pd.DataFrame({
+        'Recency': _calculate_recency(aggregates['Last_Purchase'], current_date,
+                                      business_days_only, weekmask, holidays),
+        'Frequency': aggregates['Frequency'],
+        'Monetary_Sum': monetary_sum
+    })
+    if 'mean' in monetary_stats:
+        rfm['Monetary_Mean'] = monetary_sum / count.where(count > 0)
+    if 'median' in monetary_stats:
+        rfm['Monetary_Median'] = medians.reindex(aggregates.index)
+    if 'std' in monetary_stats:
+        rfm['Monetary_Std'] = np.sqrt(aggregates['Monetary_M2'] / (count - 1).where(count > 1))
+    rfm.index.name = customer_col
+    rfm = rfm.reset_index()
+    
+    return _finalize_rfm_metrics(rfm)
+
+
+# Столбцы метрик, по которым рассчитываются ранги R, F и M
+_RANKED_METRICS = {'R': 'Recency', 'F': 'Frequency', 'M': 'Monetary'}
+
+# Допустимые значения ranking_method
+RANKING_METHODS = ('quantile', 'approx_quantile', 'fixed')
+
+
+def _assign_rfm_ranks(rfm: pd.DataFrame, n_quantiles: int, 
+                     ranking_method: str, custom_intervals: Optional[Dict[str, List[float]]],
+                     compact: bool = False,
+                     quantile_error: float = 0.01) -> Tuple[pd.DataFrame, Dict[str, Dict[str, np.ndarray]]]:
+    """
+    Присваивает ранги для каждой RFM-метрики.
+    
+    Возвращает таблицу с рангами и использованные границы: для каждой метрики
+    'edges' (верхние границы интервалов в единицах метрики) и 'labels' (ранг
+    каждого интервала). Их можно применить к новым клиентам через
+    _apply_rank_edges без повторной сортировки.
+    """
+    # Ранги добавляются на месте в таблицу метрик, без копирования
+    rfm_ranked = rfm
+    
+    # Определяем метрики для ранжирования
+    metrics = {
+        'R': {'column': _RANKED_METRICS['R'], 'ascending': True},  # Для Recency меньшее значение лучше
+        'F': {'column': _RANKED_METRICS['F'], 'ascending': False},  # Для Frequency большее значение лучше
+        'M': {'column': _RANKED_METRICS['M'], 'ascending': False}  # Для Monetary большее значение лучше
+    }
+    
+    # Присваиваем ранги для каждой метрики
+    rank_edges = {}
+    for metric_key, metric_info in metrics.items():
+        column = metric_info['column']
+        ascending = metric_info['ascending']
+        
+        if ranking_method == 'quantile':
+            # Метод квантилей: один проход сортировки на метрику, без повторных попыток
+            ranks, rank_edges[metric_key] = _quantile_ranks(
+                rfm_ranked[column].to_numpy(), n_quantiles, ascending)
+            rfm_ranked[f'{metric_key}_rank'] = ranks
+            continue
+        
+        if ranking_method == 'approx_quantile':
+            # Приближенные квантили по скетчу; точный метод используется,
+            # только если у метрики слишком мало различных значений
+            ranks, rank_edges[metric_key] = _approx_quantile_ranks(
+                rfm_ranked[column].to_numpy(), n_quantiles, ascending, quantile_error)
+            rfm_ranked[f'{metric_key}_rank'] = ranks
+            continue
+        
+        # Границы фиксированных интервалов; если ранги присвоены альтернативным
+        # методом, границы восстанавливаются по наблюдаемым значениям
+        interval_edges = None
+        
+        # Обрабатываем исключения, когда метод фиксированных интервалов не работает
+        try:
+            if ranking_method == 'fixed':
+                # Метод фиксированных интервалов
+                if custom_intervals and metric_key in custom_intervals:
+                    # Используем пользовательские интервалы
+                    intervals = custom_intervals[metric_key]
+                    if not ascending:
+                        intervals = sorted(intervals, reverse=True)
+                    
+                    # Создаем ранги на основе интервалов
+                    rfm_ranked[f'{metric_key}_rank'] = pd.cut(
+                        rfm_ranked[column],
+                        bins=[-float('inf')] + intervals + [float('inf')],
+                        labels=list(range(1, len(intervals) + 2))
+                    )
+                    interval_edges = _interval_rank_edges(intervals)
+                else:
+                    # Используем автоматически рассчитанные интервалы
+                    min_val = rfm_ranked[column].min()
+                    max_val = rfm_ranked[column].max()
+                    step = (max_val - min_val) / n_quantiles
+                    
+                    intervals = [min_val + step * i for i in range(1, n_quantiles)]
+                    if not ascending:
+                        intervals = sorted(intervals, reverse=True)
+                    
+                    rfm_ranked[f'{metric_key}_rank'] = pd.cut(
+                        rfm_ranked[column],
+                        bins=[-float('inf')] + intervals + [float('inf')],
+                        labels=list(range(1, n_quantiles + 1))
+                    )
+                    interval_edges = _interval_rank_edges(intervals)
+            else:
+                raise ValueError(f"Неподдерживаемый метод ранжирования: {ranking_method}")
+                
+        except Exception as e:
+            print(f"Ошибка при ранжировании {column}: {str(e)}. Используем альтернативный метод.")
+            
+            # Альтернативный метод ранжирования
+            if rfm_ranked[column].nunique() <= 1:
+                # Если все значения одинаковые, присваиваем средний ранг
+                rfm_ranked[f'{metric_key}_rank'] = (n_quantiles + 1) // 2
+            else:
+                # Используем ранжирование по порядку
+                ranks = rfm_ranked[column].rank(ascending=ascending, method='dense')
+                max_rank = ranks.max()
+                # Масштабируем ранги к диапазону от 1 до n_quantiles
+                rfm_ranked[f'{metric_key}_rank'] = ((ranks - 1) / (max_rank - 1) * (n_quantiles - 1) + 1).round().astype(int)
+        
+        if interval_edges is None:
+            interval_edges = _rank_edges_from_ranks(
+                rfm_ranked[column].to_numpy(), rfm_ranked[f'{metric_key}_rank'].to_numpy(dtype=np.int64))
+        rank_edges[metric_key] = interval_edges
+    
+    # Преобразуем ранги в целые числа
+    rank_dtype = np.int8 if compact else int
+    for metric_key in metrics.keys():
+        rfm_ranked[f'{metric_key}_rank'] = rfm_ranked[f'{metric_key}_rank'].astype(rank_dtype)
+    
+    # Рассчитываем общий RFM-Score
+    rfm_ranked['RFM_Score'] = rfm_ranked[['R_rank', 'F_rank', 'M_rank']].sum(axis=1)
+    
+    # Создаем RFM-комбинацию (строка из 3 цифр)
+    if compact:
+        rfm_ranked['RFM_Score'] = rfm_ranked['RFM_Score'].astype(np.int16)
+        rfm_ranked['RFM_Segment_Code'] = _packed_segment_codes(rfm_ranked)
+        _downcast_metrics(rfm_ranked)
+    else:
+        rfm_ranked['RFM_Segment_Code'] = (
+            rfm_ranked['R_rank'].astype(str) + 
+            rfm_ranked['F_rank'].astype(str) + 
+            rfm_ranked['M_rank'].astype(str)
+        )
+    
+    return rfm_ranked, rank_edges
+
+
+def _quantile_ranks(values: np.ndarray, n_quantiles: int,
+                    ascending: bool) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Рассчитывает квантильные ранги метрики за один проход без повторных попыток.
+    
+    Результат совпадает с прежней цепочкой pd.qcut -> qcut по rank(method='first')
+    -> плотное ранжирование, но правило выбирается заранее, а не через перехват
+    исключений. В основном случае границы находятся частичной сортировкой
+    (np.quantile), остальные случаи сортируют только уникальные значения.
+    Одинаковые значения при ранжировании по порядку разделяются в порядке
+    следования, как в rank(method='first').
+    """
+    if pd.isna(values).any():
+        raise ValueError("Невозможно ранжировать метрику с пропущенными значениями")
+    
+    n = len(values)
+    fractions = np.linspace(0, 1, n_quantiles + 1)
+    labels = np.arange(1, n_quantiles + 1) if ascending else np.arange(n_quantiles, 0, -1)
+    
+    # Достаточно ли уникальных значений для квантилей: обычно это видно уже
+    # по началу массива, полный подсчет нужен только для метрик с частыми повторами
+    enough_values = (len(np.unique(values[:1024])) >= n_quantiles
+                     or len(pd.unique(values)) >= n_quantiles)
+    if enough_values:
+        # Квантили самих значений (аналог qcut)
+        edges = np.quantile(values, fractions)
+        if len(np.unique(edges)) == len(edges):
+            ranks = labels[np.searchsorted(edges[1:-1], values, side='left')]
+            return ranks, {'edges': edges[1:-1], 'labels': labels}
+    
+    # Остальные правила работают с отсортированными уникальными значениями
+    codes, uniques = pd.factorize(values)
+    n_unique = len(uniques)
+    order = np.argsort(uniques, kind='stable')
+    sorted_uniques = uniques[order]
+    dense = np.empty(n_unique, dtype=np.int64)
+    dense[order] = np.arange(n_unique)
+    dense = dense[codes]
+    
+    if n_unique < n_quantiles and n > 1:
+        # Квантили позиций в отсортированном массиве (аналог qcut по rank(method='first')):
+        # позиция = число меньших значений + номер вхождения среди равных
+        counts = np.bincount(dense, minlength=n_unique)
+        occurrence = pd.Series(dense).groupby(dense).cumcount().to_numpy()
+        positions = (np.cumsum(counts) - counts)[dense] + occurrence + 1
+        
+        all_positions = np.arange(1, n + 1, dtype=np.float64)
+        edges = np.quantile(all_positions, fractions)
+        ranks = labels[np.searchsorted(edges[1:-1], positions, side='left')]
+        sorted_ranks = labels[np.searchsorted(edges[1:-1], all_positions, side='left')]
+        return ranks, _rank_edges_from_sorted(np.repeat(sorted_uniques, counts), sorted_ranks)
+    
+    if n_unique <= 1:
+        # Если все значения одинаковые, присваиваем средний ранг
+        unique_ranks = np.full(n_unique, (n_quantiles + 1) // 2)
+    else:
+        # Совпадающие границы квантилей: плотное ранжирование, масштабированное к 1..n_quantiles
+        dense_ranks = np.arange(1, n_unique + 1) if ascending else np.arange(n_unique, 0, -1)
+        unique_ranks = np.round((dense_ranks - 1) / (n_unique - 1) * (n_quantiles - 1) + 1).astype(np.int64)
+    
+    return unique_ranks[dense], _rank_edges_from_sorted(sorted_uniques, unique_ranks)
+
+
+def _approx_quantile_ranks(values: np.ndarray, n_quantiles: int, ascending: bool,
+                           quantile_error: float = 0.01) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Рассчитывает квантильные ранги по границам, оцененным скетчем.
+    
+    Скетч строится по блокам массива и объединяется тем же способом, что и скетчи
+    частей данных из разных процессов. Если границы совпадают (метрика с частыми
+    повторами), используется точный _quantile_ranks: у таких метрик мало
+    уникальных значений, и точный расчет для них дешев.
+    """
+    if pd.isna(values).any():
+        raise ValueError("Невозможно ранжировать метрику с пропущенными значениями")
+    
+    block_size = 1_000_000
+    sketch = merge_quantile_sketches([
+        build_quantile_sketch(values[start:start + block_size], quantile_error, seed=start)
+        for start in range(0, max(len(values), 1), block_size)
+    ])
+    edges = quantile_sketch_quantiles(sketch, np.linspace(0, 1, n_quantiles + 1))
+    if len(np.unique(edges)) < len(edges) or len(np.unique(sketch['values'])) < n_quantiles:
+        return _quantile_ranks(values, n_quantiles, ascending)
+    
+    labels = np.arange(1, n_quantiles + 1) if ascending else np.arange(n_quantiles, 0, -1)
+    ranks = labels[np.searchsorted(edges[1:-1], values, side='left')]
+    return ranks, {'edges': edges[1:-1], 'labels': labels}
+
+
+def build_quantile_sketch(values: np.ndarray, quantile_error: float = 0.01,
+                          confidence: float = 0.99, seed: Optional[int] = None) -> Dict:
+    """
+    Строит объединяемый скетч для приближенных квантилей.
+    
+    Скетч - равномерная выборка без возвращения (bottom-k: хранятся значения с
+    наименьшими случайными ключами) и количество исходных значений. Размер выборки
+    выбирается по неравенству Дворецкого-Кифера-Вольфовица так, чтобы ошибка ранга
+    любого квантиля не превышала quantile_error с вероятностью confidence.
+    Построение занимает O(размер выборки), а не O(len(values)): ключи выбранных
+    значений генерируются сразу как наименьшие порядковые статистики.
+    
+    Parameters:
+    -----------
+    values : np.ndarray
+        Значения метрики.
+    quantile_error : float, default=0.01
+        Допустимая ошибка ранга квантиля (доля значений).
+    confidence : float, default=0.99
+        Вероятность того, что ошибка не превышает quantile_error.
+    seed : int, optional
+        Инициализация генератора случайных чисел.
+        
+    Returns:
+    --------
+    dict
+        Скетч: 'values', 'keys', 'count' и 'sample_size'.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = int(np.ceil(np.log(2 / (1 - confidence)) / (2 * quantile_error ** 2)))
+    n = len(values)
+    
+    if n <= sample_size:
+        return {'values': np.asarray(values), 'keys': rng.random(n),
+                'count': n, 'sample_size': sample_size}
+    
+    # Наименьшие sample_size из n равномерных ключей: нормированные суммы
+    # экспоненциальных величин, остаток суммы - одна гамма-величина
+    spacings = np.cumsum(rng.exponential(size=sample_size))
+    keys = spacings / (spacings[-1] + rng.gamma(n + 1 - sample_size))
+    positions = rng.choice(n, size=sample_size, replace=False)
+    return {'values': np.asarray(values)[positions], 'keys': keys,
+            'count': n, 'sample_size': sample_size}
+
+
+def merge_quantile_sketches(sketches: List[Dict]) -> Dict:
+    """
+    Объединяет скетчи частей данных (частей файла, процессов) в один.
+    
+    Результат распределен так же, как скетч, построенный по всем данным сразу.
+    """
+    sample_size = min(sketch['sample_size'] for sketch in sketches)
+    values = np.concatenate([sketch['values'] for sketch in sketches])
+    keys = np.concatenate([sketch['keys'] for sketch in sketches])
+    
+    if len(keys) > sample_size:
+        keep = np.argpartition(keys, sample_size - 1)[:sample_size]
+        values, keys = values[keep], keys[keep]
+    
+    return {'values': values, 'keys': keys,
+            'count': sum(sketch['count'] for sketch in sketches), 'sample_size': sample_size}
+
+
+def quantile_sketch_quantiles(sketch: Dict, quantiles: np.ndarray) -> np.ndarray:
+    """Возвращает приближенные квантили по скетчу."""
+    return np.quantile(sketch['values'], quantiles)
+
+
+def _interval_rank_edges(intervals: List[float]) -> Dict[str, np.ndarray]:
+    """
+    Границы рангов для фиксированных интервалов pd.cut: сами границы интервалов,
+    а не наблюдаемые значения, чтобы значения между наблюдаемыми получали тот же
+    ранг, что и в pd.cut (значение, равное границе, относится к нижнему интервалу).
+    """
+    return {
+        'edges': np.asarray(intervals, dtype=float),
+        'labels': np.arange(1, len(intervals) + 2, dtype=np.int64)
+    }
+
+
+def _rank_edges_from_ranks(values: np.ndarray, ranks: np.ndarray) -> Dict[str, np.ndarray]:
+    """Восстанавливает границы интервалов по уже присвоенным рангам."""
+    order = np.argsort(values, kind='stable')
+    return _rank_edges_from_sorted(values[order], ranks[order])
+
+
+def _rank_edges_from_sorted(sorted_values: np.ndarray, sorted_ranks: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Строит границы интервалов по отсортированной метрике и соответствующим рангам.
+    
+    Граница интервала - максимальное значение метрики с данным рангом; значение,
+    равное границе, относится к нижнему интервалу.
+    """
+    changes = np.flatnonzero(sorted_ranks[1:] != sorted_ranks[:-1])
+    return {
+        'edges': sorted_values[changes],
+        'labels': sorted_ranks[np.r_[0, changes + 1]] if len(sorted_ranks) else np.array([], dtype=np.int64)
+    }
+
+
+def _apply_rank_edges(values: np.ndarray, rank_edges: Dict[str, np.ndarray]) -> np.ndarray:
+    """Присваивает ранги по сохраненным границам интервалов (бинарный поиск)."""
+    return rank_edges['labels'][np.searchsorted(rank_edges['edges'], values, side='left')]
+
+
+# Число клиентов, начиная с которого результат по умолчанию хранится в компактных типах
+COMPACT_DTYPES_MIN_CUSTOMERS = 100_000
+
+
+def _use_compact_dtypes(compact_dtypes: Optional[bool], n_customers: int) -> bool:
+    """Определяет, хранить ли результат в компактных типах."""
+    if compact_dtypes is None:
+        return n_customers >= COMPACT_DTYPES_MIN_CUSTOMERS
+    return compact_dtypes
+
+
+def _packed_segment_codes(rfm: pd.DataFrame) -> pd.Categorical:
+    """
+    Строит RFM_Segment_Code как Categorical без построчной конкатенации строк.
+    
+    Тройка рангов упаковывается в одно целое число, которое служит кодом категории
+    среди всех возможных комбинаций '111', '112', ... Значения совпадают со
+    строковым вариантом.
+    """
+    ranks = rfm[['R_rank', 'F_rank', 'M_rank']].to_numpy(dtype=np.int64)
+    base = int(ranks.max()) if len(ranks) else 1
+    if base > 9 or (len(ranks) and ranks.min() < 1):
+        # Многозначные ранги не упаковываются однозначно, оставляем строки
+        return pd.Categorical(rfm['R_rank'].astype(str) + rfm['F_rank'].astype(str) + rfm['M_rank'].astype(str))
+    
+    levels = [str(level) for level in range(1, base + 1)]
+    categories = [r + f + m for r in levels for f in levels for m in levels]
+    codes = ((ranks[:, 0] - 1) * base + (ranks[:, 1] - 1)) * base + (ranks[:, 2] - 1)
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+def _downcast_metrics(rfm: pd.DataFrame) -> None:
+    """Переводит Recency и Frequency в наименьший подходящий целый тип."""
+    for column in ['Recency', 'Frequency']:
+        if pd.api.types.is_integer_dtype(rfm[column]):
+            rfm[column] = pd.to_numeric(rfm[column], downcast='integer')
+
+
+# Стандартные правила сегментации: первое подходящее правило определяет сегмент.
+# Условие - допустимый диапазон рангов (нижняя и верхняя граница включительно, None - без границы)
+DEFAULT_SEGMENT_RULES = [
+    ('Чемпионы', {'R': (3, None), 'F': (3, None), 'M': (3, None)}),
+    ('Лояльные клиенты', {'R': (3, None), 'F': (3, None), 'M': (None, 2)}),
+    ('Потенциально лояльные', {'R': (3, None), 'F': (None, 2), 'M': (3, None)}),
+    ('Новые клиенты', {'R': (3, None), 'F': (None, 2), 'M': (None, 2)}),
+    ('Под угрозой ухода', {'R': (None, 2), 'F': (3, None), 'M': (3, None)}),
+    ('Нельзя потерять', {'R': (None, 2), 'F': (3, None), 'M': (None, 2)}),
+    ('Потерянные', {'R': (None, 2), 'F': (None, 2), 'M': (None, 2)}),
+    ('Крупные покупатели', {'R': (None, 2), 'F': (None, 2), 'M': (3, None)}),
+]
+
+# Описательные сегменты по отдельным рангам: (верхний ранг интервала, название)
+_RANK_SEGMENT_LABELS = {
+    'R': [(2, 'Давно'), (4, 'Недавно'), (5, 'Очень недавно')],
+    'F': [(2, 'Редко'), (4, 'Часто'), (5, 'Очень часто')],
+    'M': [(2, 'Низкая'), (4, 'Высокая'), (5, 'Очень высокая')]
+}
+
+
+def _create_rfm_segments(rfm: pd.DataFrame,
+                         segment_mapping: Optional[Union[Dict[str, str], List[Tuple]]] = None,
+                         compact: bool = False) -> pd.DataFrame:
+    """
+    Создает сегменты клиентов на основе RFM-показателей.
+    
+    Правила сегментации заранее компилируются в таблицу (max_rank+1)^3 от тройки
+    рангов к номеру сегмента (см. compile_segment_table), и каждый клиент
+    получает сегмент одной выборкой по индексу из этой таблицы.
+    """
+    # Сегменты добавляются на месте в таблицу с рангами, без копирования
+    rfm_segmented = rfm
+    ranks = [rfm_segmented[f'{metric_key}_rank'].to_numpy(dtype=np.intp) for metric_key in _RANKED_METRICS]
+    max_rank = max((int(rank.max()) for rank in ranks if len(rank)), default=0)
+    
+    # Описательные сегменты по каждому рангу - только для стандартной сегментации
+    if segment_mapping is None:
+        for metric_key, rank in zip(_RANKED_METRICS, ranks):
+            bounds = _RANK_SEGMENT_LABELS[metric_key]
+            lookup = np.full(max_rank + 1, -1)
+            lower = 0
+            for code, (upper, _) in enumerate(bounds):
+                lookup[lower:upper + 1] = code
+                lower = upper + 1
+            rfm_segmented[f'{metric_key}_Segment'] = pd.Categorical.from_codes(
+                lookup[rank], categories=[label for _, label in bounds], ordered=True)
+    
+    table, labels = compile_segment_table(segment_mapping, max_rank)
+    codes = table[ranks[0], ranks[1], ranks[2]]
+    
+    if compact:
+        # Номер сегмента сразу становится кодом Categorical с фиксированным набором категорий
+        rfm_segmented['Customer_Segment'] = pd.Categorical.from_codes(codes, categories=labels)
+    else:
+        rfm_segmented['Customer_Segment'] = np.array(labels, dtype=object)[codes]
+    
+    return rfm_segmented
+
+
+def compile_segment_table(segment_mapping: Optional[Union[Dict[str, str], List[Tuple]]],
+                          max_rank: int) -> Tuple[np.ndarray, List[str]]:
+    """
+    Компилирует правила сегментации в таблицу поиска по тройке рангов.
+    
+    Parameters:
+    -----------
+    segment_mapping : dict or list, optional
+        Словарь {RFM_Segment_Code: сегмент}, например {'444': 'Лучшие'}, или набор
+        правил - список пар (сегмент, условие), проверяемых по порядку. Условие -
+        словарь диапазонов рангов {'R': (мин, макс), ...} с границами включительно
+        (None - без границы) или функция f(r, f, m), принимающая массивы рангов и
+        возвращающая булев массив. Если None, используются DEFAULT_SEGMENT_RULES.
+        Комбинации, не попавшие ни в одно правило, относятся к сегменту 'Прочие'.
+    max_rank : int
+        Максимальный ранг.
+        
+    Returns:
+    --------
+    Tuple[np.ndarray, List[str]]
+        Таблица номеров сегментов размера (max_rank+1)^3, индексируемая рангами
+        [R, F, M], и названия сегментов по номерам.
+    """
+    r, f, m = np.indices((max_rank + 1,) * 3)
+    
+    if isinstance(segment_mapping, dict):
+        labels = list(dict.fromkeys(list(segment_mapping.values()) + ['Прочие']))
+        label_ids = {label: i for i, label in enumerate(labels)}
+        segment_codes = [f'{rank_r}{rank_f}{rank_m}' for rank_r, rank_f, rank_m in zip(r.ravel(), f.ravel(), m.ravel())]
+        table = np.array([label_ids[segment_mapping.get(code, 'Прочие')] for code in segment_codes])
+        return table.reshape(r.shape), labels
+    
+    rules = DEFAULT_SEGMENT_RULES if segment_mapping is None else segment_mapping
+    labels = list(dict.fromkeys([label for label, _ in rules] + ['Прочие']))
+    label_ids = {label: i for i, label in enumerate(labels)}
+    table = np.full(r.shape, label_ids['Прочие'])
+    assigned = np.zeros(r.shape, dtype=bool)
+    
+    for label, condition in rules:
+        if callable(condition):
+            matches = np.broadcast_to(np.asarray(condition(r, f, m), dtype=bool), r.shape).copy()
+        else:
+            matches = np.ones(r.shape, dtype=bool)
+            for metric_key, (lower, upper) in condition.items():
+                if metric_key not in _RANKED_METRICS:
+                    raise ValueError(f"Неизвестная метрика в правиле сегмента {label}: {metric_key}")
+                rank = {'R': r, 'F': f, 'M': m}[metric_key]
+                if lower is not None:
+                    matches &= rank >= lower
+                if upper is not None:
+                    matches &= rank <= upper
+        
+        # Как в np.select, сегмент определяет первое подходящее правило
+        matches &= ~assigned
+        table[matches] = label_ids[label]
+        assigned |= matches
+    
+    return table, labels
+
+
+def _create_additional_info(rfm: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """Создает дополнительную информацию для анализа."""
+    # Расчет статистики по сегментам
+    segment_stats = rfm.groupby('Customer_Segment', observed=True).agg({
+        'Recency': ['mean', 'median', 'count'],
+        'Frequency': ['mean', 'median', 'sum'],
+        'Monetary': ['mean', 'median', 'sum']
+    })
+    
+    # Переименовываем столбцы
+    segment_stats.columns = [f'{col[0]}_{col[1]}' for col in segment_stats.columns]
+    segment_stats = segment_stats.reset_index()
+    
+    # Расчет распределения по сегментам
+    segment_distribution = rfm['Customer_Segment'].value_counts()
+    # Для Categorical value_counts возвращает и пустые категории
+    segment_distribution = segment_distribution[segment_distribution > 0].reset_index()
+    segment_distribution.columns = ['Customer_Segment', 'Count']
+    segment_distribution['Percentage'] = segment_distribution['Count'] / segment_distribution['Count'].sum() * 100
+    
+    # Возвращаем словарь с дополнительной информацией
+    return {
+        'segment_stats': segment_stats,
+        'segment_distribution': segment_distribution
+    }
+
+
+class RFMModel:
+    """
+    Модель RFM-ранжирования: границы рангов, отображение сегментов и дата анализа.
+    
+    fit рассчитывает RFM-анализ по транзакциям и сохраняет только границы
+    интервалов R/F/M, после чего transform и score присваивают ранги и сегменты
+    новым клиентам бинарным поиском по этим границам, без группировок и
+    пересчета квантилей. Модель сохраняется в небольшой JSON-файл (save/load).
+    
+    Parameters:
+    -----------
+    n_quantiles, ranking_method, custom_intervals, business_days_only,
+    segment_mapping, weekmask, holidays, quantile_error
+        Параметры ранжирования и сегментации, как в rfm_analysis.
+    """
+    
+    def __init__(self, n_quantiles: int = 4, ranking_method: str = 'quantile',
+                 custom_intervals: Optional[Dict[str, List[float]]] = None,
+                 business_days_only: bool = False,
+                 segment_mapping: Optional[Union[Dict[str, str], List[Tuple]]] = None,
+                 weekmask: str = '1111100',
+                 holidays: Optional[Union[str, List]] = None,
+                 quantile_error: float = 0.01):
+        self.n_quantiles = n_quantiles
+        self.ranking_method = ranking_method
+        self.custom_intervals = custom_intervals
+        self.business_days_only = business_days_only
+        self.segment_mapping = segment_mapping
+        self.weekmask = weekmask
+        # Календарь сохраняется вместе с моделью, а не как путь к файлу
+        self.holidays = [str(day) for day in _load_holidays(holidays)]
+        self.quantile_error = quantile_error
+        self.analysis_date = None
+        self.rank_edges = None
+        self.segments = None
+    
+    def fit(self, transactions: pd.DataFrame, date_col: str, customer_col: str, amount_col: str,
+            analysis_date: Optional[Union[str, dt.datetime]] = None, n_jobs: int = 1) -> 'RFMModel':
+        """
+        Рассчитывает границы рангов по транзакциям.
+        
+        Parameters:
+        -----------
+        transactions : pd.DataFrame
+            DataFrame с данными о транзакциях.
+        date_col, customer_col, amount_col, analysis_date, n_jobs
+            Параметры, как в rfm_analysis.
+            
+        Returns:
+        --------
+        RFMModel
+            Обученная модель (self).
+        """
+        self.analysis_date = pd.Timestamp(_resolve_analysis_date(analysis_date))
+        _, additional_info = rfm_analysis(
+            transactions, date_col, customer_col, amount_col,
+            analysis_date=self.analysis_date,
+            n_quantiles=self.n_quantiles,
+            ranking_method=self.ranking_method,
+            custom_intervals=self.custom_intervals,
+            business_days_only=self.business_days_only,
+            segment_mapping=self.segment_mapping,
+            weekmask=self.weekmask,
+            holidays=self.holidays,
+            n_jobs=n_jobs,
+            quantile_error=self.quantile_error,
+            monetary_stats=()
+        )
+        self.rank_edges = additional_info['rank_edges']
+        self.segments = self._segment_table()
+        return self
+    
+    def transform(self, customer_metrics: pd.DataFrame,
+                  analysis_date: Optional[Union[str, dt.datetime]] = None) -> pd.DataFrame:
+        """
+        Присваивает ранги и сегменты клиентам по сохраненным границам.
+        
+        Parameters:
+        -----------
+        customer_metrics : pd.DataFrame
+            Метрики клиентов: Frequency, Monetary (или Monetary_Sum) и Recency.
+            Вместо Recency можно передать Last_Purchase - дату последней покупки,
+            тогда Recency рассчитывается относительно даты анализа модели.
+        analysis_date : str or datetime, optional
+            Дата для расчета Recency по Last_Purchase вместо даты анализа модели.
+            
+        Returns:
+        --------
+        pd.DataFrame
+            Копия customer_metrics с рангами, RFM_Score, RFM_Segment_Code и сегментами,
+            как в результате rfm_analysis.
+        """
+        self._check_fitted()
+        rfm = customer_metrics.copy()
+        
+        if 'Recency' not in rfm.columns:
+            if 'Last_Purchase' not in rfm.columns:
+                raise ValueError("Для расчета рангов нужен столбец Recency или Last_Purchase")
+            current_date = self.analysis_date if analysis_date is None else _resolve_analysis_date(analysis_date)
+            rfm['Recency'] = _calculate_recency(pd.to_datetime(rfm['Last_Purchase']), current_date,
+                                                self.business_days_only, self.weekmask,
+                                                self.holidays).clip(lower=0)
+        if 'Monetary' not in rfm.columns and 'Monetary_Sum' in rfm.columns:
+            rfm['Monetary'] = rfm['Monetary_Sum']
+        
+        missing_cols = [col for col in ['Recency', 'Frequency', 'Monetary'] if col not in rfm.columns]
+        if missing_cols:
+            raise ValueError(f"Отсутствуют следующие столбцы: {', '.join(missing_cols)}")
+        
+        for metric_key, column in _RANKED_METRICS.items():
+            rfm[f'{metric_key}_rank'] = _apply_rank_edges(rfm[column].to_numpy(), self.rank_edges[metric_key])
+        rfm['RFM_Score'] = rfm['R_rank'] + rfm['F_rank'] + rfm['M_rank']
+        rfm['RFM_Segment_Code'] = (
+            rfm['R_rank'].astype(str) + rfm['F_rank'].astype(str) + rfm['M_rank'].astype(str)
+        )
+        return _create_rfm_segments(rfm, self._segment_mapping())
+    
+    def score(self, recency: float, frequency: float, monetary: float) -> Dict[str, Union[int, str]]:
+        """
+        Рассчитывает ранги и сегмент одного клиента без создания DataFrame.
+        
+        Предназначено для онлайн-оценки: три бинарных поиска и поиск в словаре сегментов.
+        """
+        self._check_fitted()
+        ranks = {}
+        for metric_key, value in zip(_RANKED_METRICS, (recency, frequency, monetary)):
+            edges = self.rank_edges[metric_key]
+            ranks[metric_key] = int(edges['labels'][np.searchsorted(edges['edges'], value, side='left')])
+        
+        code = f"{ranks['R']}{ranks['F']}{ranks['M']}"
+        return {
+            'R_rank': ranks['R'],
+            'F_rank': ranks['F'],
+            'M_rank': ranks['M'],
+            'RFM_Score': ranks['R'] + ranks['F'] + ranks['M'],
+            'RFM_Segment_Code': code,
+            'Customer_Segment': self.segments.get(code, 'Прочие')
+        }
+    
+    def save(self, output_path: str) -> None:
+        """Сохраняет модель в JSON-файл."""
+        self._check_fitted()
+        model = {
+            'n_quantiles': self.n_quantiles,
+            'ranking_method': self.ranking_method,
+            'custom_intervals': self.custom_intervals,
+            'business_days_only': self.business_days_only,
+            # Правила сегментации могут содержать функции, поэтому сохраняется
+            # только скомпилированная таблица сегментов
+            'default_segments': self.segment_mapping is None,
+            'weekmask': self.weekmask,
+            'holidays': self.holidays,
+            'quantile_error': self.quantile_error,
+            'analysis_date': self.analysis_date.isoformat(),
+            'rank_edges': {
+                metric_key: {'edges': edges['edges'].tolist(), 'labels': edges['labels'].tolist()}
+                for metric_key, edges in self.rank_edges.items()
+            },
+            'segments': self.segments
+        }
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(model, f, ensure_ascii=False)
+    
+    @classmethod
+    def load(cls, input_path: str) -> 'RFMModel':
+        """Загружает модель, сохраненную методом save."""
+        try:
+            with open(input_path, 'r', encoding='utf-8') as f:
+                model = json.load(f)
+            # Нестандартная сегментация восстанавливается из таблицы как словарь {код: сегмент}
+            default_segments = model.get('default_segments', model.get('segment_mapping') is None)
+            instance = cls(model['n_quantiles'], model['ranking_method'], model['custom_intervals'],
+                           model['business_days_only'], None if default_segments else model['segments'],
+                           model['weekmask'], model['holidays'], model['quantile_error'])
+            instance.analysis_date = pd.Timestamp(model['analysis_date'])
+            instance.rank_edges = {
+                metric_key: {'edges': np.asarray(edges['edges']), 'labels': np.asarray(edges['labels'], dtype=np.int64)}
+                for metric_key, edges in model['rank_edges'].items()
+            }
+            instance.segments = model['segments']
+        except (OSError, ValueError, KeyError) as e:
+            raise ValueError(f"Файл {input_path} не содержит RFM-модель: {str(e)}")
+        return instance
+    
+    def _check_fitted(self) -> None:
+        """Проверяет, что границы рангов уже рассчитаны."""
+        if self.rank_edges is None:
+            raise ValueError("Модель не обучена: сначала вызовите fit")
+    
+    def _segment_mapping(self) -> Optional[Dict[str, str]]:
+        """Сегментация для transform: стандартная или по скомпилированной таблице сегментов."""
+        return None if self.segment_mapping is None else self.segments
+    
+    def _segment_table(self) -> Dict[str, str]:
+        """Сегмент для каждой возможной комбинации рангов."""
+        max_rank = max(int(self.rank_edges[metric_key]['labels'].max()) for metric_key in _RANKED_METRICS)
+        table, labels = compile_segment_table(self.segment_mapping, max_rank)
+        return {
+            f'{rank_r}{rank_f}{rank_m}': labels[table[rank_r, rank_f, rank_m]]
+            for rank_r in range(1, max_rank + 1)
+            for rank_f in range(1, max_rank + 1)
+            for rank_m in range(1, max_rank + 1)
+        }
+
+
+# Форматы файлов результатов по расширению
+RESULT_FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+# Текстовые столбцы результата, которые в колоночных форматах хранятся как категории
+_CATEGORICAL_RESULT_COLUMNS = ['RFM_Segment_Code', 'Customer_Segment', 'R_Segment', 'F_Segment', 'M_Segment']
+
+
+def _file_format(path: Union[str, os.PathLike], file_format: Optional[str] = None) -> str:
+    """Возвращает формат файла: заданный явно или определенный по расширению (по умолчанию CSV)."""
+    if file_format is None:
+        file_format = RESULT_FORMATS.get(os.path.splitext(str(path))[1].lower(), 'csv')
+    if file_format not in set(RESULT_FORMATS.values()):
+        raise ValueError(f"Неподдерживаемый формат файла: {file_format}")
+    return file_format
+
+
+def _import_pyarrow(module: str):
+    """Импортирует модуль pyarrow, необходимый для форматов Parquet и Arrow."""
+    try:
+        if module == 'parquet':
+            import pyarrow.parquet as parquet
+            return parquet
+        if module == 'pyarrow':
+            import pyarrow
+            return pyarrow
+        import pyarrow.feather as feather
+        return feather
+    except ImportError:
+        raise ValueError("Для форматов Parquet и Arrow требуется пакет pyarrow")
+
+
+def save_rfm_results(rfm: pd.DataFrame, output_path: str, format: Optional[str] = None) -> None:
+    """
+    Сохраняет результаты RFM-анализа в файл.
+    
+    Parameters:
+    -----------
+    rfm : pd.DataFrame
+        Результаты RFM-анализа.
+    output_path : str
+        Путь к файлу.
+    format : str, optional
+        'csv', 'parquet' или 'arrow' (Arrow IPC / Feather v2). Если None, формат
+        определяется по расширению output_path (см. RESULT_FORMATS), иначе CSV.
+        В Parquet и Arrow сохраняются типы столбцов, сегменты хранятся как категории.
+        
+    Raises:
+    -------
+    ValueError
+        Если формат не поддерживается или для него не установлен pyarrow.
+    OSError
+        Если файл не удалось записать; частично записанный файл удаляется.
+    """
+    file_format = _file_format(output_path, format)
+    try:
+        if file_format == 'csv':
+            rfm.to_csv(output_path, index=False)
+        else:
+            # Новый DataFrame ссылается на столбцы результата, копируются только
+            # текстовые столбцы, преобразуемые в категории
+            columns = {
+                column: rfm[column].astype('category') if column in _CATEGORICAL_RESULT_COLUMNS else rfm[column]
+                for column in rfm.columns
+            }
+            table = pd.DataFrame(columns, copy=False)
+            if file_format == 'parquet':
+                table.to_parquet(output_path, index=False)
+            else:
+                table.to_feather(output_path)
+        print(f"Результаты успешно сохранены в {output_path}")
+    except Exception as e:
+        print(f"Ошибка при сохранении результатов: {str(e)}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+
+def load_rfm_results(input_path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Загружает результаты RFM-анализа, сохраненные save_rfm_results.
+    
+    Из файлов Parquet и Arrow читаются только указанные столбцы, файл
+    отображается в память (memory map) вместо полного чтения.
+    
+    Parameters:
+    -----------
+    input_path : str
+        Путь к файлу результатов (формат определяется по расширению).
+    columns : list of str, optional
+        Загружаемые столбцы. Если None, загружаются все.
+        
+    Returns:
+    --------
+    pd.DataFrame
+        Результаты RFM-анализа.
+    """
+    file_format = _file_format(input_path)
+    if file_format == 'parquet':
+        _import_pyarrow('parquet')
+        return pd.read_parquet(input_path, columns=columns, memory_map=True)
+    if file_format == 'arrow':
+        feather = _import_pyarrow('feather')
+        return feather.read_table(input_path, columns=columns, memory_map=True).to_pandas()
+    return pd.read_csv(input_path, usecols=columns)
+
+
+# Файл индекса результатов в каталоге результатов: одна JSON-строка на запуск анализа
+RESULTS_MANIFEST_NAME = 'manifest.jsonl'
+
+
+def results_manifest_entry(rfm: pd.DataFrame, result_file: str, source_file: Optional[str] = None,
+                           duration: Optional[float] = None,
+                           created_at: Optional[int] = None,
+                           cache_key: Optional[str] = None) -> Dict:
+    """
+    Формирует запись индекса результатов для одного запуска анализа.
+    
+    Parameters:
+    -----------
+    rfm : pd.DataFrame
+        Результаты RFM-анализа (достаточно столбца Customer_Segment, если
+        columns известны из файла).
+    result_file : str
+        Путь к файлу результатов; в индекс записывается имя файла.
+    source_file : str, optional
+        Исходный файл транзакций.
+    duration : float, optional
+        Длительность анализа в секундах.
+    created_at : int, optional
+        Время запуска (Unix timestamp). Если None, берется из имени файла
+        rfm_results_<timestamp>, иначе из времени изменения файла.
+    cache_key : str, optional
+        Ключ исходных данных и параметров анализа, по которому повторный
+        запуск с теми же данными находит готовый результат.
+        
+    Returns:
+    --------
+    dict
+        Запись индекса: файл, время, число клиентов, распределение по сегментам,
+        столбцы, исходный файл, длительность и ключ кэша.
+    """
+    if created_at is None:
+        stem = os.path.splitext(os.path.basename(result_file))[0]
+        suffix = stem.rsplit('_', 1)[-1]
+        created_at = int(suffix) if suffix.isdigit() else int(os.path.getmtime(result_file))
+    
+    segments = rfm['Customer_Segment'].value_counts()
+    return {
+        'result_file': os.path.basename(result_file),
+        'created_at': created_at,
+        'records': len(rfm),
+        'segments': {str(label): int(count) for label, count in segments[segments > 0].items()},
+        'columns': [str(column) for column in rfm.columns],
+        'source_file': source_file,
+        'duration': None if duration is None else round(duration, 3),
+        'cache_key': cache_key
+    }
+
+
+def append_results_manifest(results_dir: str, entry: Dict) -> None:
+    """Добавляет запись в индекс результатов (manifest.jsonl) каталога results_dir."""
+    with open(os.path.join(results_dir, RESULTS_MANIFEST_NAME), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def read_results_manifest(results_dir: str) -> List[Dict]:
+    """Читает индекс результатов; поврежденные строки (например, недописанная последняя) пропускаются."""
+    entries = []
+    try:
+        with open(os.path.join(results_dir, RESULTS_MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def rebuild_results_manifest(results_dir: str) -> int:
+    """
+    Заново строит индекс результатов по файлам rfm_results_* в каталоге.
+    
+    Из каждого файла читается только столбец Customer_Segment и список столбцов.
+    Исходный файл и длительность для существующих результатов неизвестны.
+    Индекс записывается во временный файл и затем заменяет прежний.
+    
+    Returns:
+    --------
+    int
+        Количество записей в новом индексе.
+    """
+    files = sorted(
+        (f for f in os.listdir(results_dir)
+         if f.startswith('rfm_results_') and os.path.splitext(f)[1].lower() in RESULT_FORMATS),
+        key=lambda f: os.path.getmtime(os.path.join(results_dir, f))
+    )
+    
+    manifest_path = os.path.join(results_dir, RESULTS_MANIFEST_NAME)
+    count = 0
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        for filename in files:
+            file_path = os.path.join(results_dir, filename)
             try:
-                current_date = pd.to_datetime(analysis_date)
+                rfm = load_rfm_results(file_path, columns=['Customer_Segment'])
+                entry = results_manifest_entry(rfm, file_path)
+                entry['columns'] = _result_columns(file_path)
             except Exception as e:
-                raise ValueError(f"Невозможно преобразовать analysis_date в формат datetime: {str(e)}")
-        else:
-            current_date = analysis_date
-    
-    # Рассчитываем метрики RFM
-    rfm = _calculate_rfm_metrics(data_copy, customer_col, date_col, amount_col, current_date, business_days_only)
+                print(f"Ошибка при чтении файла {filename}: {str(e)}")
+                continue
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            count += 1
+    os.replace(manifest_path + '.tmp', manifest_path)
     
-    # Присваиваем ранги для каждой метрики
-    rfm = _assign_rfm_ranks(rfm, n_quantiles, ranking_method, custom_intervals)
+    return count
+
+
+def prune_results_manifest(results_dir: str) -> int:
+    """
+    Удаляет из индекса результатов записи об уже удаленных файлах.
     
-    # Создаем RFM-сегменты
-    rfm = _create_rfm_segments(rfm, segment_mapping)
+    Остальные записи (с исходным файлом, длительностью и ключом кэша)
+    сохраняются как есть; индекс заменяется через временный файл.
     
-    # Создаем дополнительную информацию для анализа
-    additional_info = _create_additional_info(rfm)
+    Returns:
+    --------
+    int
+        Количество удаленных записей.
+    """
+    entries = read_results_manifest(results_dir)
+    kept = [entry for entry in entries
+            if os.path.exists(os.path.join(results_dir, entry.get('result_file', '')))]
+    if len(kept) == len(entries):
+        return 0
     
-    return rfm, additional_info
+    manifest_path = os.path.join(results_dir, RESULTS_MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        for entry in kept:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return len(entries) - len(kept)
 
 
-def _validate_input_data(data: pd.DataFrame, date_col: str, customer_col: str, amount_col: str) -> None:
-    """Проверяет входные данные на корректность."""
-    # Проверка наличия необходимых столбцов
-    required_cols = [date_col, customer_col, amount_col]
-    missing_cols = [col for col in required_cols if col not in data.columns]
+def _result_columns(input_path: str) -> List[str]:
+    """Возвращает список столбцов файла результатов без чтения данных."""
+    file_format = _file_format(input_path)
+    if file_format == 'parquet':
+        return list(_import_pyarrow('parquet').read_schema(input_path).names)
+    if file_format == 'arrow':
+        return list(_import_pyarrow('feather').read_table(input_path, memory_map=True).schema.names)
+    return list(pd.read_csv(input_path, nrows=0).columns)
+
+
+# Сводные агрегаты хранятся рядом с файлом результатов: rfm_results_<timestamp>.aggregates.json
+RESULTS_AGGREGATES_SUFFIX = '.aggregates.json'
+
+# Столбцы результата, по которым строятся сводные агрегаты
+AGGREGATE_COLUMNS = ['Recency', 'Frequency', 'Monetary', 'R_rank', 'F_rank', 'M_rank',
+                     'RFM_Score', 'Customer_Segment']
+
+
+def rfm_aggregates(rfm: pd.DataFrame, histogram_bins: int = 20,
+                   histogram_quantile: float = 0.99) -> Dict:
+    """
+    Рассчитывает компактные сводные агрегаты результата для графиков дашборда.
     
-    if missing_cols:
-        raise ValueError(f"Отсутствуют следующие столбцы: {', '.join(missing_cols)}")
+    Размер агрегатов не зависит от числа клиентов, поэтому их можно отдавать
+    целиком вместо таблицы клиентов.
     
-    # Проверка на пустые значения
-    na_counts = data[required_cols].isna().sum()
-    cols_with_na = [col for col, count in na_counts.items() if count > 0]
+    Parameters:
+    -----------
+    rfm : pd.DataFrame
+        Результаты RFM-анализа (достаточно столбцов AGGREGATE_COLUMNS).
+    histogram_bins : int, default=20
+        Количество интервалов гистограмм Recency, Frequency и Monetary.
+    histogram_quantile : float, default=0.99
+        Гистограмма строится от минимума до этого квантиля, значения выше
+        относятся к последнему интервалу (длинный хвост Monetary не сжимает
+        остальные интервалы в один).
+        
+    Returns:
+    --------
+    dict
+        summary - общие показатели;
+        segments - по каждому сегменту: count, share (%), revenue и средние
+        Recency, Frequency, Monetary, RFM_Score;
+        rank_cube - shape [R, F, M] и counts[r-1][f-1][m-1] - число клиентов
+        с рангами (r, f, m);
+        histograms - по каждой метрике edges (histogram_bins + 1 границ) и counts;
+        scores - распределения RFM_Score и рангов R, F, M.
+    """
+    n_customers = len(rfm)
+    monetary = rfm['Monetary'].to_numpy(dtype=float)
+    frequency = rfm['Frequency'].to_numpy(dtype=float)
     
-    if cols_with_na:
-        warning_msg = f"Внимание: обнаружены пропущенные значения в столбцах: {', '.join(cols_with_na)}"
-        print(warning_msg)
+    if 'Monetary_Mean' in rfm.columns:
+        # Средний чек, усредненный по клиентам; клиенты без единой суммы (NaN) пропускаются
+        avg_monetary = rfm['Monetary_Mean'].mean()
+    else:
+        # Без Monetary_Mean (сокращенный набор monetary_stats) - среднее по клиентам
+        # Monetary / Frequency. Frequency учитывает и транзакции без суммы, поэтому
+        # при пропусках в суммах значение меньше среднего Monetary_Mean
+        avg_monetary = (monetary / frequency).mean() if n_customers else 0.0
     
-    # Проверка типа данных в столбце с суммой
-    if not pd.api.types.is_numeric_dtype(data[amount_col]):
-        try:
-            # Пытаемся преобразовать к числовому типу
-            pd.to_numeric(data[amount_col])
-        except:
-            raise ValueError(f"Столбец {amount_col} должен содержать числовые значения")
+    summary = {
+        'total_customers': n_customers,
+        'total_revenue': float(monetary.sum()),
+        'avg_recency': float(rfm['Recency'].mean()) if n_customers else 0.0,
+        'avg_frequency': float(frequency.mean()) if n_customers else 0.0,
+        'avg_monetary': 0.0 if pd.isna(avg_monetary) else float(avg_monetary)
+    }
     
-    # Проверка наличия отрицательных значений в столбце с суммой
-    if (data[amount_col] < 0).any():
-        print(f"Внимание: обнаружены отрицательные значения в столбце {amount_col}")
+    grouped = rfm.groupby('Customer_Segment', observed=True).agg(
+        count=('Monetary', 'size'),
+        revenue=('Monetary', 'sum'),
+        avg_recency=('Recency', 'mean'),
+        avg_frequency=('Frequency', 'mean'),
+        avg_monetary=('Monetary', 'mean'),
+        avg_score=('RFM_Score', 'mean')
+    ).sort_values('count', ascending=False)
+    segments = {
+        str(label): {
+            'count': int(row['count']),
+            'share': float(row['count'] / n_customers * 100),
+            'revenue': float(row['revenue']),
+            'avg_recency': float(row['avg_recency']),
+            'avg_frequency': float(row['avg_frequency']),
+            'avg_monetary': float(row['avg_monetary']),
+            'avg_score': float(row['avg_score'])
+        }
+        for label, row in grouped.iterrows()
+    }
     
-    # Проверка на минимальное количество данных
-    if len(data) < 10:
-        print("Внимание: слишком мало данных для надежного RFM-анализа")
-
-
-def _calculate_rfm_metrics(data: pd.DataFrame, customer_col: str, date_col: str, 
-                          amount_col: str, current_date: dt.datetime, 
-                          business_days_only: bool) -> pd.DataFrame:
-    """Рассчитывает базовые RFM-метрики."""
-    # Расчет Recency
-    if business_days_only:
-        # Получаем максимальную дату для каждого клиента
-        max_dates = data.groupby(customer_col)[date_col].max().reset_index()
-        # Расчет рабочих дней между максимальной датой и текущей датой
-        recency = max_dates.apply(
-            lambda row: pd.bdate_range(start=row[date_col], end=current_date).shape[0] - 1, 
-            axis=1
-        )
-        recency_df = pd.DataFrame({
-            customer_col: max_dates[customer_col],
-            'Recency': recency
-        })
-        
-        # Объединяем с другими метриками
-        rfm = data.groupby(customer_col).agg({
-            customer_col: 'count',                             # Frequency
-            amount_col: ['sum', 'mean', 'median', 'std']       # Monetary metrics
-        })
-        
-        # Переименовываем столбцы
-        rfm.columns = ['Frequency', 'Monetary_Sum', 'Monetary_Mean', 'Monetary_Median', 'Monetary_Std']
-        rfm = rfm.reset_index()
-        
-        # Объединяем с Recency
-        rfm = pd.merge(recency_df, rfm, on=customer_col)
-        
+    # Куб рангов: один bincount по линейному индексу (r, f, m)
+    ranks = [rfm[f'{metric_key}_rank'].to_numpy(dtype=np.int64) for metric_key in _RANKED_METRICS]
+    shape = tuple(int(rank.max()) if n_customers else 0 for rank in ranks)
+    if n_customers:
+        flat_index = np.ravel_multi_index(tuple(rank - 1 for rank in ranks), shape)
+        cube = np.bincount(flat_index, minlength=int(np.prod(shape))).reshape(shape)
     else:
-        # Стандартный расчет всех метрик
-        rfm = data.groupby(customer_col).agg({
-            date_col: lambda x: (current_date - x.max()).days,  # Recency
-            customer_col: 'count',                             # Frequency
-            amount_col: ['sum', 'mean', 'median', 'std']       # Monetary metrics
-        })
-        
-        # Переименовываем столбцы
-        rfm.columns = ['Recency', 'Frequency', 'Monetary_Sum', 'Monetary_Mean', 'Monetary_Median', 'Monetary_Std']
-        rfm = rfm.reset_index()
+        cube = np.zeros(shape, dtype=np.int64)
     
-    # Основная метрика для Monetary - сумма
-    rfm['Monetary'] = rfm['Monetary_Sum']
+    histograms = {}
+    for column in _RANKED_METRICS.values():
+        values = rfm[column].to_numpy(dtype=float)
+        if n_customers:
+            low, high = float(values.min()), float(np.quantile(values, histogram_quantile))
+            if high <= low:
+                high = low + 1
+            counts, edges = np.histogram(np.clip(values, low, high), bins=histogram_bins, range=(low, high))
+        else:
+            counts, edges = np.zeros(histogram_bins, dtype=np.int64), np.linspace(0, 1, histogram_bins + 1)
+        histograms[column] = {
+            'edges': edges.tolist(),
+            'counts': counts.tolist(),
+            'max': float(values.max()) if n_customers else 0.0
+        }
     
-    # Обработка возможных ошибок в данных
-    rfm['Recency'] = rfm['Recency'].clip(lower=0)  # Recency не может быть отрицательным
-    rfm['Monetary_Std'] = rfm['Monetary_Std'].fillna(0)  # Заполняем NaN в стандартном отклонении
+    scores = {
+        column: {str(value): int(count) for value, count in rfm[column].value_counts().sort_index().items()}
+        for column in ['RFM_Score', 'R_rank', 'F_rank', 'M_rank']
+    }
     
-    return rfm
+    return {
+        'summary': summary,
+        'segments': segments,
+        'rank_cube': {'shape': list(shape), 'counts': cube.tolist()},
+        'histograms': histograms,
+        'scores': scores
+    }
 
 
-def _assign_rfm_ranks(rfm: pd.DataFrame, n_quantiles: int, 
-                     ranking_method: str, custom_intervals: Optional[Dict[str, List[float]]]) -> pd.DataFrame:
-    """Присваивает ранги для каждой RFM-метрики."""
-    # Создаем копию DataFrame для работы
-    rfm_ranked = rfm.copy()
+def rfm_aggregates_path(result_file: str) -> str:
+    """Возвращает путь к файлу сводных агрегатов для файла результатов."""
+    return os.path.splitext(result_file)[0] + RESULTS_AGGREGATES_SUFFIX
+
+
+def save_rfm_aggregates(aggregates: Dict, result_file: str) -> str:
+    """
+    Сохраняет сводные агрегаты рядом с файлом результатов.
     
-    # Определяем метрики для ранжирования
-    metrics = {
-        'R': {'column': 'Recency', 'ascending': True},  # Для Recency меньшее значение лучше
-        'F': {'column': 'Frequency', 'ascending': False},  # Для Frequency большее значение лучше
-        'M': {'column': 'Monetary', 'ascending': False}  # Для Monetary большее значение лучше
-    }
+    Файл записывается во временный и затем заменяет прежний, поэтому
+    читатели не видят недописанный JSON.
     
-    # Присваиваем ранги для каждой метрики
-    for metric_key, metric_info in metrics.items():
-        column = metric_info['column']
-        ascending = metric_info['ascending']
+    Returns:
+    --------
+    str
+        Путь к файлу агрегатов.
+    """
+    output_path = rfm_aggregates_path(result_file)
+    with open(output_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(aggregates, f, ensure_ascii=False)
+    os.replace(output_path + '.tmp', output_path)
+    return output_path
+
+
+def load_rfm_aggregates(result_file: str) -> Optional[Dict]:
+    """Загружает сводные агрегаты файла результатов или возвращает None, если их нет."""
+    try:
+        with open(rfm_aggregates_path(result_file), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Режимы прореживания диаграммы Frequency vs Monetary: выборка клиентов или сетка плотности
+SCATTER_MODES = ('sample', 'density')
+
+
+def rfm_sample_positions(rfm: pd.DataFrame, max_points: int, stratify_by: str = 'Customer_Segment',
+                         min_share: float = 0.02, random_state: int = 0) -> np.ndarray:
+    """
+    Выбирает не больше max_points клиентов, сохраняя состав сегментов.
+    
+    Каждый сегмент получает часть выборки, пропорциональную его размеру, но не
+    меньше min_share от max_points (и не больше числа его клиентов), чтобы
+    малые сегменты оставались видны на графике. При одном random_state
+    выборка одна и та же.
+    
+    Parameters:
+    -----------
+    rfm : pd.DataFrame
+        Результаты RFM-анализа.
+    max_points : int
+        Максимальный размер выборки.
+    stratify_by : str, default='Customer_Segment'
+        Столбец, по значениям которого стратифицируется выборка.
+    min_share : float, default=0.02
+        Минимальная доля выборки на один сегмент.
+    random_state : int, default=0
+        Начальное значение генератора случайных чисел.
         
-        # Обрабатываем исключения, когда квантильный метод не работает
-        try:
-            if ranking_method == 'quantile':
-                # Метод квантилей
-                labels = list(range(1, n_quantiles + 1))
-                if not ascending:
-                    labels = list(reversed(labels))
-                    
-                # Обработка случаев с одинаковыми значениями
-                if rfm_ranked[column].nunique() < n_quantiles:
-                    print(f"Предупреждение: в {column} меньше уникальных значений, чем требуемое количество квантилей ({n_quantiles}). "
-                          f"Используем альтернативный метод ранжирования.")
-                    rfm_ranked[f'{metric_key}_rank'] = pd.qcut(
-                        rfm_ranked[column].rank(method='first'), 
-                        q=n_quantiles, 
-                        labels=labels,
-                        duplicates='drop'
-                    )
-                else:
-                    rfm_ranked[f'{metric_key}_rank'] = pd.qcut(
-                        rfm_ranked[column], 
-                        q=n_quantiles, 
-                        labels=labels,
-                        duplicates='drop'
-                    )
-                
-            elif ranking_method == 'fixed':
-                # Метод фиксированных интервалов
-                if custom_intervals and metric_key in custom_intervals:
-                    # Используем пользовательские интервалы
-                    intervals = custom_intervals[metric_key]
-                    if not ascending:
-                        intervals = sorted(intervals, reverse=True)
-                    
-                    # Создаем ранги на основе интервалов
-                    rfm_ranked[f'{metric_key}_rank'] = pd.cut(
-                        rfm_ranked[column],
-                        bins=[-float('inf')] + intervals + [float('inf')],
-                        labels=list(range(1, len(intervals) + 2))
-                    )
-                else:
-                    # Используем автоматически рассчитанные интервалы
-                    min_val = rfm_ranked[column].min()
-                    max_val = rfm_ranked[column].max()
-                    step = (max_val - min_val) / n_quantiles
-                    
-                    intervals = [min_val + step * i for i in range(1, n_quantiles)]
-                    if not ascending:
-                        intervals = sorted(intervals, reverse=True)
-                    
-                    rfm_ranked[f'{metric_key}_rank'] = pd.cut(
-                        rfm_ranked[column],
-                        bins=[-float('inf')] + intervals + [float('inf')],
-                        labels=list(range(1, n_quantiles + 1))
-                    )
-            else:
-                raise ValueError(f"Неподдерживаемый метод ранжирования: {ranking_method}")
-                
-        except Exception as e:
-            print(f"Ошибка при ранжировании {column}: {str(e)}. Используем альтернативный метод.")
-            
-            # Альтернативный метод ранжирования
-            if rfm_ranked[column].nunique() <= 1:
-                # Если все значения одинаковые, присваиваем средний ранг
-                rfm_ranked[f'{metric_key}_rank'] = (n_quantiles + 1) // 2
-            else:
-                # Используем ранжирование по порядку
-                ranks = rfm_ranked[column].rank(ascending=ascending, method='dense')
-                max_rank = ranks.max()
-                # Масштабируем ранги к диапазону от 1 до n_quantiles
-                rfm_ranked[f'{metric_key}_rank'] = ((ranks - 1) / (max_rank - 1) * (n_quantiles - 1) + 1).round().astype(int)
+    Returns:
+    --------
+    np.ndarray
+        Позиции выбранных строк в порядке возрастания.
+    """
+    n_customers = len(rfm)
+    if n_customers <= max_points:
+        return np.arange(n_customers)
     
-    # Преобразуем ранги в целые числа
-    for metric_key in metrics.keys():
-        rfm_ranked[f'{metric_key}_rank'] = rfm_ranked[f'{metric_key}_rank'].astype(int)
+    groups = list(rfm.groupby(stratify_by, observed=True).indices.values())
+    sizes = np.array([len(positions) for positions in groups], dtype=np.int64)
+    floor = min(int(max_points * min_share), max_points // len(groups))
+    quotas = np.minimum(sizes, np.maximum(floor, max_points * sizes // n_customers))
+    # Излишек из-за минимальной доли малых сегментов снимается с самого крупного
+    largest = np.argmax(quotas)
+    quotas[largest] = max(quotas[largest] - max(quotas.sum() - max_points, 0), 0)
     
-    # Рассчитываем общий RFM-Score
-    rfm_ranked['RFM_Score'] = rfm_ranked[['R_rank', 'F_rank', 'M_rank']].sum(axis=1)
+    rng = np.random.default_rng(random_state)
+    sample = np.concatenate([
+        rng.choice(positions, quota, replace=False) for positions, quota in zip(groups, quotas)
+    ])
+    return np.sort(sample)
+
+
+def rfm_density_grid(rfm: pd.DataFrame, bins: int = 50, x: str = 'Frequency', y: str = 'Monetary',
+                     value: str = 'Recency', quantile: float = 0.99) -> Dict:
+    """
+    Сводит клиентов в сетку bins x bins по двум метрикам со средним третьей в каждой ячейке.
     
-    # Создаем RFM-комбинацию (строка из 3 цифр)
-    rfm_ranked['RFM_Segment_Code'] = (
-        rfm_ranked['R_rank'].astype(str) + 
-        rfm_ranked['F_rank'].astype(str) + 
-        rfm_ranked['M_rank'].astype(str)
-    )
+    Размер сетки не зависит от числа клиентов. Как и гистограммы rfm_aggregates,
+    оси строятся от минимума до квантиля quantile, значения выше попадают
+    в крайние ячейки.
+    
+    Returns:
+    --------
+    dict
+        x, y, value - имена метрик; x_edges, y_edges - границы ячеек (bins + 1);
+        counts[i][j] - число клиентов в ячейке (x_edges[i], y_edges[j]);
+        mean[i][j] - среднее value в ячейке или None для пустой ячейки.
+    """
+    n_customers = len(rfm)
+    cells, edges = [], []
+    for column in (x, y):
+        values = rfm[column].to_numpy(dtype=float)
+        low, high = (float(values.min()), float(np.quantile(values, quantile))) if n_customers else (0.0, 1.0)
+        if high <= low:
+            high = low + 1
+        cells.append(np.clip(((values - low) / (high - low) * bins).astype(np.int64), 0, bins - 1))
+        edges.append(np.linspace(low, high, bins + 1))
     
-    return rfm_ranked
+    # Один bincount по линейному индексу ячейки для числа клиентов и суммы value
+    flat_index = cells[0] * bins + cells[1]
+    counts = np.bincount(flat_index, minlength=bins * bins).reshape(bins, bins)
+    totals = np.bincount(flat_index, weights=rfm[value].to_numpy(dtype=float),
+                         minlength=bins * bins).reshape(bins, bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = totals / counts
+    
+    return {
+        'x': x,
+        'y': y,
+        'value': value,
+        'x_edges': edges[0].tolist(),
+        'y_edges': edges[1].tolist(),
+        'counts': counts.tolist(),
+        'mean': [[None if np.isnan(cell) else float(cell) for cell in row] for row in mean]
+    }
+
 
+# Раскладки JSON для выгрузки результатов: список объектов по клиентам
+# или по одному массиву значений на столбец
+JSON_LAYOUTS = ('records', 'columns')
 
-def _create_rfm_segments(rfm: pd.DataFrame, segment_mapping: Optional[Dict[str, str]] = None) -> pd.DataFrame:
-    """Создает сегменты клиентов на основе RFM-показателей."""
-    # Создаем копию DataFrame
-    rfm_segmented = rfm.copy()
+
+def iter_rfm_json(rfm: pd.DataFrame, positions: Optional[np.ndarray] = None,
+                  columns: Optional[List[str]] = None, layout: str = 'records',
+                  envelope: Optional[Dict] = None, key: str = 'customers',
+                  batch_size: int = 20000) -> Iterator[bytes]:
+    """
+    Кодирует строки результатов в JSON по частям, не собирая весь ответ в памяти.
     
-    # Определяем сегменты на основе RFM-рангов, если не предоставлено пользовательское отображение
-    if segment_mapping is None:
-        # Создаем значения для сегментации
-        rfm_segmented['R_Segment'] = pd.cut(
-            rfm_segmented['R_rank'],
-            bins=[0, 2, 4, 5],
-            labels=['Давно', 'Недавно', 'Очень недавно'],
-            include_lowest=True
-        )
-        
-        rfm_segmented['F_Segment'] = pd.cut(
-            rfm_segmented['F_rank'],
-            bins=[0, 2, 4, 5],
-            labels=['Редко', 'Часто', 'Очень часто'],
-            include_lowest=True
-        )
-        
-        rfm_segmented['M_Segment'] = pd.cut(
-            rfm_segmented['M_rank'],
-            bins=[0, 2, 4, 5],
-            labels=['Низкая', 'Высокая', 'Очень высокая'],
-            include_lowest=True
-        )
-        
-        # Определяем основные сегменты клиентов
-        conditions = [
-            # Champions
-            ((rfm_segmented['R_rank'] >= 3) & (rfm_segmented['F_rank'] >= 3) & (rfm_segmented['M_rank'] >= 3)),
-            # Loyal Customers
-            ((rfm_segmented['R_rank'] >= 3) & (rfm_segmented['F_rank'] >= 3) & (rfm_segmented['M_rank'] < 3)),
-            # Potential Loyalists
-            ((rfm_segmented['R_rank'] >= 3) & (rfm_segmented['F_rank'] < 3) & (rfm_segmented['M_rank'] >= 3)),
-            # New Customers
-            ((rfm_segmented['R_rank'] >= 3) & (rfm_segmented['F_rank'] < 3) & (rfm_segmented['M_rank'] < 3)),
-            # At Risk
-            ((rfm_segmented['R_rank'] < 3) & (rfm_segmented['F_rank'] >= 3) & (rfm_segmented['M_rank'] >= 3)),
-            # Can't Lose Them
-            ((rfm_segmented['R_rank'] < 3) & (rfm_segmented['F_rank'] >= 3) & (rfm_segmented['M_rank'] < 3)),
-            # Lost
-            ((rfm_segmented['R_rank'] < 3) & (rfm_segmented['F_rank'] < 3) & (rfm_segmented['M_rank'] < 3)),
-            # Big Spenders
-            ((rfm_segmented['R_rank'] < 3) & (rfm_segmented['F_rank'] < 3) & (rfm_segmented['M_rank'] >= 3)),
-        ]
-        
-        choices = [
-            'Чемпионы', 
-            'Лояльные клиенты', 
-            'Потенциально лояльные', 
-            'Новые клиенты',
-            'Под угрозой ухода', 
-            'Нельзя потерять', 
-            'Потерянные', 
-            'Крупные покупатели'
-        ]
-        
-        rfm_segmented['Customer_Segment'] = np.select(conditions, choices, default='Прочие')
+    Строки кодируются пачками по batch_size прямо из столбцов DataFrame
+    (pandas to_json), поэтому в памяти одновременно находится только одна
+    пачка. Дробные числа округляются до 10 знаков после запятой.
     
-    else:
-        # Используем пользовательское отображение для создания сегментов
-        rfm_segmented['Customer_Segment'] = rfm_segmented['RFM_Segment_Code'].map(
-            segment_mapping).fillna('Прочие')
+    Parameters:
+    -----------
+    rfm : pd.DataFrame
+        Результаты RFM-анализа.
+    positions : np.ndarray, optional
+        Позиции выгружаемых строк в нужном порядке (по умолчанию все строки).
+    columns : list, optional
+        Выгружаемые столбцы (по умолчанию все).
+    layout : str, default='records'
+        'records' - массив объектов {столбец: значение}, 'columns' - объект
+        {столбец: массив значений}; второй вариант компактнее, так как имена
+        столбцов не повторяются в каждой строке.
+    envelope : dict, optional
+        Поля ответа, записываемые перед данными.
+    key : str, default='customers'
+        Имя поля ответа с данными.
+    batch_size : int, default=20000
+        Число строк в одной пачке.
     
-    return rfm_segmented
+    Returns:
+    --------
+    Iterator[bytes]
+        Части JSON-документа в кодировке UTF-8.
+    """
+    if layout not in JSON_LAYOUTS:
+        raise ValueError(f"Неизвестная раскладка JSON: {layout}")
+    if positions is None:
+        positions = np.arange(len(rfm))
+    columns = list(rfm.columns) if columns is None else columns
+    column_indexer = rfm.columns.get_indexer(columns)
+    
+    head = json.dumps(envelope or {}, ensure_ascii=False)[:-1]
+    yield f"{head}{', ' if envelope else ''}{json.dumps(key)}: ".encode()
+    
+    if layout == 'records':
+        yield b'['
+        for start in range(0, len(positions), batch_size):
+            batch = rfm.iloc[positions[start:start + batch_size], column_indexer]
+            chunk = batch.to_json(orient='records', force_ascii=False)[1:-1]
+            yield (',' + chunk if start else chunk).encode()
+        yield b']}'
+        return
+    
+    yield b'{'
+    for i, column in enumerate(columns):
+        yield f"{', ' if i else ''}{json.dumps(column, ensure_ascii=False)}: [".encode()
+        values = rfm.iloc[:, column_indexer[i]]
+        for start in range(0, len(positions), batch_size):
+            chunk = values.iloc[positions[start:start + batch_size]].to_json(
+                orient='values', force_ascii=False)[1:-1]
+            yield (',' + chunk if start else chunk).encode()
+        yield b']'
+    yield b'}}'
 
 
-def _create_additional_info(rfm: pd.DataFrame) -> Dict[str, pd.DataFrame]:
-    """Создает дополнительную информацию для анализа."""
-    # Расчет статистики по сегментам
-    segment_stats = rfm.groupby('Customer_Segment').agg({
-        'Recency': ['mean', 'median', 'count'],
-        'Frequency': ['mean', 'median', 'sum'],
-        'Monetary': ['mean', 'median', 'sum']
-    })
+def iter_rfm_csv(rfm: pd.DataFrame, positions: Optional[np.ndarray] = None,
+                 columns: Optional[List[str]] = None, batch_size: int = 20000) -> Iterator[bytes]:
+    """
+    Кодирует строки результатов в CSV по частям (заголовок в первой части).
     
-    # Переименовываем столбцы
-    segment_stats.columns = [f'{col[0]}_{col[1]}' for col in segment_stats.columns]
-    segment_stats = segment_stats.reset_index()
+    Параметры те же, что у iter_rfm_json.
+    """
+    if positions is None:
+        positions = np.arange(len(rfm))
+    columns = list(rfm.columns) if columns is None else columns
+    column_indexer = rfm.columns.get_indexer(columns)
     
-    # Расчет распределения по сегментам
-    segment_distribution = rfm['Customer_Segment'].value_counts().reset_index()
-    segment_distribution.columns = ['Customer_Segment', 'Count']
-    segment_distribution['Percentage'] = segment_distribution['Count'] / segment_distribution['Count'].sum() * 100
+    # Хотя бы одна пачка, чтобы у пустой выборки был заголовок
+    for start in range(0, max(len(positions), 1), batch_size):
+        batch = rfm.iloc[positions[start:start + batch_size], column_indexer]
+        yield batch.to_csv(index=False, header=start == 0).encode()
+
+
+def rfm_arrow_table(rfm: pd.DataFrame):
+    """
+    Преобразует результаты в таблицу Arrow для передачи в формате Arrow IPC.
     
-    # Возвращаем словарь с дополнительной информацией
-    return {
-        'segment_stats': segment_stats,
-        'segment_distribution': segment_distribution
+    Числовые столбцы не копируются: таблица ссылается на буферы numpy
+    DataFrame. Сегменты (_CATEGORICAL_RESULT_COLUMNS) всегда становятся
+    словарными столбцами (коды и словарь категорий), как и при сохранении
+    в Parquet, даже если в результате они хранятся строками; клиент читает
+    их как коды. Копируются только текстовые столбцы.
+    """
+    pa = _import_pyarrow('pyarrow')
+    columns = {
+        column: rfm[column].astype('category') if column in _CATEGORICAL_RESULT_COLUMNS else rfm[column]
+        for column in rfm.columns
     }
+    table = pd.DataFrame(columns, copy=False)
+    return pa.Table.from_pandas(table, preserve_index=False).replace_schema_metadata(None)
 
 
-def save_rfm_results(rfm: pd.DataFrame, output_path: str) -> None:
-    """Сохраняет результаты RFM-анализа в CSV-файл."""
-    try:
-        rfm.to_csv(output_path, index=False)
-        print(f"Результаты успешно сохранены в {output_path}")
-    except Exception as e:
-        print(f"Ошибка при сохранении результатов: {str(e)}")
+class _ChunkSink:
+    """Приемник записи pyarrow, накапливающий записанные байты до выдачи очередной части."""
+    
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_rfm_arrow(table, positions: Optional[np.ndarray] = None,
+                   columns: Optional[List[str]] = None, metadata: Optional[Dict] = None,
+                   batch_size: int = 65536) -> Iterator[bytes]:
+    """
+    Кодирует строки результатов в поток Arrow IPC по частям.
+    
+    Каждая часть - один record batch, поэтому клиент может разбирать поток
+    по мере получения. Если позиции идут подряд (без фильтров и сортировки),
+    строки берутся срезом таблицы без копирования, иначе выбираются по позициям.
+    
+    Parameters:
+    -----------
+    table : pyarrow.Table
+        Результаты, преобразованные rfm_arrow_table.
+    positions : np.ndarray, optional
+        Позиции выгружаемых строк в нужном порядке (по умолчанию все строки).
+    columns : list, optional
+        Выгружаемые столбцы (по умолчанию все).
+    metadata : dict, optional
+        Метаданные схемы потока (значения записываются строками).
+    batch_size : int, default=65536
+        Число строк в одном record batch.
+    
+    Returns:
+    --------
+    Iterator[bytes]
+        Части потока Arrow IPC.
+    """
+    pa = _import_pyarrow('pyarrow')
+    if columns is not None:
+        table = table.select(columns)
+    if metadata:
+        table = table.replace_schema_metadata({str(key): str(value) for key, value in metadata.items()})
+    
+    if positions is None:
+        positions = np.arange(table.num_rows)
+    contiguous = len(positions) == 0 or bool(np.all(np.diff(positions) == 1))
+    
+    sink = _ChunkSink()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        yield sink.take()
+        for offset in range(0, len(positions), batch_size):
+            if contiguous:
+                batch = table.slice(int(positions[0]) + offset, min(batch_size, len(positions) - offset))
+            else:
+                # take сохраняет словари категорий, поэтому все пачки потока используют один словарь
+                batch = table.take(pa.array(positions[offset:offset + batch_size]))
+            writer.write_table(batch, max_chunksize=batch_size)
+            yield sink.take()
+    yield sink.take()
 
 
 def visualize_rfm(rfm: pd.DataFrame, additional_info: Dict[str, pd.DataFrame], 
-                 output_dir: Optional[str] = None) -> None:
-    """Создает визуализации результатов RFM-анализа."""
+                 output_dir: Optional[str] = None, max_points: Optional[int] = None,
+                 scatter_mode: str = 'sample') -> None:
+    """
+    Создает визуализации результатов RFM-анализа.
+    
+    Если задан max_points и клиентов больше, диаграмма Frequency vs Monetary
+    строится не по всем клиентам: при scatter_mode='sample' - по выборке
+    rfm_sample_positions, при 'density' - сеткой плотности rfm_density_grid
+    со средним Recency в ячейке. Время ее построения тогда не зависит от числа
+    клиентов.
+    """
+    if scatter_mode not in SCATTER_MODES:
+        raise ValueError(f"Неизвестный режим диаграммы: {scatter_mode}")
+    downsample = max_points is not None and len(rfm) > max_points
+    
     # Создаем базовые настройки для графиков
     plt.figure(figsize=(12, 10))
     plt.style.use('ggplot')
@@ -415,10 +2431,17 @@ def visualize_rfm(rfm: pd.DataFrame, additional_info: Dict[str, pd.DataFrame],
     
     # 3. Scatter plot: Frequency vs Monetary с цветовой кодировкой по Recency
     plt.subplot(2, 2, 3)
-    scatter = plt.scatter(rfm['Frequency'], rfm['Monetary'], 
-                         c=rfm['Recency'], cmap='viridis', 
-                         alpha=0.6, edgecolors='w', linewidth=0.5)
-    plt.colorbar(scatter, label='Recency (дни)')
+    if downsample and scatter_mode == 'density':
+        grid = rfm_density_grid(rfm)
+        mean = np.ma.masked_invalid(np.array(grid['mean'], dtype=float))
+        mesh = plt.pcolormesh(grid['x_edges'], grid['y_edges'], mean.T, cmap='viridis')
+        plt.colorbar(mesh, label='Средний Recency (дни)')
+    else:
+        points = rfm.iloc[rfm_sample_positions(rfm, max_points)] if downsample else rfm
+        scatter = plt.scatter(points['Frequency'], points['Monetary'], 
+                             c=points['Recency'], cmap='viridis', 
+                             alpha=0.6, edgecolors='w', linewidth=0.5)
+        plt.colorbar(scatter, label='Recency (дни)')
     plt.xlabel('Frequency (количество транзакций)')
     plt.ylabel('Monetary (сумма)')
     plt.title('Frequency vs Monetary по Recency')
@@ -539,4 +2562,17 @@ def example_usage():
 
 
 if __name__ == "__main__":
-    example_usage()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="RFM-анализ")
+    parser.add_argument('--rebuild-manifest', metavar='RESULTS_DIR',
+                        help="перестроить индекс результатов (manifest.jsonl) в каталоге и выйти")
+    args = parser.parse_args()
+    
+    if args.rebuild_manifest:
+        try:
+            count = rebuild_results_manifest(args.rebuild_manifest)
+        except OSError as e:
+            print(f"Ошибка при построении индекса результатов: {str(e)}")
+            sys.exit(1)
+        print(f"Индекс результатов перестроен: {count} записей")
+    else:
+        example_usage()
\ No newline at end of file
@@ -1,11 +1,28 @@
 import http.server
-import socketserver
 import pandas as pd
-from rfmpro_analysis import rfm_analysis
+import numpy as np
+from rfmpro_analysis import (rfm_analysis_stream, sniff_csv_format, save_rfm_results, load_rfm_results,
+                             results_manifest_entry, append_results_manifest, read_results_manifest,
+                             rebuild_results_manifest, prune_results_manifest, RESULTS_MANIFEST_NAME,
+                             RESULT_FORMATS, RANKING_METHODS, rfm_aggregates_path,
+                             rfm_aggregates, save_rfm_aggregates, load_rfm_aggregates,
+                             AGGREGATE_COLUMNS, iter_rfm_json, iter_rfm_csv, JSON_LAYOUTS,
+                             rfm_arrow_table, iter_rfm_arrow, rfm_sample_positions, rfm_density_grid,
+                             SCATTER_MODES)
 import os
+import re
 import json
 import traceback
-from urllib.parse import unquote
+import hashlib
+import gzip
+import email.message
+import email.utils
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit, urljoin, parse_qs
 from datetime import datetime
 
 # Попытка инициализации Firebase, при условии наличия конфигурационного файла
@@ -40,116 +57,866 @@ try:
 except ImportError:
     print("Модуль firebase_admin не установлен, функциональность Firebase будет отключена")
 
+# Результаты сохраняются в Parquet, если установлен pyarrow, иначе в CSV
+try:
+    import pyarrow.parquet as pq
+    RESULTS_FORMAT = 'parquet'
+except ImportError:
+    pq = None
+    RESULTS_FORMAT = 'csv'
+    print("Модуль pyarrow не установлен, результаты будут сохраняться в CSV")
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+    print("Модуль brotli не установлен, статические файлы будут сжиматься только gzip")
+
 PORT = 8000
+RESULTS_DIR = "results"
 
-class SimpleHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def do_GET(self):
-        print(f"Запрос: GET {self.path}")
+# Кэш последнего результата: сводные агрегаты, готовые JSON-ответы и (для
+# /api/customers) разобранный файл результатов. Кэш сбрасывается, когда
+# появляется новый файл результатов или меняются время изменения или размер
+# текущего; счетчики доступны через /api/cache-stats
+rfm_data_cache = {
+    'dir_mtime': None,
+    'latest_file': None,
+    'key': None,
+    'frame': None,
+    'aggregates': None,
+    'aggregate_bodies': {},
+    'sort_orders': {},
+    'segment_positions': None,
+    'arrow_table': None,
+    'scatter_bodies': {},
+    'body': None,
+    'etag': None,
+    'hits': 0,
+    'misses': 0,
+    'not_modified': 0
+}
+rfm_data_cache_lock = threading.Lock()
+
+# Кэш истории загрузок: прочитанные записи индекса результатов и позиция в файле
+# индекса; при каждом запросе дочитываются только добавленные строки
+upload_history_cache = {
+    'inode': None,
+    'offset': 0,
+    'entries': [],
+    'body': None
+}
+upload_history_cache_lock = threading.Lock()
+
+# Фоновые задачи анализа: загрузка возвращает id задачи сразу, анализ выполняется
+# в пуле из ANALYSIS_WORKERS потоков, сервер тем временем продолжает отвечать на запросы.
+# Новые загрузки отклоняются (503), если в очереди и в работе MAX_ACTIVE_JOBS задач
+ANALYSIS_WORKERS = 2
+MAX_ACTIVE_JOBS = 8
+MAX_FINISHED_JOBS = 100
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix='rfm-analysis')
+analysis_jobs = {}
+analysis_jobs_lock = threading.Lock()
+
+# Выбор имени и запись файла результатов
+results_write_lock = threading.Lock()
+
+# Загрузки больше MAX_UPLOAD_SIZE байт отклоняются (413) до чтения тела запроса.
+# Тело читается блоками по UPLOAD_READ_SIZE байт, файл сразу записывается на диск
+MAX_UPLOAD_SIZE = 2 * 1024 ** 3
+UPLOAD_READ_SIZE = 1024 * 1024
+# Максимальный размер заголовков части формы и текстового поля
+MAX_FORM_FIELD_SIZE = 64 * 1024
+
+# Загруженные файлы хранятся по хэшу содержимого (uploads/<sha256>.csv): повторная
+# загрузка того же файла не создает копию, а запуск с теми же данными и параметрами
+# анализа сразу возвращает готовый результат. Загрузки и результаты, не использовавшиеся
+# дольше MAX_*_AGE секунд, удаляются, как и самые старые при превышении MAX_*_SIZE байт
+UPLOADS_DIR = "uploads"
+MAX_UPLOADS_SIZE = 10 * 1024 ** 3
+MAX_UPLOAD_AGE = 30 * 24 * 3600
+MAX_RESULTS_SIZE = 5 * 1024 ** 3
+MAX_RESULT_AGE = 180 * 24 * 3600
+
+# Части сводных агрегатов, доступные через /api/aggregates/<часть>
+AGGREGATE_PARTS = {
+    'summary': 'summary',
+    'segments': 'segments',
+    'rank-cube': 'rank_cube',
+    'histograms': 'histograms',
+    'scores': 'scores'
+}
+
+# Размер страницы /api/customers по умолчанию и максимальный
+CUSTOMERS_PAGE_SIZE = 50
+CUSTOMERS_MAX_PAGE_SIZE = 1000
+
+# Тип содержимого потока Arrow IPC: /api/customers отдает его по format=arrow или
+# клиентам, указавшим его в заголовке Accept (при наличии pyarrow)
+ARROW_STREAM_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Диаграмма Frequency vs Monetary (/api/scatter): размер выборки и сетки плотности
+# по умолчанию и максимальный; ответ не растет с числом клиентов
+SCATTER_MAX_POINTS = 5000
+SCATTER_MAX_POINTS_LIMIT = 50000
+SCATTER_BINS = 50
+SCATTER_BINS_LIMIT = 200
+SCATTER_COLUMNS = ['Frequency', 'Monetary', 'Recency', 'Customer_Segment']
+
+# Уровень сжатия gzip для выгрузок, сжимаемых на лету: уровень 1 сжимает в 4 раза
+# быстрее уровня 6, и выгрузка не упирается в процессор, при ответе на ~25% больше
+STREAM_GZIP_LEVEL = 1
+
+# Статические файлы хранятся в памяти вместе со сжатыми вариантами и
+# перечитываются при изменении. Ссылки из HTML на скрипты и стили содержат
+# версию файла (?v=), поэтому по таким ссылкам файлы кэшируются браузером на
+# STATIC_MAX_AGE секунд; страницы и прочие запросы перепроверяются по ETag
+STATIC_DIR = "static"
+STATIC_CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.jsx': 'text/babel; charset=utf-8',
+    '.json': 'application/json'
+}
+STATIC_MAX_AGE = 365 * 24 * 3600
+STATIC_MIN_COMPRESS_SIZE = 512
+STATIC_REFERENCE_PATTERN = re.compile(r'((?:src|href)=")([^"?#:]+\.(?:js|css))"')
+
+static_assets = {}
+static_assets_lock = threading.Lock()
+static_assets_stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+
+def find_latest_results_file():
+    """
+    Возвращает путь к последнему файлу результатов или None.
+    
+    Каталог просматривается заново, только если изменилось время изменения
+    самого каталога (файл добавлен, удален или переименован).
+    """
+    try:
+        dir_mtime = os.stat(RESULTS_DIR).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    
+    if rfm_data_cache['dir_mtime'] != dir_mtime:
+        # Файлы агрегатов (rfm_results_*.aggregates.json) лежат рядом и результатами не являются
+        entries = [entry for entry in os.scandir(RESULTS_DIR)
+                   if entry.name.startswith('rfm_results_')
+                   and os.path.splitext(entry.name)[1].lower() in RESULT_FORMATS]
+        latest = max(entries, key=lambda entry: entry.stat().st_mtime, default=None)
+        rfm_data_cache['latest_file'] = latest.path if latest else None
+        rfm_data_cache['dir_mtime'] = dir_mtime
+    return rfm_data_cache['latest_file']
+
+def create_job(job_id, file_name, cache_key=None, result_file=None, result=None):
+    """
+    Регистрирует задачу анализа в очереди.
+    
+    Если передан готовый результат (повторный анализ тех же данных),
+    задача сразу регистрируется выполненной.
+    Возвращает False, если в очереди и в работе уже MAX_ACTIVE_JOBS задач.
+    Из завершенных задач хранятся последние MAX_FINISHED_JOBS.
+    """
+    with analysis_jobs_lock:
+        statuses = [job['status'] for job in analysis_jobs.values()]
+        if result is None and sum(status in ('queued', 'running') for status in statuses) >= MAX_ACTIVE_JOBS:
+            return False
         
-        if self.path == '/':
-            print("GET / requested")
-            try:
-                self.send_response(200)
-                self.send_header("Content-type", "text/html")
-                self.end_headers()
-                with open("static/index.html", "rb") as f:
-                    content = f.read()
-                    print(f"Sending index.html, size: {len(content)} bytes")
-                    self.wfile.write(content)
-            except FileNotFoundError:
-                print("index.html not found")
-                self.send_response(404)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"404 - File not found")
+        finished = [old_id for old_id, job in analysis_jobs.items() if job['status'] in ('done', 'error')]
+        for old_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS + 1)]:
+            del analysis_jobs[old_id]
         
-        elif self.path == '/style.css':
-            print("GET /style.css requested")
-            self.send_response(200)
-            self.send_header("Content-type", "text/css")
-            self.end_headers()
-            with open("static/style.css", "rb") as f:
-                self.wfile.write(f.read())
+        now = time.time()
+        analysis_jobs[job_id] = {
+            'id': job_id,
+            'status': 'queued' if result is None else 'done',
+            'stage': 'В очереди' if result is None else 'Готово (результат из кэша)',
+            'progress': 0.0 if result is None else 100.0,
+            'rows_processed': 0,
+            'rows_total': None,
+            'file_name': file_name,
+            'cache_key': cache_key,
+            'cached': result is not None,
+            'created_at': now,
+            'started_at': None if result is None else now,
+            'finished_at': None if result is None else now,
+            'result_file': result_file,
+            'result': result,
+            'error': None
+        }
+    return True
+
+
+def update_job(job_id, **fields):
+    """Обновляет поля задачи анализа"""
+    with analysis_jobs_lock:
+        analysis_jobs[job_id].update(fields)
+
+
+def find_active_job(cache_key):
+    """Возвращает id задачи в очереди или в работе с тем же ключом кэша или None"""
+    with analysis_jobs_lock:
+        for job in analysis_jobs.values():
+            if job['cache_key'] == cache_key and job['status'] in ('queued', 'running'):
+                return job['id']
+    return None
+
+
+def get_job(job_id):
+    """Возвращает копию задачи анализа или None"""
+    with analysis_jobs_lock:
+        job = analysis_jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+def multipart_boundary(content_type):
+    """
+    Возвращает boundary из заголовка Content-Type multipart/form-data в байтах
+    (кавычки и экранирование параметра снимаются) или None, если тип другой
+    или boundary не указан.
+    """
+    message = email.message.Message()
+    message['Content-Type'] = content_type
+    if message.get_content_type() != 'multipart/form-data':
+        return None
+    boundary = message.get_param('boundary')
+    if not isinstance(boundary, str) or not boundary:
+        return None
+    try:
+        return boundary.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+
+
+def read_multipart_upload(rfile, content_length, boundary, file_field, file_path):
+    """
+    Потоково разбирает тело запроса multipart/form-data.
+    
+    Содержимое поля file_field записывается в file_path по мере чтения,
+    остальные поля возвращаются строками. В памяти находится не больше
+    одного блока UPLOAD_READ_SIZE и хвоста длиной с разделитель.
+    
+    Returns:
+    --------
+    tuple
+        (fields, file_size, file_head, file_hash): текстовые поля формы, размер
+        записанного файла (None, если поля file_field нет), первые 4 байта файла
+        и SHA-256 его содержимого, рассчитанный при записи.
+    
+    Raises:
+    -------
+    ValueError
+        Если тело запроса обрывается или часть формы слишком велика.
+    """
+    delimiter = b'\r\n--' + boundary
+    remaining = content_length
+    # Перед первым разделителем нет CRLF; добавляем его, чтобы все разделители искались одинаково
+    buffer = b'\r\n'
+    
+    def read_more():
+        nonlocal buffer, remaining
+        chunk = rfile.read(min(UPLOAD_READ_SIZE, remaining)) if remaining > 0 else b''
+        if not chunk:
+            raise ValueError("Тело запроса обрывается до конца формы")
+        remaining -= len(chunk)
+        buffer += chunk
+    
+    # Пропускаем преамбулу до первого разделителя
+    position = buffer.find(delimiter)
+    while position == -1:
+        buffer = buffer[-len(delimiter):]
+        read_more()
+        position = buffer.find(delimiter)
+    buffer = buffer[position + len(delimiter):]
+    
+    fields = {}
+    file_size, file_head = None, b''
+    file_hash = hashlib.sha256()
+    while True:
+        while len(buffer) < 2:
+            read_more()
+        if buffer.startswith(b'--'):
+            break
+        
+        # Заголовки части: CRLF после разделителя, затем строки до пустой строки
+        header_end = buffer.find(b'\r\n\r\n')
+        while header_end == -1:
+            if len(buffer) > MAX_FORM_FIELD_SIZE:
+                raise ValueError("Слишком длинные заголовки части формы")
+            read_more()
+            header_end = buffer.find(b'\r\n\r\n')
+        headers = buffer[2:header_end].decode('utf-8', errors='ignore')
+        buffer = buffer[header_end + 4:]
+        name_match = re.search(r'\bname="([^"]*)"', headers)
+        name = name_match.group(1) if name_match else None
+        
+        is_file = name == file_field
+        output = open(file_path, 'wb') if is_file else None
+        value = bytearray()
+        size = 0
+        try:
+            while True:
+                position = buffer.find(delimiter)
+                if position != -1:
+                    data, buffer = buffer[:position], buffer[position + len(delimiter):]
+                else:
+                    # Конец буфера может оказаться началом разделителя, его оставляем
+                    split = max(0, len(buffer) - len(delimiter) + 1)
+                    data, buffer = buffer[:split], buffer[split:]
+                
+                if is_file:
+                    if size < 4:
+                        file_head += data[:4 - size]
+                    output.write(data)
+                    file_hash.update(data)
+                else:
+                    value += data
+                    if len(value) > MAX_FORM_FIELD_SIZE:
+                        raise ValueError(f"Слишком длинное поле формы {name}")
+                size += len(data)
+                
+                if position != -1:
+                    break
+                read_more()
+        finally:
+            if output is not None:
+                output.close()
         
-        elif self.path == '/dashboard':
-            print("GET /dashboard requested")
+        if is_file:
+            file_size = size
+        elif name is not None:
+            fields[name] = value.decode('utf-8', errors='ignore')
+    
+    # Дочитываем эпилог после последнего разделителя
+    while remaining > 0:
+        chunk = rfile.read(min(UPLOAD_READ_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+    
+    return fields, file_size, file_head, file_hash.hexdigest() if file_size is not None else None
+
+
+def parse_analysis_params(fields):
+    """
+    Возвращает параметры анализа из необязательных полей формы загрузки:
+    n_quantiles (по умолчанию 4), ranking_method (quantile) и analysis_date
+    (сегодня). Дата приводится к дню, чтобы повторные запуски в тот же день
+    находили результат в кэше.
+    """
+    n_quantiles = int(fields.get('n_quantiles') or 4)
+    if not 2 <= n_quantiles <= 10:
+        raise ValueError("n_quantiles должно быть от 2 до 10")
+    
+    ranking_method = (fields.get('ranking_method') or 'quantile').strip()
+    if ranking_method not in RANKING_METHODS:
+        raise ValueError(f"Неизвестный ranking_method: {ranking_method}")
+    
+    analysis_date = (fields.get('analysis_date') or '').strip()
+    analysis_date = pd.to_datetime(analysis_date) if analysis_date else pd.Timestamp.now()
+    
+    return {
+        'n_quantiles': n_quantiles,
+        'ranking_method': ranking_method,
+        'analysis_date': analysis_date.strftime('%Y-%m-%d')
+    }
+
+
+def analysis_cache_key(file_hash, customer_col, date_col, amount_col, analysis_params):
+    """Ключ кэша анализа: хэш содержимого файла вместе со столбцами и параметрами анализа"""
+    key = json.dumps({
+        'file': file_hash,
+        'customer_col': customer_col,
+        'date_col': date_col,
+        'amount_col': amount_col,
+        **analysis_params
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def store_upload(part_path, file_hash, is_parquet):
+    """
+    Переносит загруженный файл в UPLOADS_DIR под именем по хэшу содержимого.
+    
+    Если такой файл уже есть, новая копия удаляется, а у сохраненной
+    обновляется время изменения (по нему работает вытеснение).
+    """
+    file_name = os.path.join(UPLOADS_DIR, f"{file_hash}.{'parquet' if is_parquet else 'csv'}")
+    if os.path.exists(file_name):
+        os.remove(part_path)
+        os.utime(file_name)
+        print(f"Файл уже загружался, используется {file_name}")
+    else:
+        os.replace(part_path, file_name)
+    return file_name
+
+
+def find_cached_result(cache_key):
+    """Возвращает запись индекса результатов с тем же ключом кэша, если файл результата еще существует"""
+    for entry in reversed(read_results_manifest(RESULTS_DIR)):
+        if entry.get('cache_key') == cache_key and os.path.exists(os.path.join(RESULTS_DIR, entry['result_file'])):
+            return entry
+    return None
+
+
+def results_aggregates(result_file):
+    """Читает сводные агрегаты результата; если их нет, рассчитывает и сохраняет рядом с результатом"""
+    aggregates = load_rfm_aggregates(result_file)
+    if aggregates is None:
+        print(f"Агрегаты для {result_file} не найдены, рассчитываем")
+        try:
+            rfm = load_rfm_results(result_file, columns=AGGREGATE_COLUMNS + ['Monetary_Mean'])
+        except ValueError:
+            # Monetary_Mean нет, если анализ выполнялся с сокращенным набором monetary_stats
+            rfm = load_rfm_results(result_file, columns=AGGREGATE_COLUMNS)
+        aggregates = rfm_aggregates(rfm)
+        try:
+            save_rfm_aggregates(aggregates, result_file)
+        except Exception as e:
+            print(f"Не удалось сохранить агрегаты: {str(e)}")
+    return aggregates
+
+
+def reuse_cached_result(entry):
+    """
+    Делает найденный в кэше результат последним (его показывает дашборд)
+    и возвращает ответ анализа в том же виде, что и после нового расчета.
+    """
+    result_file = os.path.join(RESULTS_DIR, entry['result_file'])
+    os.utime(result_file)
+    if os.path.exists(rfm_aggregates_path(result_file)):
+        os.utime(rfm_aggregates_path(result_file))
+    with rfm_data_cache_lock:
+        # Время изменения каталога не меняется, поэтому последний файл ищется заново
+        rfm_data_cache['dir_mtime'] = None
+    
+    return {
+        "total_customers": entry['records'],
+        "total_revenue": results_aggregates(result_file)['summary']['total_revenue'],
+        "segments": entry['segments']
+    }
+
+
+def evict_files(paths, max_size, max_age, keep=()):
+    """
+    Удаляет файлы, не изменявшиеся дольше max_age секунд, и самые старые,
+    пока общий размер больше max_size. Файлы из keep не удаляются.
+    
+    Returns:
+    --------
+    list
+        Пути удаленных файлов.
+    """
+    files = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    
+    now = time.time()
+    total_size = sum(size for _, size, _ in files)
+    removed = []
+    for mtime, size, path in files:
+        if path in keep or (now - mtime <= max_age and total_size <= max_size):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        removed.append(path)
+    return removed
+
+
+def evict_cached_files():
+    """
+    Вытесняет старые загрузки и результаты по возрасту и общему размеру.
+    
+    Файлы задач в очереди и в работе, а также последний результат (его
+    показывает дашборд) не удаляются; записи об удаленных результатах
+    убираются из индекса.
+    """
+    with analysis_jobs_lock:
+        active_files = {job['file_name'] for job in analysis_jobs.values() if job['status'] in ('queued', 'running')}
+    
+    if os.path.isdir(UPLOADS_DIR):
+        uploads = [entry.path for entry in os.scandir(UPLOADS_DIR) if not entry.name.endswith('.part')]
+        for path in evict_files(uploads, MAX_UPLOADS_SIZE, MAX_UPLOAD_AGE, keep=active_files):
+            print(f"Удалена старая загрузка {path}")
+    
+    if os.path.isdir(RESULTS_DIR):
+        with results_write_lock:
+            results = [entry.path for entry in os.scandir(RESULTS_DIR)
+                       if entry.name.startswith('rfm_results_')
+                       and os.path.splitext(entry.name)[1].lower() in RESULT_FORMATS]
+            latest = max(results, key=os.path.getmtime, default=None)
+            removed = evict_files(results, MAX_RESULTS_SIZE, MAX_RESULT_AGE, keep={latest})
+            for path in removed:
+                print(f"Удален старый результат {path}")
+                if os.path.exists(rfm_aggregates_path(path)):
+                    os.remove(rfm_aggregates_path(path))
+            if removed:
+                prune_results_manifest(RESULTS_DIR)
+
+
+def estimate_transaction_rows(file_name, is_parquet):
+    """Оценивает число транзакций для хода задачи: точно для Parquet, по первому мегабайту для CSV"""
+    try:
+        if is_parquet:
+            return pq.ParquetFile(file_name).metadata.num_rows
+        with open(file_name, 'rb') as f:
+            head = f.read(1 << 20)
+        lines = head.count(b'\n')
+        if not lines:
+            return 1
+        # Первая строка - заголовок
+        return max(1, round(os.path.getsize(file_name) * lines / len(head)) - 1)
+    except Exception as e:
+        print(f"Не удалось оценить размер файла {file_name}: {str(e)}")
+        return None
+
+
+def run_analysis_job(job_id, file_name, is_parquet, customer_col, date_col, amount_col, read_csv_kwargs,
+                     analysis_params, cache_key):
+    """
+    Выполняет RFM-анализ загруженного файла в пуле фоновых задач.
+    
+    Ход выполнения, результат или ошибка записываются в задачу job_id,
+    которую возвращает /api/jobs/<id>.
+    """
+    update_job(job_id, status='running', stage='Чтение транзакций', started_at=time.time())
+    rows_total = estimate_transaction_rows(file_name, is_parquet)
+    update_job(job_id, rows_total=rows_total)
+    
+    def report_progress(rows_processed):
+        # Чтение и агрегация транзакций - основная часть анализа, на нее отводится 90%
+        progress = 90.0 * min(rows_processed / rows_total, 1.0) if rows_total else None
+        update_job(job_id, rows_processed=rows_processed, progress=progress)
+    
+    # Из CSV разбираются только три столбца анализа, сумма - сразу как число
+    if read_csv_kwargs is not None:
+        read_csv_kwargs = {**read_csv_kwargs, 'dtype': {amount_col: 'float64'}}
+    
+    try:
+        started = time.perf_counter()
+        try:
+            rfm_df, additional_info = rfm_analysis_stream(
+                file_name, date_col, customer_col, amount_col, **analysis_params,
+                read_csv_kwargs=read_csv_kwargs, progress=report_progress)
+        except UnicodeDecodeError:
+            # Кодировка определяется по выборке из файла; если байты, не подходящие
+            # к ней, встретились вне выборки, файл разбирается повторно в latin-1
+            print(f"Кодировка {read_csv_kwargs['encoding']} не подошла для всего файла, повторяем в latin-1")
+            rfm_df, additional_info = rfm_analysis_stream(
+                file_name, date_col, customer_col, amount_col, **analysis_params,
+                read_csv_kwargs={**read_csv_kwargs, 'encoding': 'latin-1'}, progress=report_progress)
+        update_job(job_id, stage='Сохранение результатов', progress=90.0)
+        rfm_result = {
+            "total_customers": int(rfm_df[customer_col].nunique()),
+            "total_revenue": float(rfm_df['Monetary'].sum()),
+            "segments": additional_info['segment_distribution'].set_index('Customer_Segment')['Count'].to_dict()
+        }
+        
+        # Сохранение результатов в Firebase только если Firebase настроен
+        if firebase_admin_imported:
             try:
-                self.send_response(200)
-                self.send_header("Content-type", "text/html")
-                self.end_headers()
-                with open("static/dashboard/index.html", "rb") as f:
-                    content = f.read()
-                    print(f"Отправка dashboard/index.html, размер: {len(content)} байт")
-                    self.wfile.write(content)
-            except FileNotFoundError as e:
-                print(f"dashboard/index.html не найден: {str(e)}")
-                # Попробуем создать папку и файл автоматически
+                # Пробуем сохранить в Firebase Storage
                 try:
-                    os.makedirs("static/dashboard", exist_ok=True)
-                    self.send_response(404)
-                    self.send_header("Content-type", "text/plain")
-                    self.end_headers()
-                    self.wfile.write(b"404 - Dashboard files missing. Directory created, please add necessary files.")
-                except Exception as dir_error:
-                    print(f"Ошибка создания директории: {str(dir_error)}")
-                    self.send_response(500)
-                    self.send_header("Content-type", "text/plain")
-                    self.end_headers()
-                    self.wfile.write(f"500 - Server error: {str(dir_error)}".encode())
-            except Exception as e:
-                print(f"Ошибка при обработке /dashboard: {str(e)}")
-                self.send_response(500)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(f"500 - Server error: {str(e)}".encode())
+                    blob = bucket.blob(f"uploads/{os.path.basename(file_name)}")
+                    with open(file_name, "rb") as f:
+                        blob.upload_from_file(
+                            f, content_type="application/vnd.apache.parquet" if is_parquet else "text/csv")
+                    print(f"Файл успешно загружен в Firebase Storage")
+                except Exception as storage_error:
+                    print(f"Ошибка при загрузке в Firebase Storage: {str(storage_error)}")
+                
+                # Пробуем сохранить в Firestore
+                try:
+                    db.collection("rfm_results").add({
+                        "file_name": file_name,
+                        "result": rfm_result,
+                        "timestamp": firestore.SERVER_TIMESTAMP
+                    })
+                    print(f"Результаты успешно сохранены в Firestore")
+                except Exception as firestore_error:
+                    print(f"Ошибка при сохранении в Firestore: {str(firestore_error)}")
+            except Exception as firebase_error:
+                print(f"Общая ошибка при работе с Firebase: {str(firebase_error)}")
+        else:
+            print("Firebase не инициализирован, результаты не сохранены в облаке")
+        
+        # Создаем директорию results, если её нет
+        results_dir = RESULTS_DIR
+        if not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+        
+        # Сохраняем локально в Parquet (или CSV, если pyarrow не установлен).
+        # Задачи могут завершиться в одну секунду, поэтому имя выбирается под блокировкой
+        with results_write_lock:
+            timestamp = int(datetime.now().timestamp())
+            while any(os.path.exists(f"{results_dir}/rfm_results_{timestamp}{ext}") for ext in RESULT_FORMATS):
+                timestamp += 1
+            result_file = f"{results_dir}/rfm_results_{timestamp}.{RESULTS_FORMAT}"
+            save_rfm_results(rfm_df, result_file, format=RESULTS_FORMAT)
+        
+        # Сводные агрегаты для графиков дашборда сохраняются рядом с результатами
+        # (ошибка записи результатов выше завершает задачу с ошибкой)
+        try:
+            save_rfm_aggregates(rfm_aggregates(rfm_df), result_file)
+        except Exception as e:
+            print(f"Не удалось сохранить агрегаты: {str(e)}")
+        
+        # Добавляем запуск в индекс результатов для истории загрузок; по ключу
+        # кэша повторная загрузка тех же данных найдет этот результат
+        try:
+            with results_write_lock:
+                append_results_manifest(results_dir, results_manifest_entry(
+                    rfm_df, result_file, source_file=file_name,
+                    duration=time.perf_counter() - started, cache_key=cache_key))
+        except Exception as e:
+            print(f"Не удалось обновить индекс результатов: {str(e)}")
+        
+        # Обновляем исходную страницу index.html, чтобы добавить ссылку на дашборд
+        try:
+            ensure_dashboard_link_in_index()
+        except Exception as e:
+            print(f"Не удалось добавить ссылку на дашборд: {str(e)}")
         
-        elif self.path.startswith('/dashboard/'):
-            # Обработка файлов дашборда
-            file_path = os.path.join("static", self.path[1:])
-            print(f"Запрос файла дашборда: {file_path}")
+        update_job(job_id, status='done', stage='Готово', progress=100.0, result=rfm_result,
+                   result_file=os.path.basename(result_file), finished_at=time.time())
+    except Exception as e:
+        print(f"Ошибка в функции rfm_analysis: {str(e)}")
+        traceback.print_exc()  # Печатаем полный стек ошибки
+        update_job(job_id, status='error', stage='Ошибка', error=str(e), finished_at=time.time())
+    
+    try:
+        evict_cached_files()
+    except Exception as e:
+        print(f"Ошибка при удалении старых файлов: {str(e)}")
+
+
+def ensure_dashboard_link_in_index():
+    """Убеждаемся, что в index.html есть ссылка на дашборд"""
+    index_path = "static/index.html"
+    
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        
+        # Проверяем, есть ли ссылка на дашборд
+        if '<a href="/dashboard"' not in content and 'id="results-card"' in content:
+            # Добавляем ссылку на дашборд
+            dashboard_link = '\n<div class="text-center mt-4">\n<a href="/dashboard" class="bg-blue-500 text-white px-4 py-2 rounded hover:bg-blue-600">Открыть расширенный дашборд</a>\n</div>\n'
             
-            try:
-                with open(file_path, "rb") as f:
-                    content = f.read()
-                    self.send_response(200)
-                    
-                    # Установка правильного типа содержимого
-                    if file_path.endswith('.jsx'):
-                        self.send_header("Content-type", "text/babel")
-                    elif file_path.endswith('.js'):
-                        self.send_header("Content-type", "application/javascript")
-                    elif file_path.endswith('.css'):
-                        self.send_header("Content-type", "text/css")
-                    elif file_path.endswith('.json'):
-                        self.send_header("Content-type", "application/json")
-                    elif file_path.endswith('.html'):
-                        self.send_header("Content-type", "text/html")
-                    else:
-                        self.send_header("Content-type", "text/plain")
+            # Находим место для вставки ссылки
+            results_end_pos = content.find('</div>', content.find('id="results-card"'))
+            if results_end_pos != -1:
+                new_content = content[:results_end_pos] + dashboard_link + content[results_end_pos:]
+                
+                # Сохраняем обновленный файл
+                with open(index_path, "w", encoding="utf-8") as f:
+                    f.write(new_content)
                     
-                    self.end_headers()
-                    self.wfile.write(content)
-                    print(f"Файл {file_path} успешно отправлен ({len(content)} байт)")
-            
-            except FileNotFoundError:
-                print(f"Файл не найден: {file_path}")
-                self.send_response(404)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(f"404 - File not found: {file_path}".encode())
-            
-            except Exception as e:
-                print(f"Ошибка при обработке {file_path}: {str(e)}")
-                self.send_response(500)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(f"500 - Server error: {str(e)}".encode())
+                print("Ссылка на дашборд добавлена в index.html")
+    except Exception as e:
+        print(f"Ошибка при обновлении index.html: {str(e)}")
+        # Не останавливаем основной процесс из-за ошибки
+        pass
+
+
+def static_file_path(url_path):
+    """Возвращает путь к статическому файлу для URL или None, если URL не относится к статике"""
+    if url_path == '/':
+        relative_path = 'index.html'
+    elif url_path == '/dashboard':
+        relative_path = 'dashboard/index.html'
+    elif url_path == '/style.css' or url_path.startswith('/dashboard/'):
+        relative_path = unquote(url_path[1:])
+    else:
+        return None
+    
+    # Пути вида /dashboard/../server.py не выходят за пределы STATIC_DIR
+    file_path = os.path.normpath(os.path.join(STATIC_DIR, relative_path))
+    if not file_path.startswith(os.path.join(STATIC_DIR, '')):
+        return None
+    return file_path
+
+
+def compress_static(content):
+    """Возвращает сжатые варианты файла (gzip и, если доступен, br), если они меньше исходного"""
+    encodings = {}
+    if len(content) < STATIC_MIN_COMPRESS_SIZE:
+        return encodings
+    
+    compressed = gzip.compress(content, compresslevel=9, mtime=0)
+    if len(compressed) < len(content):
+        encodings['gzip'] = compressed
+    if brotli is not None:
+        compressed = brotli.compress(content, quality=11)
+        if len(compressed) < len(content):
+            encodings['br'] = compressed
+    return encodings
+
+
+def load_static_asset(file_path, url_path):
+    """
+    Возвращает статический файл из кэша в памяти или None, если файла нет.
+    
+    Файл перечитывается и заново сжимается, когда меняются его время изменения
+    или размер. В HTML к ссылкам на локальные скрипты и стили добавляется
+    ?v=<версия файла>, поэтому страница пересобирается и при изменении
+    подключенных файлов.
+    
+    Parameters:
+    -----------
+    file_path : str
+        Путь к файлу в STATIC_DIR.
+    url_path : str
+        URL файла, относительно которого разрешаются ссылки в HTML.
+    
+    Returns:
+    --------
+    dict or None
+        body, encodings (сжатые варианты по Content-Encoding), version
+        (хэш содержимого), content_type, last_modified.
+    """
+    if not os.path.isfile(file_path):
+        return None
+    stat = os.stat(file_path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    
+    with static_assets_lock:
+        asset = static_assets.get(file_path)
+    if asset is not None and asset['key'] == key and all(
+            (load_static_asset(dep_path, dep_url) or {}).get('version') == dep_version
+            for dep_path, (dep_url, dep_version) in asset['deps'].items()):
+        with static_assets_lock:
+            static_assets_stats['hits'] += 1
+        return asset
+    
+    with static_assets_lock:
+        static_assets_stats['misses'] += 1
+    with open(file_path, "rb") as f:
+        body = f.read()
+    
+    deps = {}
+    if file_path.endswith('.html'):
+        def add_version(match):
+            dep_url = urljoin(url_path, match.group(2))
+            dep_path = static_file_path(dep_url)
+            dep = load_static_asset(dep_path, dep_url) if dep_path else None
+            if dep is None:
+                return match.group(0)
+            deps[dep_path] = (dep_url, dep['version'])
+            return f'{match.group(1)}{match.group(2)}?v={dep["version"]}"'
         
-        elif self.path == '/api/rfm-data':
+        body = STATIC_REFERENCE_PATTERN.sub(add_version, body.decode('utf-8')).encode('utf-8')
+    
+    asset = {
+        'key': key,
+        'deps': deps,
+        'body': body,
+        'encodings': compress_static(body),
+        'version': hashlib.sha256(body).hexdigest()[:20],
+        'content_type': STATIC_CONTENT_TYPES.get(os.path.splitext(file_path)[1].lower(), 'text/plain'),
+        'last_modified': email.utils.formatdate(stat.st_mtime, usegmt=True)
+    }
+    with static_assets_lock:
+        static_assets[file_path] = asset
+    return asset
+
+
+def parse_accept(header):
+    """Возвращает множество значений заголовка Accept или Accept-Encoding с ненулевым q"""
+    accepted = set()
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def choose_static_encoding(accept_encoding, encodings):
+    """Выбирает сжатый вариант по заголовку Accept-Encoding (br предпочтительнее gzip) или None"""
+    accepted = parse_accept(accept_encoding)
+    for encoding in ('br', 'gzip'):
+        if encoding in encodings and encoding in accepted:
+            return encoding
+    return None
+
+
+class SimpleHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def do_GET(self):
+        url_path = urlsplit(self.path).path
+        static_path = static_file_path(url_path)
+        if static_path is not None:
+            # Статические файлы отдаются из памяти без записи в журнал
+            version = parse_qs(urlsplit(self.path).query).get('v', [None])[0]
+            self.send_static_asset(static_path, url_path, version)
+            return
+        
+        print(f"Запрос: GET {self.path}")
+        
+        if self.path == '/api/rfm-data':
             # API для получения данных RFM-анализа
             print("Запрос API: /api/rfm-data")
             self.handle_rfm_data_api()
         
+        elif urlsplit(self.path).path == '/api/customers':
+            # API для постраничного получения клиентов
+            print("Запрос API: /api/customers")
+            self.handle_customers_api()
+        
+        elif self.path == '/api/aggregates' or self.path.startswith('/api/aggregates/'):
+            # API сводных агрегатов для графиков дашборда
+            print(f"Запрос API: {self.path}")
+            self.handle_aggregates_api(self.path[len('/api/aggregates/'):])
+        
+        elif urlsplit(self.path).path == '/api/scatter':
+            # Прореженные данные диаграммы Frequency vs Monetary
+            print(f"Запрос API: {self.path}")
+            self.handle_scatter_api()
+        
+        elif self.path.startswith('/api/jobs/'):
+            # Статус и ход фоновой задачи анализа
+            job = get_job(self.path[len('/api/jobs/'):])
+            if job is None:
+                self.send_response(404)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps({"error": "Job not found"}).encode())
+                return
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(json.dumps(job).encode())
+        
+        elif self.path == '/api/cache-stats':
+            # Счетчики кэша API
+            with rfm_data_cache_lock:
+                rfm_data_stats = {name: rfm_data_cache[name] for name in ('hits', 'misses', 'not_modified')}
+            with static_assets_lock:
+                static_stats = dict(static_assets_stats)
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({
+                "rfm_data": rfm_data_stats,
+                "static": static_stats
+            }).encode())
+        
         elif self.path == '/api/upload-history':
             # API для получения истории загрузок
             print("Запрос API: /api/upload-history")
@@ -162,85 +929,464 @@ class SimpleHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(b"404 - Not Found")
 
+    def send_static_asset(self, file_path, url_path, version=None):
+        """
+        Отправляет статический файл из памяти: сжатый вариант, если клиент его
+        принимает, или 304, если у клиента та же версия.
+        """
+        asset = load_static_asset(file_path, url_path)
+        if asset is None:
+            print(f"Файл не найден: {file_path}")
+            self.send_response(404)
+            self.send_header("Content-type", "text/plain")
+            self.end_headers()
+            self.wfile.write(f"404 - File not found: {url_path}".encode())
+            return
+        
+        encoding = choose_static_encoding(self.headers.get('Accept-Encoding', ''), asset['encodings'])
+        body = asset['encodings'][encoding] if encoding else asset['body']
+        etag = f'"{asset["version"]}-{encoding}"' if encoding else f'"{asset["version"]}"'
+        
+        # Файл, запрошенный по ссылке с текущей версией (?v=), не изменится,
+        # остальные браузер перепроверяет по ETag при каждом использовании
+        if version == asset['version']:
+            cache_control = f"public, max-age={STATIC_MAX_AGE}, immutable"
+        else:
+            cache_control = "no-cache"
+        
+        if etag in self.headers.get('If-None-Match', ''):
+            with static_assets_lock:
+                static_assets_stats['not_modified'] += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-type", asset['content_type'])
+        self.send_header("Content-Length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", asset['last_modified'])
+        self.send_header("Cache-Control", cache_control)
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
     def handle_rfm_data_api(self):
         """Обработчик API для получения данных RFM-анализа"""
-        # Получаем последний файл результатов
-        results_dir = "results"
-        if os.path.exists(results_dir):
-            files = sorted(
-                [f for f in os.listdir(results_dir) if f.startswith('rfm_results_')],
-                key=lambda x: os.path.getmtime(os.path.join(results_dir, x)),
-                reverse=True
-            )
-            
-            if files:
-                latest_file = os.path.join(results_dir, files[0])
-                try:
-                    # Читаем CSV файл
-                    rfm_df = pd.read_csv(latest_file)
-                    
-                    # Преобразуем в формат JSON
-                    rfm_data = {
-                        "customers": rfm_df.to_dict(orient='records'),
-                        "summary": {
-                            "total_customers": int(rfm_df[rfm_df.columns[0]].nunique()),
-                            "total_revenue": float(rfm_df['Monetary'].sum()),
-                            "avg_recency": float(rfm_df['Recency'].mean()),
-                            "avg_frequency": float(rfm_df['Frequency'].mean()),
-                            "avg_monetary": float(rfm_df['Monetary_Mean'].mean())
-                        },
-                        "segments": rfm_df.groupby('Customer_Segment').size().to_dict(),
-                        "rfm_scores": rfm_df.groupby('RFM_Score').size().to_dict()
-                    }
-                    
-                    self.send_response(200)
+        with rfm_data_cache_lock:
+            try:
+                response = self.get_rfm_data_response()
+            except Exception as e:
+                print(f"Error processing RFM data: {str(e)}")
+                traceback.print_exc()
+                response = None
+        
+        self.send_cached_json(response)
+
+    def handle_aggregates_api(self, part):
+        """
+        Обработчик API сводных агрегатов последнего результата.
+        
+        Без части возвращается весь набор, иначе одна из AGGREGATE_PARTS:
+        summary, segments, rank-cube, histograms или scores.
+        """
+        if part and part not in AGGREGATE_PARTS:
+            self.send_response(404)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": f"Unknown aggregate: {part}"}).encode())
+            return
+        
+        with rfm_data_cache_lock:
+            try:
+                aggregates = self.get_rfm_aggregates()
+                response = None
+                if aggregates is not None:
+                    bodies = rfm_data_cache['aggregate_bodies']
+                    if part not in bodies:
+                        bodies[part] = json.dumps(aggregates[AGGREGATE_PARTS[part]] if part else aggregates).encode()
+                    etag = rfm_data_cache['etag']
+                    response = bodies[part], etag[:-1] + (f'-{part}"' if part else '-all"')
+            except Exception as e:
+                print(f"Error processing RFM aggregates: {str(e)}")
+                traceback.print_exc()
+                response = None
+        
+        self.send_cached_json(response)
+
+    def handle_scatter_api(self):
+        """
+        Обработчик API диаграммы Frequency vs Monetary с прореживанием на сервере.
+        
+        mode=sample (по умолчанию) - стратифицированная по сегментам выборка
+        не больше max_points клиентов: JSON по столбцам или Arrow IPC, если
+        клиент указал его в Accept. mode=density - сетка bins x bins с числом
+        клиентов и средним Recency в ячейке. Ответ рассчитывается один раз для
+        файла результатов и параметров.
+        """
+        query = {name: values[-1] for name, values in parse_qs(urlsplit(self.path).query).items()}
+        try:
+            mode = query.get('mode', 'sample')
+            if mode not in SCATTER_MODES:
+                raise ValueError(f"Неизвестный режим: {mode}")
+            if mode == 'sample':
+                size = min(max(int(query.get('max_points', SCATTER_MAX_POINTS)), 1), SCATTER_MAX_POINTS_LIMIT)
+            else:
+                size = min(max(int(query.get('bins', SCATTER_BINS)), 2), SCATTER_BINS_LIMIT)
+        except ValueError as e:
+            self.send_response(400)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": str(e)}).encode())
+            return
+        
+        use_arrow = mode == 'sample' and pq is not None and ARROW_STREAM_TYPE in parse_accept(self.headers.get('Accept', ''))
+        content_type = ARROW_STREAM_TYPE if use_arrow else "application/json"
+        with rfm_data_cache_lock:
+            try:
+                rfm_df = self.get_rfm_frame()
+                response = None
+                if rfm_df is not None:
+                    key = f"{mode}-{size}-{'arrow' if use_arrow else 'json'}"
+                    bodies = rfm_data_cache['scatter_bodies']
+                    if key not in bodies:
+                        if mode == 'density':
+                            bodies[key] = json.dumps(rfm_density_grid(rfm_df, bins=size)).encode()
+                        else:
+                            positions = rfm_sample_positions(rfm_df, size)
+                            envelope = {"mode": mode, "total": len(rfm_df), "sampled": len(positions)}
+                            if use_arrow:
+                                bodies[key] = b''.join(iter_rfm_arrow(
+                                    self.get_rfm_arrow_table(), positions, SCATTER_COLUMNS, envelope))
+                            else:
+                                bodies[key] = b''.join(iter_rfm_json(
+                                    rfm_df, positions, SCATTER_COLUMNS, 'columns', envelope))
+                    response = bodies[key], rfm_data_cache['etag'][:-1] + f'-scatter-{key}"'
+            except Exception as e:
+                print(f"Error processing scatter data: {str(e)}")
+                traceback.print_exc()
+                response = None
+        
+        self.send_cached_json(response, content_type)
+
+    def send_cached_json(self, response, content_type="application/json"):
+        """Отправляет закэшированный ответ (по умолчанию JSON) с ETag; 304, если у клиента та же версия, и 404, если данных нет"""
+        if response is None:
+            self.send_response(404)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": "No RFM data found"}).encode())
+            return
+        
+        body, etag = response
+        if self.headers.get('If-None-Match') == etag:
+            # Данные не изменились с прошлого запроса дашборда
+            with rfm_data_cache_lock:
+                rfm_data_cache['not_modified'] += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def refresh_rfm_cache(self):
+        """Возвращает путь к последнему результату, сбрасывая кэш, если файл изменился"""
+        latest_file = find_latest_results_file()
+        if latest_file is None:
+            return None
+        
+        stat = os.stat(latest_file)
+        key = (latest_file, stat.st_mtime_ns, stat.st_size)
+        if rfm_data_cache['key'] == key:
+            rfm_data_cache['hits'] += 1
+            return latest_file
+        
+        rfm_data_cache['misses'] += 1
+        print(f"Кэш результатов устарел: {latest_file}")
+        
+        # Файл результатов, агрегаты, JSON и индексы читаются и строятся при первом обращении
+        rfm_data_cache.update({
+            'key': key,
+            'frame': None,
+            'aggregates': None,
+            'aggregate_bodies': {},
+            'sort_orders': {},
+            'segment_positions': None,
+            'arrow_table': None,
+            'scatter_bodies': {},
+            'body': None,
+            'etag': '"%x-%x-%x"' % (zlib.crc32(latest_file.encode()), stat.st_mtime_ns, stat.st_size)
+        })
+        return latest_file
+
+    def get_rfm_frame(self):
+        """Возвращает последний результат из кэша, перечитывая файл только при его изменении"""
+        latest_file = self.refresh_rfm_cache()
+        if latest_file is None:
+            return None
+        
+        if rfm_data_cache['frame'] is None:
+            print(f"Читаем {latest_file}")
+            rfm_data_cache['frame'] = load_rfm_results(latest_file)
+        return rfm_data_cache['frame']
+
+    def get_rfm_arrow_table(self):
+        """Возвращает последний результат в виде таблицы Arrow; строится один раз для файла результатов"""
+        if rfm_data_cache['arrow_table'] is None:
+            rfm_data_cache['arrow_table'] = rfm_arrow_table(rfm_data_cache['frame'])
+        return rfm_data_cache['arrow_table']
+
+    def get_rfm_aggregates(self):
+        """
+        Возвращает сводные агрегаты последнего результата.
+        
+        Агрегаты читаются из файла рядом с результатами; для результатов,
+        сохраненных без агрегатов, они рассчитываются один раз и сохраняются.
+        """
+        latest_file = self.refresh_rfm_cache()
+        if latest_file is None:
+            return None
+        
+        if rfm_data_cache['aggregates'] is None:
+            rfm_data_cache['aggregates'] = results_aggregates(latest_file)
+        return rfm_data_cache['aggregates']
+
+    def get_rfm_data_response(self):
+        """Возвращает JSON сводки последнего результата и его ETag, пересчитывая их при изменении файла"""
+        aggregates = self.get_rfm_aggregates()
+        if aggregates is None:
+            return None
+        
+        if rfm_data_cache['body'] is None:
+            # Сводка собирается из агрегатов и не зависит от числа клиентов;
+            # таблица клиентов загружается постранично через /api/customers
+            segments = aggregates['segments']
+            rfm_data = {
+                "summary": aggregates['summary'],
+                "segments": {label: stats['count'] for label, stats in segments.items()},
+                "segment_revenue": {label: stats['revenue'] for label, stats in segments.items()},
+                "rfm_scores": aggregates['scores']['RFM_Score']
+            }
+            rfm_data_cache['body'] = json.dumps(rfm_data).encode()
+        
+        return rfm_data_cache['body'], rfm_data_cache['etag']
+
+    def handle_customers_api(self):
+        """
+        Обработчик API для постраничного получения клиентов.
+        
+        Параметры запроса: offset, limit, segment, score_min, score_max,
+        sort (столбец), order (asc/desc), columns (через запятую),
+        layout (records или columns - по массиву на столбец) и format=csv,
+        format=json или format=arrow для выгрузки отобранных строк (всех, если
+        не задан limit). Выгрузка передается по частям по мере кодирования.
+        
+        Страницы и выгрузка JSON отдаются в формате Arrow IPC, если клиент
+        указал его в заголовке Accept.
+        """
+        query = {name: values[-1] for name, values in parse_qs(urlsplit(self.path).query).items()}
+        export_format = query.get('format')
+        use_arrow = export_format == 'arrow' or (
+            export_format in (None, 'json') and pq is not None
+            and ARROW_STREAM_TYPE in parse_accept(self.headers.get('Accept', '')))
+        try:
+            if export_format not in (None, 'csv', 'json', 'arrow'):
+                raise ValueError(f"Неизвестный формат: {export_format}")
+            with rfm_data_cache_lock:
+                rfm_df = self.get_rfm_frame()
+                if rfm_df is None:
+                    self.send_response(404)
                     self.send_header("Content-type", "application/json")
                     self.end_headers()
-                    self.wfile.write(json.dumps(rfm_data).encode())
+                    self.wfile.write(json.dumps({"error": "No RFM data found"}).encode())
                     return
-                except Exception as e:
-                    print(f"Error processing RFM data: {str(e)}")
-                    traceback.print_exc()
+                positions = self.select_customers(rfm_df, query)
+                arrow_table = self.get_rfm_arrow_table() if use_arrow else None
+            
+            id_column = rfm_df.columns[0]
+            columns = list(rfm_df.columns)
+            if query.get('columns'):
+                requested = [column for column in query['columns'].split(',') if column]
+                unknown = [column for column in requested if column not in rfm_df.columns]
+                if unknown:
+                    raise ValueError(f"Неизвестные столбцы: {', '.join(unknown)}")
+                columns = list(dict.fromkeys([id_column] + requested))
+            
+            layout = query.get('layout', 'records')
+            if layout not in JSON_LAYOUTS:
+                raise ValueError(f"Неизвестная раскладка: {layout}")
+            
+            # Страница ограничена CUSTOMERS_MAX_PAGE_SIZE строками, выгрузка - только limit
+            offset = max(int(query.get('offset', 0)), 0)
+            if export_format is None:
+                limit = min(max(int(query.get('limit', CUSTOMERS_PAGE_SIZE)), 0), CUSTOMERS_MAX_PAGE_SIZE)
+            else:
+                limit = max(int(query.get('limit', len(positions))), 0)
+            page = positions[offset:offset + limit]
+            
+            if export_format == 'csv':
+                self.send_stream(iter_rfm_csv(rfm_df, page, columns), "text/csv; charset=utf-8",
+                                 {"Content-Disposition": 'attachment; filename="rfm_export.csv"'})
+                return
+            
+            if use_arrow:
+                # Столбцы таблицы Arrow ссылаются на буферы результата; подряд идущие
+                # строки передаются срезом без копирования
+                metadata = {"total": len(positions), "offset": offset, "limit": limit, "id_column": id_column}
+                self.send_stream(iter_rfm_arrow(arrow_table, page, columns, metadata), ARROW_STREAM_TYPE)
+                return
+            
+            if export_format == 'json':
+                envelope = {"total": int(len(positions)), "id_column": id_column, "columns": columns}
+                self.send_stream(iter_rfm_json(rfm_df, page, columns, layout, envelope),
+                                 "application/json; charset=utf-8",
+                                 {"Content-Disposition": 'attachment; filename="rfm_export.json"'})
+                return
+            
+            body = b''.join(iter_rfm_json(rfm_df, page, columns, layout, {
+                "total": int(len(positions)),
+                "offset": offset,
+                "limit": limit,
+                "id_column": id_column,
+                "columns": columns
+            }))
+        except ValueError as e:
+            self.send_response(400)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"error": str(e)}).encode())
+            return
         
-        self.send_response(404)
+        self.send_response(200)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept")
         self.end_headers()
-        self.wfile.write(json.dumps({"error": "No RFM data found"}).encode())
+        self.wfile.write(body)
+
+    def send_stream(self, chunks, content_type, headers=None):
+        """
+        Отправляет ответ по мере получения частей, без Content-Length.
+        
+        Клиентам HTTP/1.1 ответ передается с Transfer-Encoding: chunked,
+        клиентам HTTP/1.0 - до закрытия соединения. Если клиент принимает
+        gzip, поток сжимается на лету.
+        """
+        compress = 'gzip' in parse_accept(self.headers.get('Accept-Encoding', ''))
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            # Сервер отвечает по HTTP/1.0, chunked требует HTTP/1.1 в строке статуса
+            self.protocol_version = 'HTTP/1.1'
+        
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept, Accept-Encoding")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        
+        compressor = zlib.compressobj(STREAM_GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+        
+        def write(data):
+            if not data:
+                return
+            if chunked:
+                self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+            else:
+                self.wfile.write(data)
+        
+        try:
+            for chunk in chunks:
+                write(compressor.compress(chunk) if compressor else chunk)
+            if compressor:
+                write(compressor.flush())
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            print("Клиент закрыл соединение во время выгрузки")
+        except Exception as e:
+            # Заголовки уже отправлены: обрываем ответ, клиент увидит неполный поток
+            print(f"Ошибка при выгрузке: {str(e)}")
+            traceback.print_exc()
+
+    def select_customers(self, rfm_df, query):
+        """
+        Возвращает позиции клиентов, отобранных фильтрами, в порядке сортировки.
+        
+        Позиции клиентов по сегментам и порядок сортировки по каждому столбцу
+        вычисляются один раз для файла результатов и хранятся в кэше, поэтому
+        запрос страницы не сортирует таблицу.
+        """
+        n = len(rfm_df)
+        mask = None
+        
+        segment = query.get('segment')
+        if segment and segment != 'all':
+            if rfm_data_cache['segment_positions'] is None:
+                rfm_data_cache['segment_positions'] = {
+                    str(name): positions
+                    for name, positions in rfm_df.groupby('Customer_Segment', observed=True).indices.items()
+                }
+            mask = np.zeros(n, dtype=bool)
+            mask[rfm_data_cache['segment_positions'].get(segment, [])] = True
+        
+        if query.get('score_min') or query.get('score_max'):
+            scores = rfm_df['RFM_Score'].to_numpy()
+            score_mask = np.ones(n, dtype=bool)
+            if query.get('score_min'):
+                score_mask &= scores >= int(query['score_min'])
+            if query.get('score_max'):
+                score_mask &= scores <= int(query['score_max'])
+            mask = score_mask if mask is None else mask & score_mask
+        
+        sort_column = query.get('sort')
+        if not sort_column:
+            return np.arange(n) if mask is None else np.flatnonzero(mask)
+        
+        if sort_column not in rfm_df.columns:
+            raise ValueError(f"Неизвестный столбец сортировки: {sort_column}")
+        descending = query.get('order', 'asc') == 'desc'
+        if sort_column not in rfm_data_cache['sort_orders']:
+            values = rfm_df[sort_column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype(str)
+            rfm_data_cache['sort_orders'][sort_column] = np.argsort(values.to_numpy(), kind='stable')
+        order = rfm_data_cache['sort_orders'][sort_column]
+        if descending:
+            order = order[::-1]
+        
+        return order if mask is None else order[mask[order]]
 
     def handle_upload_history_api(self):
         """Обработчик API для получения истории загрузок"""
-        results_dir = "results"
-        if os.path.exists(results_dir):
+        if os.path.exists(RESULTS_DIR):
             try:
-                # Получаем список файлов с результатами
-                files = [f for f in os.listdir(results_dir) if f.startswith('rfm_results_')]
-                upload_history = []
-                
-                for i, filename in enumerate(files):
-                    timestamp = filename.split('_')[-1].split('.')[0]
-                    date_str = datetime.fromtimestamp(int(timestamp)).strftime('%d.%m.%Y')
-                    
-                    # Читаем краткую информацию из файла
-                    file_path = os.path.join(results_dir, filename)
-                    try:
-                        rfm_df = pd.read_csv(file_path)
-                        segment_count = rfm_df['Customer_Segment'].nunique()
-                        record_count = len(rfm_df)
-                        
-                        upload_history.append({
-                            "id": i + 1,
-                            "filename": filename,
-                            "date": date_str,
-                            "records": record_count,
-                            "segments": segment_count
-                        })
-                    except Exception as e:
-                        print(f"Ошибка при чтении файла {filename}: {str(e)}")
+                # История берется из индекса результатов, файлы результатов не читаются
+                with upload_history_cache_lock:
+                    body = self.get_upload_history_response()
                 
                 self.send_response(200)
                 self.send_header("Content-type", "application/json")
                 self.end_headers()
-                self.wfile.write(json.dumps(upload_history).encode())
+                self.wfile.write(body)
                 return
             except Exception as e:
                 print(f"Ошибка при получении истории загрузок: {str(e)}")
@@ -252,11 +1398,48 @@ class SimpleHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(json.dumps([]).encode())
 
+    def get_upload_history_response(self):
+        """Возвращает JSON истории загрузок, дочитывая из индекса только новые записи"""
+        manifest_path = os.path.join(RESULTS_DIR, RESULTS_MANIFEST_NAME)
+        try:
+            stat = os.stat(manifest_path)
+        except FileNotFoundError:
+            return json.dumps([]).encode()
+        
+        # Индекс перестроен (новый файл) или усечен - читаем его заново
+        if stat.st_ino != upload_history_cache['inode'] or stat.st_size < upload_history_cache['offset']:
+            upload_history_cache.update({'inode': stat.st_ino, 'offset': 0, 'entries': [], 'body': None})
+        
+        if stat.st_size > upload_history_cache['offset'] or upload_history_cache['body'] is None:
+            with open(manifest_path, 'rb') as f:
+                f.seek(upload_history_cache['offset'])
+                data = f.read()
+            # Последняя строка может быть еще не дописана
+            complete = data[:data.rfind(b'\n') + 1]
+            upload_history_cache['offset'] += len(complete)
+            
+            for line in complete.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                upload_history_cache['entries'].append({
+                    "id": len(upload_history_cache['entries']) + 1,
+                    "filename": entry['result_file'],
+                    "date": datetime.fromtimestamp(entry['created_at']).strftime('%d.%m.%Y'),
+                    "records": entry['records'],
+                    "segments": len(entry['segments'])
+                })
+            upload_history_cache['body'] = json.dumps(upload_history_cache['entries']).encode()
+        
+        return upload_history_cache['body']
+
     def do_POST(self):
         try:
             content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             content_type = self.headers.get('Content-Type', '')
+            # Тело загрузки файла разбирается потоково в обработчике /upload
+            post_data = self.rfile.read(content_length) if self.path != '/upload' else None
 
             if self.path == '/register':
                 if not firebase_admin_imported:
@@ -320,86 +1503,109 @@ class SimpleHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                     self.wfile.write(json.dumps({"status": "error", "message": "Требуется авторизация"}).encode())
                     return
                 
-                # Исправленный парсинг multipart/form-data
-                if 'multipart/form-data' in content_type:
-                    # Извлекаем boundary, обрабатываем кавычки
-                    boundary = content_type.split('boundary=')[1]
-                    if boundary.startswith('"') and boundary.endswith('"'):
-                        boundary = boundary[1:-1]
-                    boundary = boundary.encode()
-                    
-                    # Правильный разбор многокомпонентных данных формы
-                    parts = post_data.split(b'--' + boundary)
-                    file_data = None
-                    customer_col, date_col, amount_col = None, None, None
-                    
-                    for part in parts:
-                        if b'Content-Disposition: form-data' not in part:
-                            continue
-                            
-                        # Извлекаем имя поля формы
-                        header_end = part.find(b'\r\n\r\n')
-                        if header_end == -1:
-                            continue
-                            
-                        headers = part[:header_end].decode('utf-8', errors='ignore')
-                        body = part[header_end + 4:]
-                        
-                        # Удаляем трейлер в конце, если есть
-                        if body.endswith(b'\r\n'):
-                            body = body[:-2]
-                        
-                        if 'name="file"' in headers:
-                            file_data = body
-                        elif 'name="customer_col"' in headers:
-                            customer_col = body.decode('utf-8', errors='ignore').strip()
-                            print(f"Selected customer_col: {customer_col}")
-                        elif 'name="date_col"' in headers:
-                            date_col = body.decode('utf-8', errors='ignore').strip()
-                            print(f"Selected date_col: {date_col}")
-                        elif 'name="amount_col"' in headers:
-                            amount_col = body.decode('utf-8', errors='ignore').strip()
-                            print(f"Selected amount_col: {amount_col}")
-                else:
+                # Извлекаем boundary; без него тело формы разобрать нельзя
+                boundary = multipart_boundary(content_type)
+                if boundary is None:
                     self.send_response(400)
                     self.send_header("Content-type", "application/json")
                     self.end_headers()
-                    self.wfile.write(json.dumps({"status": "error", "message": "Неверный формат данных"}).encode())
+                    self.wfile.write(json.dumps({"status": "error", "message": "Неверный формат данных: ожидается multipart/form-data с boundary"}).encode())
+                    return
+                
+                if content_length > MAX_UPLOAD_SIZE:
+                    self.send_response(413)
+                    self.send_header("Content-type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(json.dumps({"status": "error", "message": f"Файл больше {MAX_UPLOAD_SIZE // 1024 ** 2} МБ"}).encode())
                     return
+                
+                # Файл из формы записывается на диск по мере чтения тела запроса;
+                # формат (и расширение) становится известен по первым байтам
+                job_id = uuid.uuid4().hex
+                os.makedirs(UPLOADS_DIR, exist_ok=True)
+                file_stem = os.path.join(UPLOADS_DIR, f"upload_{int(datetime.now().timestamp())}_{job_id[:8]}")
+                try:
+                    fields, file_size, file_head, file_hash = read_multipart_upload(
+                        self.rfile, content_length, boundary, 'file', file_stem + '.part')
+                except ValueError as e:
+                    if os.path.exists(file_stem + '.part'):
+                        os.remove(file_stem + '.part')
+                    self.send_response(400)
+                    self.send_header("Content-type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
+                    return
+                
+                customer_col = fields.get('customer_col', '').strip()
+                date_col = fields.get('date_col', '').strip()
+                amount_col = fields.get('amount_col', '').strip()
+                print(f"Selected customer_col: {customer_col}")
+                print(f"Selected date_col: {date_col}")
+                print(f"Selected amount_col: {amount_col}")
 
-                if not file_data or not customer_col or not date_col or not amount_col:
+                try:
+                    if not file_size or not customer_col or not date_col or not amount_col:
+                        raise ValueError("Не указаны все необходимые данные")
+                    analysis_params = parse_analysis_params(fields)
+                except ValueError as e:
+                    if file_size is not None:
+                        os.remove(file_stem + '.part')
                     self.send_response(400)
                     self.send_header("Content-type", "application/json")
                     self.end_headers()
-                    self.wfile.write(json.dumps({"status": "error", "message": "Не указаны все необходимые данные"}).encode())
+                    self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
                     return
                 
-                # Сохраняем файл
-                file_name = f"upload_{int(datetime.now().timestamp())}.csv"
-                with open(file_name, "wb") as f:
-                    f.write(file_data)
+                # Файлы Parquet (сигнатура PAR1) анализируются без разбора CSV
+                is_parquet = file_head == b'PAR1'
+                file_name = store_upload(file_stem + '.part', file_hash, is_parquet)
                 
-                print(f"Сохранён файл {file_name} размером {len(file_data)} байт")
+                print(f"Сохранён файл {file_name} размером {file_size} байт")
                 
-                # Пытаемся прочитать файл с разными кодировками
+                # Те же данные с теми же параметрами уже анализируются или проанализированы
+                cache_key = analysis_cache_key(file_hash, customer_col, date_col, amount_col, analysis_params)
+                active_job_id = find_active_job(cache_key)
+                if active_job_id is not None:
+                    print(f"Такой же анализ уже выполняется: задача {active_job_id}")
+                    self.send_job_response(202, active_job_id, "queued")
+                    return
+                
+                cached_entry = find_cached_result(cache_key)
+                if cached_entry is not None:
+                    print(f"Результат найден в кэше: {cached_entry['result_file']}")
+                    rfm_result = reuse_cached_result(cached_entry)
+                    create_job(job_id, file_name, cache_key, result_file=cached_entry['result_file'], result=rfm_result)
+                    self.send_job_response(200, job_id, "done", cached=True)
+                    return
+                
+                # Кодировка, разделитель и десятичный знак CSV определяются по выборке
+                # из файла, и анализ затем разбирает файл один раз; здесь читается
+                # только начало. Для Parquet достаточно схемы файла
+                read_csv_kwargs = None
+                data = None
                 try:
-                    data = pd.read_csv(file_name, encoding='utf-8')
-                except UnicodeDecodeError:
-                    try:
-                        data = pd.read_csv(file_name, encoding='latin-1')
-                    except Exception as e:
-                        print(f"Ошибка при чтении CSV: {str(e)}")
-                        self.send_response(400)
-                        self.send_header("Content-type", "application/json")
-                        self.end_headers()
-                        self.wfile.write(json.dumps({"status": "error", "message": f"Ошибка при чтении CSV: {str(e)}"}).encode())
-                        return
+                    if is_parquet:
+                        if pq is None:
+                            raise ValueError("для файлов Parquet требуется пакет pyarrow")
+                        data_columns = pq.read_schema(file_name).names
+                    else:
+                        read_csv_kwargs = sniff_csv_format(file_name)
+                        print(f"Параметры CSV: {read_csv_kwargs}")
+                        data = pd.read_csv(file_name, nrows=5, **read_csv_kwargs)
+                        data_columns = list(data.columns)
+                except Exception as e:
+                    print(f"Ошибка при чтении файла: {str(e)}")
+                    self.send_response(400)
+                    self.send_header("Content-type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(json.dumps({"status": "error", "message": f"Ошибка при чтении файла: {str(e)}"}).encode())
+                    return
                 
-                print(f"Колонки в CSV: {list(data.columns)}")
+                print(f"Колонки в файле: {data_columns}")
                 
                 # Проверяем наличие необходимых колонок
                 required_cols = {customer_col, date_col, amount_col}
-                actual_cols = set(data.columns)
+                actual_cols = set(data_columns)
                 print(f"Требуемые колонки: {required_cols}")
                 print(f"Колонки в данных: {actual_cols}")
                 
@@ -412,71 +1618,21 @@ class SimpleHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                     return
                 
                 # Дополнительная диагностика
-                print(f"Первые 5 строк данных:\n{data.head()}")
+                if data is not None:
+                    print(f"Первые 5 строк данных:\n{data.head()}")
                 
-                try:
-                    rfm_df, additional_info = rfm_analysis(data, date_col, customer_col, amount_col)
-                    rfm_result = {
-                        "total_customers": int(rfm_df[customer_col].nunique()),
-                        "total_revenue": float(rfm_df['Monetary'].sum()),
-                        "segments": additional_info['segment_distribution'].set_index('Customer_Segment')['Count'].to_dict()
-                    }
-                    
-                    # Сохранение результатов в Firebase только если Firebase настроен
-                    if firebase_admin_imported:
-                        try:
-                            # Пробуем сохранить в Firebase Storage
-                            try:
-                                blob = bucket.blob(f"uploads/{file_name}")
-                                with open(file_name, "rb") as f:
-                                    blob.upload_from_file(f, content_type="text/csv")
-                                print(f"Файл успешно загружен в Firebase Storage")
-                            except Exception as storage_error:
-                                print(f"Ошибка при загрузке в Firebase Storage: {str(storage_error)}")
-                            
-                            # Пробуем сохранить в Firestore
-                            try:
-                                db.collection("rfm_results").add({
-                                    "file_name": file_name,
-                                    "result": rfm_result,
-                                    "timestamp": firestore.SERVER_TIMESTAMP
-                                })
-                                print(f"Результаты успешно сохранены в Firestore")
-                            except Exception as firestore_error:
-                                print(f"Ошибка при сохранении в Firestore: {str(firestore_error)}")
-                        except Exception as firebase_error:
-                            print(f"Общая ошибка при работе с Firebase: {str(firebase_error)}")
-                    else:
-                        print("Firebase не инициализирован, результаты не сохранены в облаке")
-                    
-                    # Создаем директорию results, если её нет
-                    results_dir = "results"
-                    if not os.path.exists(results_dir):
-                        os.makedirs(results_dir)
-                    
-                    # Сохраняем локально в CSV-файл
-                    result_file = f"{results_dir}/rfm_results_{int(datetime.now().timestamp())}.csv"
-                    rfm_df.to_csv(result_file, index=False)
-                    print(f"Результаты сохранены в {result_file}")
-                    
-                    # Обновляем исходную страницу index.html, чтобы добавить ссылку на дашборд
-                    try:
-                        self.ensure_dashboard_link_in_index()
-                    except Exception as e:
-                        print(f"Не удалось добавить ссылку на дашборд: {str(e)}")
-
-                    self.send_response(200)
-                    self.send_header("Content-type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps(rfm_result).encode())
-                except Exception as e:
-                    print(f"Ошибка в функции rfm_analysis: {str(e)}")
-                    traceback.print_exc()  # Печатаем полный стек ошибки
-                    self.send_response(500)
+                # Анализ выполняется в фоне, клиент получает id задачи и опрашивает /api/jobs/<id>
+                if not create_job(job_id, file_name, cache_key):
+                    self.send_response(503)
                     self.send_header("Content-type", "application/json")
+                    self.send_header("Retry-After", "30")
                     self.end_headers()
-                    self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
-
+                    self.wfile.write(json.dumps({"status": "error", "message": "Слишком много задач анализа, повторите позже"}).encode())
+                    return
+                analysis_executor.submit(run_analysis_job, job_id, file_name, is_parquet,
+                                         customer_col, date_col, amount_col, read_csv_kwargs,
+                                         analysis_params, cache_key)
+                self.send_job_response(202, job_id, "queued")
         except Exception as e:
             print(f"Общая ошибка: {str(e)}")
             traceback.print_exc()  # Печатаем полный стек ошибки
@@ -485,33 +1641,14 @@ class SimpleHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
 
-    def ensure_dashboard_link_in_index(self):
-        """Убеждаемся, что в index.html есть ссылка на дашборд"""
-        index_path = "static/index.html"
-        
-        try:
-            with open(index_path, "r", encoding="utf-8") as f:
-                content = f.read()
-            
-            # Проверяем, есть ли ссылка на дашборд
-            if '<a href="/dashboard"' not in content and 'id="results-card"' in content:
-                # Добавляем ссылку на дашборд
-                dashboard_link = '\n<div class="text-center mt-4">\n<a href="/dashboard" class="bg-blue-500 text-white px-4 py-2 rounded hover:bg-blue-600">Открыть расширенный дашборд</a>\n</div>\n'
-                
-                # Находим место для вставки ссылки
-                results_end_pos = content.find('</div>', content.find('id="results-card"'))
-                if results_end_pos != -1:
-                    new_content = content[:results_end_pos] + dashboard_link + content[results_end_pos:]
-                    
-                    # Сохраняем обновленный файл
-                    with open(index_path, "w", encoding="utf-8") as f:
-                        f.write(new_content)
-                        
-                    print("Ссылка на дашборд добавлена в index.html")
-        except Exception as e:
-            print(f"Ошибка при обновлении index.html: {str(e)}")
-            # Не останавливаем основной процесс из-за ошибки
-            pass
+    def send_job_response(self, code, job_id, status, **extra):
+        """Отправляет ответ загрузки со ссылкой на задачу анализа"""
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Location", f"/api/jobs/{job_id}")
+        self.end_headers()
+        self.wfile.write(json.dumps({"status": status, "job_id": job_id,
+                                     "status_url": f"/api/jobs/{job_id}", **extra}).encode())
 
     def check_auth(self, auth_header):
         if not firebase_admin_imported:
@@ -533,9 +1670,25 @@ try:
 except Exception as e:
     print(f"Ошибка при создании директории static/dashboard: {str(e)}")
 
+# Индекс результатов создается по существующим файлам, если его еще нет
+if os.path.isdir(RESULTS_DIR) and not os.path.exists(os.path.join(RESULTS_DIR, RESULTS_MANIFEST_NAME)):
+    try:
+        count = rebuild_results_manifest(RESULTS_DIR)
+        print(f"Индекс результатов создан: {count} записей")
+    except Exception as e:
+        print(f"Ошибка при создании индекса результатов: {str(e)}")
+
+# Старые загрузки и результаты удаляются при запуске и после каждой задачи анализа
+try:
+    evict_cached_files()
+except Exception as e:
+    print(f"Ошибка при удалении старых файлов: {str(e)}")
+
 try:
     print(f"Запуск сервера на http://localhost:{PORT}")
-    httpd = socketserver.TCPServer(("", PORT), Handler)
+    # Каждый запрос обрабатывается в отдельном потоке: статика и API
+    # доступны, пока в фоне выполняется анализ
+    httpd = http.server.ThreadingHTTPServer(("", PORT), Handler)
     httpd.serve_forever()
 except KeyboardInterrupt:
     print("Сервер остановлен пользователем")
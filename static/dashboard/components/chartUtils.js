@@ -2,6 +2,9 @@
  * Утилиты для работы с графиками на основе ApexCharts
  */
 const ChartUtils = (function() {
+    // Цвета сегментов на диаграммах
+    const SEGMENT_COLORS = ['#4f46e5', '#10b981', '#f59e0b', '#ef4444', '#8b5cf6', '#6b7280', '#059669', '#9333ea'];
+    
     /**
      * Создает столбчатую диаграмму на основе данных сегментов
      * @param {string} containerId ID контейнера для графика
@@ -134,7 +137,7 @@ const ChartUtils = (function() {
             dataLabels: {
                 enabled: false
             },
-            colors: ['#4f46e5', '#10b981', '#f59e0b', '#ef4444', '#8b5cf6', '#6b7280', '#059669', '#9333ea'],
+            colors: SEGMENT_COLORS,
             xaxis: {
                 categories: data.map(item => item.name),
                 labels: {
@@ -267,7 +270,7 @@ const ChartUtils = (function() {
                     color: '#444'
                 }
             },
-            colors: ['#4f46e5', '#10b981', '#f59e0b', '#ef4444', '#8b5cf6', '#6b7280', '#059669', '#9333ea']
+            colors: SEGMENT_COLORS
         };
         
         try {
@@ -281,6 +284,92 @@ const ChartUtils = (function() {
         }
     }
     
+    /**
+     * Рисует диаграмму рассеяния "частота - сумма покупок" на canvas.
+     * Точки читаются прямо из типизированных массивов, без объекта на каждую
+     * точку, поэтому диаграмма остается быстрой на десятках тысяч клиентов
+     * @param {string} containerId ID контейнера для графика
+     * @param {Object} points Точки {frequency, monetary, segments, segmentNames, total}
+     * @returns {HTMLCanvasElement} Canvas диаграммы
+     */
+    function createScatterChart(containerId, points) {
+        const container = document.getElementById(containerId);
+        if (!container) {
+            console.error(`Контейнер ${containerId} не найден`);
+            return null;
+        }
+        
+        const n = points.frequency.length;
+        const legend = points.segmentNames.map((name, code) => `
+            <span class="inline-flex items-center mr-3">
+                <span class="inline-block w-3 h-3 rounded-full mr-1" style="background: ${SEGMENT_COLORS[code % SEGMENT_COLORS.length]}"></span>${name}
+            </span>
+        `).join('');
+        container.innerHTML = `
+            <canvas></canvas>
+            <div class="text-xs text-gray-600 mt-1">
+                ${legend}<span class="text-gray-400">Показано ${n.toLocaleString()} из ${points.total.toLocaleString()} клиентов</span>
+            </div>
+        `;
+        
+        const canvas = container.querySelector('canvas');
+        const width = container.clientWidth || 600;
+        const height = (container.clientHeight || 300) - 40;
+        const ratio = window.devicePixelRatio || 1;
+        canvas.width = width * ratio;
+        canvas.height = height * ratio;
+        canvas.style.width = `${width}px`;
+        canvas.style.height = `${height}px`;
+        const ctx = canvas.getContext('2d');
+        ctx.scale(ratio, ratio);
+        
+        if (n === 0) {
+            return canvas;
+        }
+        
+        // Оси ограничены 99-м перцентилем, чтобы выбросы не сжимали остальные точки
+        const percentile = values => Float64Array.from(values).sort()[Math.floor((n - 1) * 0.99)] || 1;
+        const maxFrequency = percentile(points.frequency);
+        const maxMonetary = percentile(points.monetary);
+        
+        const padding = { left: 60, right: 10, top: 10, bottom: 25 };
+        const plotWidth = width - padding.left - padding.right;
+        const plotHeight = height - padding.top - padding.bottom;
+        
+        // Оси и подписи
+        ctx.strokeStyle = '#d1d5db';
+        ctx.beginPath();
+        ctx.moveTo(padding.left, padding.top);
+        ctx.lineTo(padding.left, padding.top + plotHeight);
+        ctx.lineTo(padding.left + plotWidth, padding.top + plotHeight);
+        ctx.stroke();
+        ctx.fillStyle = '#6b7280';
+        ctx.font = '11px sans-serif';
+        ctx.textAlign = 'right';
+        ctx.fillText(Math.round(maxMonetary).toLocaleString(), padding.left - 5, padding.top + 10);
+        ctx.fillText('0', padding.left - 5, padding.top + plotHeight);
+        ctx.fillText(Math.round(maxFrequency).toLocaleString(), padding.left + plotWidth, height - 5);
+        ctx.textAlign = 'left';
+        ctx.fillText('Частота покупок', padding.left, height - 5);
+        
+        // Точки рисуются по сегментам, чтобы цвет менялся один раз на сегмент
+        ctx.globalAlpha = 0.5;
+        points.segmentNames.forEach((name, code) => {
+            ctx.fillStyle = SEGMENT_COLORS[code % SEGMENT_COLORS.length];
+            for (let i = 0; i < n; i++) {
+                if (points.segments[i] !== code) {
+                    continue;
+                }
+                const x = padding.left + Math.min(points.frequency[i] / maxFrequency, 1) * plotWidth;
+                const y = padding.top + plotHeight - Math.min(points.monetary[i] / maxMonetary, 1) * plotHeight;
+                ctx.fillRect(x - 1, y - 1, 2, 2);
+            }
+        });
+        ctx.globalAlpha = 1;
+        
+        return canvas;
+    }
+    
     /**
      * Инициализирует все графики на странице
      * @param {string} activeTab Активная вкладка
@@ -302,7 +391,16 @@ const ChartUtils = (function() {
         // Формируем данные по доходу для каждого сегмента
         const segmentRevenueData = [];
         
-        if (state.rfmData.customers && state.rfmData.customers.length > 0) {
+        if (state.rfmData.segment_revenue) {
+            // Доход по сегментам рассчитан на сервере
+            for (const [segment, revenue] of Object.entries(state.rfmData.segment_revenue)) {
+                segmentRevenueData.push({
+                    name: segment,
+                    revenue: revenue
+                });
+            }
+            segmentRevenueData.sort((a, b) => b.revenue - a.revenue);
+        } else if (state.rfmData.customers && state.rfmData.customers.length > 0) {
             // Группируем клиентов по сегментам и суммируем их доход
             const segmentRevenues = {};
             
@@ -335,6 +433,10 @@ const ChartUtils = (function() {
             if (document.getElementById('segment-revenue-chart') && segmentRevenueData.length > 0) {
                 createSegmentRevenueChart('segment-revenue-chart', segmentRevenueData);
             }
+            
+            if (document.getElementById('customers-scatter-chart') && state.customerPoints) {
+                createScatterChart('customers-scatter-chart', state.customerPoints);
+            }
         }
         
         // График для вкладки "Сегменты"
@@ -349,6 +451,7 @@ const ChartUtils = (function() {
     return {
         createBarChart,
         createPieChart,
+        createScatterChart,
         createSegmentRevenueChart,
         initializeCharts
     };
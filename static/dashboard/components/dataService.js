@@ -38,12 +38,46 @@ const DataService = (function() {
     // API эндпоинты
     const API_ENDPOINTS = {
         RFM_DATA: '/api/rfm-data',
+        CUSTOMERS: '/api/customers',
+        SCATTER: '/api/scatter',
+        SEGMENT_STATS: '/api/aggregates/segments',
         UPLOAD_HISTORY: '/api/upload-history'
     };
     
+    // Клиенты загружаются постранично: только строки, которые показывает таблица
+    const CUSTOMERS_PAGE_SIZE = 10;
+    const CUSTOMER_COLUMNS = ['Recency', 'Frequency', 'Monetary', 'RFM_Score', 'Customer_Segment'];
+    
+    // Число точек диаграммы рассеяния: сервер отбирает их по сегментам из всех клиентов
+    const MAX_CHART_POINTS = 5000;
+    const ARROW_STREAM_TYPE = 'application/vnd.apache.arrow.stream';
+    
+    // Диапазоны RFM Score для фильтра таблицы клиентов
+    const SCORE_RANGES = {
+        high: [8, 10],
+        medium: [5, 7],
+        low: [1, 4]
+    };
+    
     // Состояние данных
     let state = {
         rfmData: DEMO_DATA,
+        segmentStats: null,
+        customersPage: {
+            customers: DEMO_DATA.customers,
+            total: DEMO_DATA.customers.length,
+            offset: 0,
+            limit: CUSTOMERS_PAGE_SIZE,
+            idColumn: 'CustomerID',
+            fromServer: false
+        },
+        customerQuery: {
+            segment: 'all',
+            score: 'all',
+            sort: null,
+            order: 'desc'
+        },
+        customerPoints: null,
         uploadHistory: [],
         isLoading: false,
         error: null
@@ -99,6 +133,172 @@ const DataService = (function() {
         }
     }
     
+    /**
+     * Загрузка статистики по сегментам из сводных агрегатов сервера
+     * @returns {Promise} Промис со статистикой сегментов
+     */
+    async function loadSegmentStats() {
+        try {
+            const response = await fetch(API_ENDPOINTS.SEGMENT_STATS);
+            if (!response.ok) {
+                throw new Error('Не удалось загрузить статистику сегментов');
+            }
+            
+            state.segmentStats = await response.json();
+            notifyListeners();
+            return state.segmentStats;
+        } catch (error) {
+            console.error('Ошибка при загрузке статистики сегментов:', error);
+            return state.segmentStats;
+        }
+    }
+    
+    /**
+     * Формирует параметры запроса клиентов по текущим фильтрам
+     * @returns {URLSearchParams} Параметры запроса
+     */
+    function buildCustomerParams() {
+        const query = state.customerQuery;
+        const params = new URLSearchParams();
+        
+        if (query.segment !== 'all') {
+            params.set('segment', query.segment);
+        }
+        if (SCORE_RANGES[query.score]) {
+            params.set('score_min', SCORE_RANGES[query.score][0]);
+            params.set('score_max', SCORE_RANGES[query.score][1]);
+        }
+        if (query.sort) {
+            params.set('sort', query.sort);
+            params.set('order', query.order);
+        }
+        
+        return params;
+    }
+    
+    /**
+     * Загрузка страницы клиентов с сервера
+     * @param {Object} changes Изменения запроса: offset, segment, score, sort, order
+     * @returns {Promise} Промис со страницей клиентов
+     */
+    async function loadCustomers(changes = {}) {
+        const { offset = 0, ...queryChanges } = changes;
+        state.customerQuery = { ...state.customerQuery, ...queryChanges };
+        
+        const params = buildCustomerParams();
+        params.set('offset', offset);
+        params.set('limit', CUSTOMERS_PAGE_SIZE);
+        params.set('columns', CUSTOMER_COLUMNS.join(','));
+        
+        try {
+            const response = await fetch(`${API_ENDPOINTS.CUSTOMERS}?${params}`);
+            if (!response.ok) {
+                throw new Error('Не удалось загрузить клиентов');
+            }
+            
+            const data = await response.json();
+            state.customersPage = {
+                customers: data.customers,
+                total: data.total,
+                offset: data.offset,
+                limit: data.limit,
+                idColumn: data.id_column,
+                fromServer: true
+            };
+            notifyListeners();
+            return state.customersPage;
+        } catch (error) {
+            console.error('Ошибка при загрузке клиентов:', error);
+            return state.customersPage;
+        }
+    }
+    
+    /**
+     * Точки диаграммы из таблицы Arrow: столбцы используются как типизированные
+     * массивы из буферов ответа, сегменты - как коды словаря Arrow
+     * @param {Object} table Таблица Arrow
+     * @returns {Object} Точки {frequency, monetary, segments, segmentNames, total}
+     */
+    function pointsFromArrow(table) {
+        const segment = table.getChild('Customer_Segment');
+        const codes = new Uint8Array(table.numRows);
+        let offset = 0;
+        for (const chunk of segment.data) {
+            codes.set(chunk.values, offset);
+            offset += chunk.length;
+        }
+        
+        return {
+            frequency: table.getChild('Frequency').toArray(),
+            monetary: table.getChild('Monetary').toArray(),
+            segments: codes,
+            segmentNames: segment.data.length > 0 ? Array.from(segment.data[0].dictionary) : [],
+            total: Number(table.schema.metadata.get('total'))
+        };
+    }
+    
+    /**
+     * Точки диаграммы из JSON по столбцам (если Arrow недоступен)
+     * @param {Object} data Ответ API диаграммы в формате JSON по столбцам
+     * @returns {Object} Точки {frequency, monetary, segments, segmentNames, total}
+     */
+    function pointsFromJson(data) {
+        const segmentNames = [];
+        const segmentCodes = new Map();
+        const values = data.customers.Customer_Segment;
+        const codes = new Uint8Array(values.length);
+        
+        values.forEach((name, i) => {
+            if (!segmentCodes.has(name)) {
+                segmentCodes.set(name, segmentNames.length);
+                segmentNames.push(name);
+            }
+            codes[i] = segmentCodes.get(name);
+        });
+        
+        return {
+            frequency: Float64Array.from(data.customers.Frequency),
+            monetary: Float64Array.from(data.customers.Monetary),
+            segments: codes,
+            segmentNames,
+            total: data.total
+        };
+    }
+    
+    /**
+     * Загрузка точек диаграммы рассеяния в типизированные массивы: выборка
+     * клиентов по сегментам, размер которой не зависит от числа клиентов.
+     * Если на странице есть библиотека Apache Arrow, данные запрашиваются
+     * в формате Arrow IPC, иначе - JSON по столбцам
+     * @returns {Promise} Промис с точками диаграммы
+     */
+    async function loadCustomerPoints() {
+        const params = new URLSearchParams({
+            mode: 'sample',
+            max_points: MAX_CHART_POINTS
+        });
+        const useArrow = typeof Arrow !== 'undefined';
+        
+        try {
+            const response = await fetch(`${API_ENDPOINTS.SCATTER}?${params}`, {
+                headers: useArrow ? { 'Accept': `${ARROW_STREAM_TYPE}, application/json;q=0.9` } : {}
+            });
+            if (!response.ok) {
+                throw new Error('Не удалось загрузить точки диаграммы');
+            }
+            
+            const contentType = response.headers.get('Content-Type') || '';
+            state.customerPoints = contentType.startsWith(ARROW_STREAM_TYPE)
+                ? pointsFromArrow(Arrow.tableFromIPC(new Uint8Array(await response.arrayBuffer())))
+                : pointsFromJson(await response.json());
+            notifyListeners();
+            return state.customerPoints;
+        } catch (error) {
+            console.error('Ошибка при загрузке точек диаграммы:', error);
+            return state.customerPoints;
+        }
+    }
+    
     /**
      * Загрузка истории загрузок
      * @returns {Promise} Промис с данными истории
@@ -124,12 +324,20 @@ const DataService = (function() {
      * Экспорт данных в CSV
      */
     function exportToCSV() {
-        if (!state.rfmData || !state.rfmData.customers || state.rfmData.customers.length === 0) {
+        if (state.customersPage.fromServer) {
+            // Выгрузку всех отобранных клиентов формирует сервер
+            const params = buildCustomerParams();
+            params.set('format', 'csv');
+            window.location.href = `${API_ENDPOINTS.CUSTOMERS}?${params}`;
+            return;
+        }
+        
+        if (!state.customersPage.customers || state.customersPage.customers.length === 0) {
             alert('Нет данных для экспорта');
             return;
         }
         
-        const customers = state.rfmData.customers;
+        const customers = state.customersPage.customers;
         
         // Получаем заголовки столбцов из первого клиента
         const headers = Object.keys(customers[0]);
@@ -193,6 +401,9 @@ const DataService = (function() {
     function init() {
         // Асинхронно загружаем данные
         loadRfmData();
+        loadSegmentStats();
+        loadCustomers();
+        loadCustomerPoints();
         loadUploadHistory();
     }
     
@@ -201,6 +412,9 @@ const DataService = (function() {
         subscribe,
         getState,
         loadRfmData,
+        loadSegmentStats,
+        loadCustomers,
+        loadCustomerPoints,
         loadUploadHistory,
         exportToCSV,
         getSegmentClass,
@@ -53,6 +53,10 @@ const MetricsComponent = (function() {
                     <div class="chart-container" id="segment-revenue-chart"></div>
                 </div>
             </div>
+            <div class="bg-white rounded-lg shadow p-4 mb-6">
+                <h3 class="text-lg font-semibold mb-4">Частота и сумма покупок клиентов</h3>
+                <div class="chart-container" id="customers-scatter-chart"></div>
+            </div>
         `;
     }
     
@@ -26,6 +26,9 @@ const SegmentsComponent = (function() {
             return '<div class="text-center p-4">Нет данных о сегментах</div>';
         }
         
+        // Статистика сегментов из сводных агрегатов сервера (для демо-данных ее нет)
+        const segmentStats = state.segmentStats || {};
+        
         const segmentColors = {
             'Чемпионы': 'bg-indigo-100 border-indigo-500',
             'Лояльные клиенты': 'bg-blue-100 border-blue-500',
@@ -50,6 +53,20 @@ const SegmentsComponent = (function() {
                             <span>% от общего:</span>
                             <span class="font-bold">${((count / state.rfmData.summary.total_customers) * 100).toFixed(1)}%</span>
                         </div>
+                        ${segmentStats[segment] ? `
+                            <div class="flex justify-between">
+                                <span>Доход:</span>
+                                <span class="font-bold">${Math.round(segmentStats[segment].revenue).toLocaleString()}</span>
+                            </div>
+                            <div class="flex justify-between">
+                                <span>Средняя давность:</span>
+                                <span class="font-bold">${segmentStats[segment].avg_recency.toFixed(0)} дн.</span>
+                            </div>
+                            <div class="flex justify-between">
+                                <span>Средняя частота:</span>
+                                <span class="font-bold">${segmentStats[segment].avg_frequency.toFixed(1)}</span>
+                            </div>
+                        ` : ''}
                     </div>
                 `).join('')}
             </div>
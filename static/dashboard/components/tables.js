@@ -8,12 +8,16 @@ const TablesComponent = (function() {
      */
     function renderClientsTable() {
         const state = DataService.getState();
+        const page = state.customersPage;
         
-        if (!state.rfmData || !state.rfmData.customers || state.rfmData.customers.length === 0) {
+        if (!page || !page.customers || page.customers.length === 0) {
             return '<div class="text-center p-4">Нет данных о клиентах</div>';
         }
         
-        const customers = state.rfmData.customers.slice(0, 10); // Показываем только первые 10 для производительности
+        // Сервер возвращает только строки текущей страницы
+        const customers = page.customers;
+        const currentPage = Math.floor(page.offset / page.limit) + 1;
+        const totalPages = Math.ceil(page.total / page.limit);
         
         return `
             <div class="bg-white rounded-lg shadow overflow-hidden mb-6">
@@ -23,17 +27,17 @@ const TablesComponent = (function() {
                         <thead>
                             <tr>
                                 <th>ID</th>
-                                <th>Recency</th>
-                                <th>Frequency</th>
-                                <th>Monetary</th>
-                                <th>RFM Score</th>
+                                <th class="cursor-pointer" onclick="TablesComponent.sortBy('Recency')">Recency</th>
+                                <th class="cursor-pointer" onclick="TablesComponent.sortBy('Frequency')">Frequency</th>
+                                <th class="cursor-pointer" onclick="TablesComponent.sortBy('Monetary')">Monetary</th>
+                                <th class="cursor-pointer" onclick="TablesComponent.sortBy('RFM_Score')">RFM Score</th>
                                 <th>Сегмент</th>
                             </tr>
                         </thead>
                         <tbody>
                             ${customers.map(customer => `
                                 <tr>
-                                    <td>${customer.CustomerID}</td>
+                                    <td>${customer[page.idColumn]}</td>
                                     <td>${customer.Recency}</td>
                                     <td>${customer.Frequency}</td>
                                     <td>₽${customer.Monetary.toLocaleString()}</td>
@@ -49,8 +53,9 @@ const TablesComponent = (function() {
                     </table>
                 </div>
                 <div class="p-4 border-t text-right">
-                    <span class="text-gray-500">Показаны первые 10 клиентов из ${state.rfmData.customers.length}</span>
+                    <span class="text-gray-500">Показаны клиенты ${page.offset + 1}–${page.offset + customers.length} из ${page.total}</span>
                 </div>
+                ${createPagination(currentPage, totalPages)}
             </div>
         `;
     }
@@ -75,8 +80,10 @@ const TablesComponent = (function() {
             paginationHtml += '<button class="pagination-btn disabled" disabled>Предыдущая</button>';
         }
         
-        // Номера страниц
-        for (let i = 1; i <= totalPages; i++) {
+        // Номера страниц: только соседние с текущей, чтобы не выводить тысячи кнопок
+        const firstPage = Math.max(1, currentPage - 2);
+        const lastPage = Math.min(totalPages, currentPage + 2);
+        for (let i = firstPage; i <= lastPage; i++) {
             if (i === currentPage) {
                 paginationHtml += `<button class="pagination-btn active">${i}</button>`;
             } else {
@@ -102,12 +109,24 @@ const TablesComponent = (function() {
      */
     function goToPage(page) {
         console.log(`Переход на страницу ${page}`);
-        // Логика пагинации здесь
-        // Обновляем отображение таблицы
-        const tableContainer = document.getElementById('clients-table-container');
-        if (tableContainer) {
-            // Обновляем содержимое
-        }
+        const { customersPage } = DataService.getState();
+        DataService.loadCustomers({ offset: (page - 1) * customersPage.limit });
+    }
+    
+    /**
+     * Фильтрация клиентов по сегменту
+     * @param {string} segment Название сегмента или 'all'
+     */
+    function filterBySegment(segment) {
+        DataService.loadCustomers({ segment });
+    }
+    
+    /**
+     * Фильтрация клиентов по диапазону RFM Score
+     * @param {string} score 'high', 'medium', 'low' или 'all'
+     */
+    function filterByScore(score) {
+        DataService.loadCustomers({ score });
     }
     
     /**
@@ -125,8 +144,13 @@ const TablesComponent = (function() {
      * @param {boolean} ascending Направление сортировки
      */
     function sortBy(column, ascending) {
+        const { customerQuery } = DataService.getState();
+        if (ascending === undefined) {
+            // Повторный клик по тому же столбцу меняет направление
+            ascending = customerQuery.sort === column && customerQuery.order === 'desc';
+        }
         console.log(`Сортировка по ${column}, ascending: ${ascending}`);
-        // Логика сортировки
+        DataService.loadCustomers({ sort: column, order: ascending ? 'asc' : 'desc' });
     }
     
     /**
@@ -134,6 +158,16 @@ const TablesComponent = (function() {
      * @returns {string} HTML-код вкладки клиентов
      */
     function renderClientsTab() {
+        const state = DataService.getState();
+        const query = state.customerQuery;
+        const segments = Object.keys(state.rfmData.segments || {});
+        const scoreOptions = [
+            ['all', 'Все оценки RFM'],
+            ['high', 'Высокая оценка (8-10)'],
+            ['medium', 'Средняя оценка (5-7)'],
+            ['low', 'Низкая оценка (1-4)']
+        ];
+        
         return `
             <div class="mb-4">
                 <div class="bg-white rounded-lg shadow p-4">
@@ -152,19 +186,16 @@ const TablesComponent = (function() {
                             >
                         </div>
                         <div class="flex gap-2">
-                            <select class="p-2 border rounded" id="segment-filter">
+                            <select class="p-2 border rounded" id="segment-filter" onchange="TablesComponent.filterBySegment(this.value)">
                                 <option value="all">Все сегменты</option>
-                                <option value="Чемпионы">Чемпионы</option>
-                                <option value="Лояльные клиенты">Лояльные клиенты</option>
-                                <option value="Новые клиенты">Новые клиенты</option>
-                                <option value="Под угрозой ухода">Под угрозой ухода</option>
-                                <option value="Потерянные">Потерянные</option>
+                                ${segments.map(segment => `
+                                    <option value="${segment}" ${query.segment === segment ? 'selected' : ''}>${segment}</option>
+                                `).join('')}
                             </select>
-                            <select class="p-2 border rounded" id="score-filter">
-                                <option value="all">Все оценки RFM</option>
-                                <option value="high">Высокая оценка (8-10)</option>
-                                <option value="medium">Средняя оценка (5-7)</option>
-                                <option value="low">Низкая оценка (1-4)</option>
+                            <select class="p-2 border rounded" id="score-filter" onchange="TablesComponent.filterByScore(this.value)">
+                                ${scoreOptions.map(([value, label]) => `
+                                    <option value="${value}" ${query.score === value ? 'selected' : ''}>${label}</option>
+                                `).join('')}
                             </select>
                         </div>
                     </div>
@@ -174,10 +205,6 @@ const TablesComponent = (function() {
             <div id="clients-table-container">
                 ${renderClientsTable()}
             </div>
-            
-            <div class="mt-4">
-                ${createPagination(1, 5)}
-            </div>
         `;
     }
     
@@ -187,6 +214,8 @@ const TablesComponent = (function() {
         renderClientsTab,
         createPagination,
         goToPage,
+        filterBySegment,
+        filterByScore,
         searchClients,
         sortBy
     };
@@ -108,7 +108,7 @@ const DashboardApp = (function() {
             case 'segments':
                 return SegmentsComponent.renderSegmentsTab();
             case 'clients':
-                return TablesComponent.renderClientsTable();
+                return TablesComponent.renderClientsTab();
             case 'reports':
                 return ReportsComponent.renderReportsTab();
             default:
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rfmpro_analysis import rfm_analysis, rfm_arrow_table, iter_rfm_arrow
+
+pa = pytest.importorskip('pyarrow')
+
+
+def _small_result():
+    rng = np.random.default_rng(0)
+    n_rows = 2000
+    transactions = pd.DataFrame({
+        'date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D'),
+        'customer': rng.integers(0, 300, n_rows),
+        'amount': rng.gamma(2.0, 50.0, n_rows).round(2),
+    })
+    rfm, _ = rfm_analysis(transactions, 'date', 'customer', 'amount', analysis_date='2025-01-01')
+    return rfm
+
+
+def test_segments_are_dictionary_encoded_for_non_compact_result():
+    rfm = _small_result()
+    # Без компактных типов сегменты хранятся строками
+    assert not isinstance(rfm['Customer_Segment'].dtype, pd.CategoricalDtype)
+
+    table = rfm_arrow_table(rfm)
+    segment_type = table.schema.field('Customer_Segment').type
+    assert pa.types.is_dictionary(segment_type)
+    assert pa.types.is_string(segment_type.value_type)
+    assert table.column('Customer_Segment').to_pylist() == rfm['Customer_Segment'].tolist()
+
+
+def test_arrow_stream_keeps_dictionary_segments():
+    rfm = _small_result()
+    body = b''.join(iter_rfm_arrow(rfm_arrow_table(rfm), np.arange(0, len(rfm), 2),
+                                   ['Frequency', 'Monetary', 'Customer_Segment'], {'total': len(rfm)},
+                                   batch_size=50))
+    table = pa.ipc.open_stream(body).read_all()
+    assert pa.types.is_dictionary(table.schema.field('Customer_Segment').type)
+    assert table.column('Customer_Segment').to_pylist() == rfm['Customer_Segment'].iloc[::2].tolist()
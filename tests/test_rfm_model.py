@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from rfmpro_analysis import RFMModel
+
+
+def _transactions(n_customers=200, n_rows=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D'),
+        'customer': rng.integers(0, n_customers, n_rows),
+        'amount': rng.gamma(2.0, 50.0, n_rows).round(2),
+    })
+
+
+def test_save_and_load_model_with_callable_rules(tmp_path):
+    rules = [
+        ('Лучшие', lambda r, f, m: (r + f + m) >= 10),
+        ('Активные', lambda r, f, m: r >= 3),
+        ('Спящие', {'R': (None, 2)}),
+    ]
+    transactions = _transactions()
+    model = RFMModel(n_quantiles=4, segment_mapping=rules)
+    model.fit(transactions, 'date', 'customer', 'amount', analysis_date='2025-01-01')
+
+    path = tmp_path / 'model.json'
+    model.save(str(path))
+    loaded = RFMModel.load(str(path))
+
+    metrics = pd.DataFrame({
+        'Recency': [1, 30, 120, 300],
+        'Frequency': [20, 10, 5, 1],
+        'Monetary': [2000.0, 900.0, 300.0, 20.0],
+    })
+    expected = model.transform(metrics)
+    actual = loaded.transform(metrics)
+    pd.testing.assert_series_equal(actual['Customer_Segment'], expected['Customer_Segment'])
+    assert set(actual['Customer_Segment']) <= {'Лучшие', 'Активные', 'Спящие', 'Прочие'}
+    assert loaded.score(1, 20, 2000.0) == model.score(1, 20, 2000.0)
+
+
+def test_save_and_load_model_with_default_rules(tmp_path):
+    model = RFMModel(n_quantiles=4).fit(_transactions(), 'date', 'customer', 'amount',
+                                        analysis_date='2025-01-01')
+    path = tmp_path / 'model.json'
+    model.save(str(path))
+    loaded = RFMModel.load(str(path))
+
+    metrics = pd.DataFrame({'Recency': [5, 200], 'Frequency': [15, 2], 'Monetary': [1500.0, 50.0]})
+    pd.testing.assert_frame_equal(loaded.transform(metrics), model.transform(metrics))
+    assert loaded.segment_mapping is None
+
+
+def test_fixed_intervals_score_values_between_observed_values():
+    analysis_date = pd.Timestamp('2024-04-01')
+    transactions = pd.DataFrame({
+        'date': [analysis_date - pd.Timedelta(days=days) for days in (17, 31, 60, 91)],
+        'customer': [1, 2, 3, 4],
+        'amount': [10.0, 20.0, 30.0, 40.0],
+    })
+    model = RFMModel(ranking_method='fixed', custom_intervals={'R': [30, 60]})
+    model.fit(transactions, 'date', 'customer', 'amount', analysis_date=analysis_date)
+
+    # 25 лежит между наблюдаемыми 17 и 31, но внутри интервала (-inf, 30]
+    expected = pd.cut(pd.Series([25, 45, 61]), bins=[-np.inf, 30, 60, np.inf], labels=[1, 2, 3])
+    assert [model.score(value, 1, 10.0)['R_rank'] for value in (25, 45, 61)] == expected.astype(int).tolist()
+    np.testing.assert_array_equal(model.rank_edges['R']['edges'], [30, 60])